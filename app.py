@@ -1,42 +1,95 @@
 import os
-import sys
-import time
 from flask import Flask
 from linebot import LineBotApi, WebhookParser
 from dotenv import load_dotenv
 
-from views import register_url
+from views import register_url, create_event_queue
+from handlers import Session, session_factory, init_database
+from event_queue import DEFAULT_WORKERS, DEFAULT_MAX_DEPTH
+from line_dispatcher import PooledHttpClient, LineDispatcher, LINE_API_TIMEOUT
+from metrics import start_dumper
+from database import wait_for_database, WAIT_DEADLINE
+from dialog_store import create_dialog_store, DEFAULT_SQLITE_PATH
 
-app = Flask(__name__)
 
-# Load env variables
-dotenv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env')
-if os.path.exists(dotenv_path):
-    load_dotenv(dotenv_path=dotenv_path)
+def load_config():
+    """
+    Config from the environment, and from .env if it exists
+    """
+    dotenv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env')
+    if os.path.exists(dotenv_path):
+        load_dotenv(dotenv_path=dotenv_path)
+    return {
+        "DEBUG": True if os.getenv("DEBUG") == "True" else False,
+        "DATABASE_URI": os.getenv("DATABASE_URI"),
+        "CHANNEL_ACCESS_TOKEN": os.getenv("CHANNEL_ACCESS_TOKEN", None),
+        "CHANNEL_SECRET":  os.getenv("CHANNEL_SECRET", None),
+        # Another endpoint, e.g. the stub of loadtest_webhook.py, receives the replies instead of LINE
+        "LINE_API_ENDPOINT": os.getenv("LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT),
+        "EVENT_QUEUE_WORKERS": int(os.getenv("EVENT_QUEUE_WORKERS", DEFAULT_WORKERS)),
+        "EVENT_QUEUE_MAX_DEPTH": int(os.getenv("EVENT_QUEUE_MAX_DEPTH", DEFAULT_MAX_DEPTH)),
+        "DB_WAIT_SECONDS": int(os.getenv("DB_WAIT_SECONDS", WAIT_DEADLINE)),
+        "METRICS_DIR": os.getenv("METRICS_DIR"),
+        # "memory" keeps the dialogs in the process, only for a single worker
+        "DIALOG_STORE": os.getenv("DIALOG_STORE", "sqlite"),
+        "DIALOG_STORE_PATH": os.getenv("DIALOG_STORE_PATH", DEFAULT_SQLITE_PATH),
+        "DIALOG_STORE_SYNC_WRITE": os.getenv("DIALOG_STORE_SYNC_WRITE") == "True",
+    }
 
-# Set up config
-app.config.update({
-    "DEBUG": True if os.getenv("DEBUG") == "True" else False,
-    "DATABASE_URI": os.getenv("DATABASE_URI"),
-    "CHANNEL_ACCESS_TOKEN": os.getenv("CHANNEL_ACCESS_TOKEN", None),
-    "CHANNEL_SECRET":  os.getenv("CHANNEL_SECRET", None),
-})
 
-# Create Linebot instance
-try:
-    app.linebot = LineBotApi(app.config['CHANNEL_ACCESS_TOKEN'])
+def create_app(config=None):
+    """
+    Importing this module does nothing, the engine, the LINE clients and the event queue are created
+    here. Nothing connects or runs in the background until start_app or the first request.
+    :param config: dict overriding the config loaded from the environment
+    """
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(config or {})
+    if not app.config["DATABASE_URI"]:
+        raise RuntimeError("Please specify DATABASE_URI.")
+    if not app.config["CHANNEL_ACCESS_TOKEN"] or not app.config["CHANNEL_SECRET"]:
+        raise RuntimeError("Please specify line CHANNEL_ACCESS_TOKEN and CHANNEL_SECRET.")
+
+    app.engine = init_database(app.config["DATABASE_URI"])
+    # Create Linebot instance, it only connects to LINE when sending
+    app.linebot = LineBotApi(app.config['CHANNEL_ACCESS_TOKEN'], endpoint=app.config["LINE_API_ENDPOINT"],
+                             timeout=LINE_API_TIMEOUT, http_client=PooledHttpClient)
+    app.line_dispatcher = LineDispatcher(app.linebot)
     app.parser = WebhookParser(app.config['CHANNEL_SECRET'])
-except KeyError:
-    app.logger.error("Please specify line CHANNEL_ACCESS_TOKEN and CHANNEL_SECRET.")
-    sys.exit(1)
 
-# Register routing rule
-register_url(app)
+    # Handlers use the session of the thread or greenlet handling the event
+    app.session = Session
+    app.dialog_store = create_dialog_store(session_factory, app.config["DIALOG_STORE"],
+                                           app.config["DIALOG_STORE_PATH"], app.config["DIALOG_STORE_SYNC_WRITE"])
+
+    # Register routing rule, the workers of the event queue start with the first delivery
+    register_url(app)
+    app.event_queue = create_event_queue(app)
+    return app
+
+
+def start_app(app):
+    """
+    Start what a served app needs besides handling requests, called by wsgi.py
+    """
+    # Every worker writes its metrics to METRICS_DIR, so /metrics of any worker reports all of them
+    if app.config["METRICS_DIR"]:
+        start_dumper(app.config["METRICS_DIR"])
+
+    # Enable "flask db" commands, see migrations/README. Alembic is only imported here as it is slow
+    from flask_migrate import Migrate
+    from models import Base
+    Migrate(app, Base)
+
+    # Wait for postgresql to start, this returns at once when it is already up
+    if not wait_for_database(app.engine, deadline=app.config["DB_WAIT_SECONDS"]):
+        app.logger.error("Database is not reachable yet, /readyz tells when it is.")
 
-time.sleep(5)  # wait for postgresql to start
+    # Base models will be created in routine container
+    app.logger.info("START....")
+    return app
 
-# Base models will be created in routine container
-app.logger.info("START....")
 
 if __name__ == "__main__":
-    app.run()
+    start_app(create_app()).run()
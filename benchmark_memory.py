@@ -0,0 +1,83 @@
+"""
+Compare the memory of a day of timetables loaded as ORM objects and as a DayIndex.
+
+    python benchmark_memory.py --tra-dates 2018-06-02 --thsr-dates 2018-06-05
+
+The dates have to be built already. The measured average per date is projected to the number of
+dates given by --tra-days and --thsr-days.
+"""
+import os
+import gc
+import argparse
+import tracemalloc
+from datetime import datetime
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, contains_eager
+
+# Load env variables
+dotenv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path=dotenv_path)
+
+from timetable_index import build_day_index, get_table_classes  # noqa
+
+MEGABYTE = 1024 * 1024
+
+
+def load_orm(session, train_type, service_date):
+    _, timetable_class, table_entry_class = get_table_classes(train_type)
+    return session.query(timetable_class, table_entry_class) \
+        .join(table_entry_class, table_entry_class.pattern_id == timetable_class.pattern_id) \
+        .join(timetable_class.train) \
+        .options(contains_eager(timetable_class.train)) \
+        .filter(timetable_class.date == service_date).all()
+
+
+def measure(load, session_factory, train_type, service_date):
+    """
+    :return: bytes still allocated after the load
+    """
+    session = session_factory()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = load(session, train_type, service_date)  # noqa: F841 keeps the result alive
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+        session.close()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory of timetables loaded as ORM objects and as DayIndex")
+    parser.add_argument("--tra-dates", nargs="*", default=[], help="YYYY-MM-DD")
+    parser.add_argument("--thsr-dates", nargs="*", default=[], help="YYYY-MM-DD")
+    parser.add_argument("--tra-days", type=int, default=60, help="Number of TRA dates to project to")
+    parser.add_argument("--thsr-days", type=int, default=45, help="Number of THSR dates to project to")
+    args = parser.parse_args()
+
+    engine = create_engine(os.environ["DATABASE_URI"])
+    session_factory = sessionmaker(bind=engine)
+    projected = {"ORM": 0, "DayIndex": 0}
+    for train_type, dates, days in (("TRA", args.tra_dates, args.tra_days),
+                                    ("THSR", args.thsr_dates, args.thsr_days)):
+        if not dates:
+            continue
+        totals = {"ORM": 0, "DayIndex": 0}
+        for text in dates:
+            service_date = datetime.strptime(text, "%Y-%m-%d").date()
+            for name, load in (("ORM", load_orm), ("DayIndex", build_day_index)):
+                size = measure(load, session_factory, train_type, service_date)
+                totals[name] += size
+                print("{0:<4} {1} {2:<8} {3:>8.2f} MB".format(train_type, text, name, size / MEGABYTE))
+        for name, total in totals.items():
+            projected[name] += total / len(dates) * days
+    print("Projected to {0} TRA and {1} THSR dates".format(args.tra_days, args.thsr_days))
+    for name, total in projected.items():
+        print("{0:<8} {1:>8.2f} MB".format(name, total / MEGABYTE))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Benchmark the train search over the recorded days of tests/load_example.py.
+
+    python benchmark_search.py --database sqlite:///benchmark.sqlite3 --rounds 5 --output search.json
+    python benchmark_search.py --database $TESTING_DATABASE_URI
+
+The recorded days are loaded into the database when they are not built there yet. Every engine
+answers the same fixed mix of searches, and the p50/p95/p99 latency, the statements per search and
+the peak memory are printed and written as JSON, so runs of different commits can be compared.
+Every engine has to return exactly the trains of "sql", the reference search joining the stops of
+the timetables, in every round, so results served from the cache are checked as well. Otherwise
+the differences are printed and the exit status is 1.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from datetime import date, datetime, time as clock_time
+from collections import namedtuple
+from dotenv import load_dotenv
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# Load env variables
+dotenv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path=dotenv_path)
+
+from models import Base, TRA_BuildingStatusOnDate, THSR_BuildingStatusOnDate  # noqa
+from database import instrument_engine, count_queries  # noqa
+from metrics import percentile  # noqa
+from handlers import (  # noqa
+    SearchQuestion, request_matching_train, request_joined_matching_train, search_trains, find_matching_train,
+    get_request_date
+)
+from timetable_index import timetable_index, get_timetable_version  # noqa
+from search_cache import search_cache  # noqa
+from tests.load_example import load_example_timetable_to_database  # noqa
+
+MEGABYTE = 1024 * 1024
+# Recorded days of tests/load_example.py
+DATES = {"TRA": date(2018, 6, 2), "THSR": date(2018, 6, 5)}
+BUILDING_STATUS_CLASSES = {"TRA": TRA_BuildingStatusOnDate, "THSR": THSR_BuildingStatusOnDate}
+# Busy origin and destination pairs, both directions are searched
+TRA_PAIRS = [("臺北", "臺中"), ("臺北", "新竹"), ("臺北", "高雄"), ("板橋", "桃園"), ("臺中", "彰化"),
+             ("臺南", "高雄"), ("嘉義", "臺南"), ("臺北", "花蓮"), ("臺北", "宜蘭"), ("新竹", "竹北")]
+THSR_PAIRS = [("臺北", "左營"), ("臺北", "臺中"), ("板橋", "新竹"), ("桃園", "臺南"), ("臺中", "嘉義"),
+              ("南港", "左營")]
+# Searches are spread over the day, the ones after midnight belong to the day before
+DEPARTURE_TIMES = [clock_time(6, 0), clock_time(7, 45), clock_time(8, 30), clock_time(12, 15),
+                   clock_time(17, 50), clock_time(18, 30), clock_time(22, 40), clock_time(0, 30)]
+PERCENTILES = (50, 95, 99)
+
+Search = namedtuple("Search", ["train_type", "question"])
+
+
+def build_search_mix(dates=DATES):
+    searches = list()
+    for train_type, pairs in (("TRA", TRA_PAIRS), ("THSR", THSR_PAIRS)):
+        if train_type not in dates:
+            continue
+        service_date = dates[train_type]
+        for departure, destination in pairs:
+            for a, b in ((departure, destination), (destination, departure)):
+                for t in DEPARTURE_TIMES:
+                    day = service_date if t.hour >= 3 else date.fromordinal(service_date.toordinal() + 1)
+                    searches.append(Search(train_type, SearchQuestion(a, b, datetime.combine(day, t))))
+    return searches
+
+
+def search_sql(session, search):
+    return request_joined_matching_train(search.question, search.train_type)
+
+
+def search_request(session, search):
+    """
+    What handlers.py answered with before the index, trip pairs if precomputed
+    """
+    return request_matching_train(search.question, search.train_type)
+
+
+def search_index(session, search):
+    request_date = get_request_date(search.question.departure_time)
+    version = get_timetable_version(session, search.train_type, request_date)
+    return search_trains(search.train_type, search.question, request_date, version)
+
+
+def search_cached(session, search):
+    return find_matching_train(search.question, search.train_type)
+
+
+ENGINES = [("sql", search_sql), ("request", search_request), ("index", search_index), ("cached", search_cached)]
+
+
+def normalize(suitable_trains):
+    """
+    :return: list of (train no, departure, arrival) to compare the engines
+    """
+    return [(t.train.train_no, dep.departure_time.strftime("%Y-%m-%d %H:%M"),
+             dest.arrival_time.strftime("%Y-%m-%d %H:%M")) for t, dep, dest in suitable_trains]
+
+
+def load_dates(session, dates=DATES):
+    for train_type, service_date in dates.items():
+        status_class = BUILDING_STATUS_CLASSES[train_type]
+        if session.query(status_class).filter_by(assigned_date=service_date).count() == 0:
+            print("Loading {0} {1}".format(train_type, service_date))
+            load_example_timetable_to_database(session, service_date, train_type)
+
+
+def prepare(session, engine_name, dates=DATES):
+    timetable_index.clear()
+    search_cache.clear()
+    if engine_name in ("index", "cached"):
+        for train_type, service_date in dates.items():
+            timetable_index.load(session, train_type, service_date)
+
+
+def measure_peak_memory(session, name, search, searches, dates=DATES):
+    """
+    :return: peak bytes allocated while preparing the engine and answering every search once,
+             traced apart from the timed rounds since tracing slows every allocation down
+    """
+    tracemalloc.start()
+    try:
+        prepare(session, name, dates)
+        for s in searches:
+            search(session, s)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_engine(app, session_factory, name, search, searches, rounds, dates=DATES):
+    """
+    :return: (report, list of the normalized results of every round)
+    """
+    session = app.session = session_factory()
+    latencies = list()
+    statements = 0
+    trains_found = 0
+    results = [list() for _ in range(rounds)]
+    try:
+        peak = measure_peak_memory(session, name, search, searches, dates)
+        session.expunge_all()
+        prepare(session, name, dates)
+        for i in range(rounds):
+            for s in searches:
+                with count_queries() as stats:
+                    started = time.perf_counter()
+                    trains = search(session, s)
+                    latencies.append(time.perf_counter() - started)
+                statements += stats.count
+                trains_found += len(trains)
+                results[i].append(normalize(trains))
+    finally:
+        session.close()
+    latencies.sort()
+    report = {
+        "searches": len(latencies),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "statements_per_search": round(statements / len(latencies), 3),
+        "trains_per_search": round(trains_found / len(latencies), 3),
+        "peak_memory_mb": round(peak / MEGABYTE, 3),
+    }
+    for p in PERCENTILES:
+        report["p{0}_ms".format(p)] = round(percentile(latencies, p) * 1000, 3)
+    return report, results
+
+
+def compare(searches, reference, results, round_index=0):
+    """
+    :return: list of the searches whose trains differ from the reference
+    """
+    differences = list()
+    for s, expected, actual in zip(searches, reference, results):
+        if expected != actual:
+            differences.append({"round": round_index, "train_type": s.train_type,
+                                "departure_station": s.question.departure_station,
+                                "destination_station": s.question.destination_station,
+                                "departure_time": s.question.departure_time.isoformat(),
+                                "missing": sorted(set(expected) - set(actual)),
+                                "unexpected": sorted(set(actual) - set(expected))})
+    return differences
+
+
+def run_benchmark(database_uri, rounds=3, engines=None, dates=DATES):
+    """
+    :return: dict of the reports of every engine and the differences from the reference
+    """
+    engine = instrument_engine(create_engine(database_uri))
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    try:
+        load_dates(session, dates)
+    finally:
+        session.close()
+    app = Flask("benchmark_search")
+    searches = build_search_mix(dates)
+    selected = [(name, search) for name, search in ENGINES if engines is None or name in engines]
+    if not selected or selected[0][0] != "sql":
+        selected.insert(0, ENGINES[0])
+    output = {"database": engine.dialect.name, "rounds": rounds,
+              "dates": {k: v.isoformat() for k, v in dates.items()},
+              "engines": dict(), "differences": dict()}
+    reference = None
+    try:
+        with app.app_context():
+            for name, search in selected:
+                report, results = run_engine(app, session_factory, name, search, searches, rounds, dates)
+                output["engines"][name] = report
+                if reference is None:
+                    reference = results[0]
+                differences = list()
+                for round_index, round_results in enumerate(results):
+                    differences.extend(compare(searches, reference, round_results, round_index))
+                output["differences"][name] = differences
+    finally:
+        # The index and the cache hold the timetables of the benchmark database
+        timetable_index.clear()
+        search_cache.clear()
+        engine.dispose()
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency, statements and memory of the train search engines")
+    parser.add_argument("--database", default=os.getenv("BENCHMARK_DATABASE_URI", "sqlite:///benchmark.sqlite3"),
+                        help="SQLAlchemy URI, the recorded days are loaded when missing")
+    parser.add_argument("--rounds", type=int, default=3, help="Times every search is run")
+    parser.add_argument("--engines", nargs="*", default=None, choices=[name for name, _ in ENGINES])
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    output = run_benchmark(args.database, args.rounds, args.engines)
+    print("{0:<8} {1:>9} {2:>9} {3:>9} {4:>9} {5:>11} {6:>10}".format(
+        "engine", "p50 ms", "p95 ms", "p99 ms", "mean ms", "statements", "peak MB"))
+    for name, report in output["engines"].items():
+        print("{0:<8} {1:>9.3f} {2:>9.3f} {3:>9.3f} {4:>9.3f} {5:>11.2f} {6:>10.2f}".format(
+            name, report["p50_ms"], report["p95_ms"], report["p99_ms"], report["mean_ms"],
+            report["statements_per_search"], report["peak_memory_mb"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, ensure_ascii=False)
+    failed = False
+    for name, differences in output["differences"].items():
+        for difference in differences:
+            failed = True
+            print("{0} differs from sql: {1}".format(name, json.dumps(difference, ensure_ascii=False)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
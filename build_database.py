@@ -1,19 +1,24 @@
+import os
 import traceback
 import sys
+import hashlib
 from utils import request_MOTC, convert_date_to_string
-from datetime import datetime, date, timedelta
+from datetime import datetime, date
 from sqlalchemy.orm.exc import NoResultFound
 
 from models import (
-    TRA_Train, TRA_TrainTimeTable, TRA_TableEntry, TRA_BuildingStatusOnDate,
-    THSR_Train, THSR_TrainTimeTable, THSR_TableEntry, THSR_BuildingStatusOnDate
+    TRA_Train, TRA_TrainTimeTable, TRA_TimetablePattern, TRA_TableEntry, TRA_BuildingStatusOnDate,
+    TRA_TripPair, THSR_Train, THSR_TrainTimeTable, THSR_TimetablePattern, THSR_TableEntry,
+    THSR_BuildingStatusOnDate, THSR_TripPair
 )
 from data import (
-    TRA_STATION_CODE2NAME, TRA_TRAINTYPE_CODE2NAME, THSR_STATION_CODE2NAME
+    TRA_STATION_CODE2NAME, TRA_TRAINTYPE_CODE2NAME, THSR_STATION_CODE2NAME, TRA_TRIP_PAIR_STATIONS
 )
 
 URL_FOR_ALL_TRA_TRAIN_NO_AND_TIMETABLE = "http://ptx.transportdata.tw/MOTC/v2/Rail/TRA/DailyTimetable/TrainDate/{0}"
 URL_FOR_ALL_THSR_TRAIN_NO_AND_TIMETABLE = "http://ptx.transportdata.tw/MOTC/v2/Rail/THSR/DailyTimetable/TrainDate/{0}"
+# Precompute TRA trips between TRA_TRIP_PAIR_STATIONS, THSR trips are always precomputed
+BUILD_TRA_TRIP_PAIRS = os.getenv("BUILD_TRA_TRIP_PAIRS", "True") == "True"
 
 
 class ResponseMessage(object):
@@ -66,12 +71,18 @@ def convert_TRA_station_code2name(station_code):
     return TRA_STATION_CODE2NAME.get(station_code, None)
 
 
-def remove_TRA_timetable_by_date(date_input, session):
+def remove_TRA_timetable_by_date(date_input, session, remove_patterns=True):
+    """
+    :param remove_patterns: also remove the patterns which no longer run on any date,
+                            a rebuild does it after the date is built again instead
+    """
     q = session.query(TRA_TrainTimeTable).filter_by(date=date_input).all()
     if not q:
         return True
     for table in q:
         session.delete(table)
+    if remove_patterns:
+        remove_unused_patterns(TRA_TimetablePattern, session)
     update_TRA_building_status(date_input, 3, session)
 
 
@@ -99,10 +110,79 @@ def update_TRA_building_status(date_input, status, session):
         create_TRA_building_status_by_date(date_input, status, session)
         return True
     status_object.status = status
+    # Recorded again by record_finished_build once the date is built
+    if status != 2:
+        status_object.trip_pairs = False
     status_object.update_date = datetime.now().date()
     session.commit()
 
 
+def minute_of_service_date(time_input, day_offset):
+    return day_offset * 24 * 60 + time_input.hour * 60 + time_input.minute
+
+
+def hash_stops(stops):
+    """
+    :param stops: list of (station_name, arrival minute, departure minute)
+    """
+    return hashlib.sha1(repr(stops).encode("utf-8")).hexdigest()
+
+
+def get_or_create_pattern(train, stops, pattern_class, table_entry_class, session):
+    """
+    Reuse the pattern of the train with the same stops, otherwise create it with its entries
+    :return: (pattern, True if the pattern is created)
+    """
+    stop_hash = hash_stops(stops)
+    if train.id is not None:
+        pattern = session.query(pattern_class).filter_by(train_id=train.id, stop_hash=stop_hash).first()
+        if pattern is not None:
+            return pattern, False
+    pattern = pattern_class(stop_hash)
+    pattern.train = train
+    for station_name, arrival_minute, departure_minute in stops:
+        pattern.entries.append(table_entry_class(station_name, arrival_minute, departure_minute))
+    return pattern, True
+
+
+def record_finished_build(date_input, timetable_class, pattern_class, status_class, session):
+    """
+    Record on the building status of the date whether every pattern running on it has its trip pairs
+    and count the build, so that an index or search result taken while the date was being built is
+    not used after it
+    """
+    missing = session.query(timetable_class.id) \
+        .join(pattern_class, timetable_class.pattern_id == pattern_class.id) \
+        .filter(timetable_class.date == date_input) \
+        .filter(pattern_class.trip_pairs_built.isnot(True)) \
+        .first()
+    session.query(status_class).filter_by(assigned_date=date_input) \
+        .update({"trip_pairs": missing is None, "build": status_class.build + 1}, synchronize_session="evaluate")
+
+
+def remove_unused_patterns(pattern_class, session):
+    """
+    Remove the patterns which no longer run on any date together with their entries and trip pairs
+    """
+    session.flush()
+    for pattern in session.query(pattern_class).filter(~pattern_class.timetables.any()):
+        session.delete(pattern)
+
+
+def create_trip_pairs(pattern, trip_pair_class, stations=None):
+    """
+    Emit every ordered pair of stops of the pattern, or only the pairs between stations if given
+    """
+    pattern.trip_pairs_built = True
+    entries = [e for e in pattern.entries if stations is None or e.station_name in stations]
+    for i, dep_entry in enumerate(entries):
+        for dest_entry in entries[i + 1:]:
+            if dest_entry.arrival_minute <= dep_entry.departure_minute:
+                continue
+            pattern.trip_pairs.append(trip_pair_class(dep_entry.station_name, dest_entry.station_name,
+                                                      dep_entry.departure_minute, dest_entry.arrival_minute))
+
+
 def build_TRA_traintimetable(table_input, session, date_input):
     """
     table_input form:
@@ -129,10 +209,8 @@ def build_TRA_traintimetable(table_input, session, date_input):
         session.add(train)
     # Update TRA_BuildingStatusOnDate for the date with status building
     update_TRA_building_status(date_input, 1, session)
-    # Create TRA_TrainTimeTable
-    timetable = TRA_TrainTimeTable(date_input)
-    timetable.train = train
-    # Create a list of TimeTableEntry
+    # Create a list of stops, times are minutes since the start of date_input
+    stops = list()
     cross_day = False
     previous_departure_time = None
     for entry in table_input["StopTimes"]:
@@ -145,25 +223,28 @@ def build_TRA_traintimetable(table_input, session, date_input):
         departure_time = datetime.strptime(entry["DepartureTime"], "%H:%M").time()
 
         if cross_day:
-            arrival_date = date_input + timedelta(1)
-            departure_date = date_input + timedelta(1)
+            arrival_day = departure_day = 1
         elif departure_time < arrival_time:
             cross_day = True
-            arrival_date = date_input
-            departure_date = date_input + timedelta(1)
+            arrival_day = 0
+            departure_day = 1
         elif previous_departure_time and arrival_time < previous_departure_time:
             cross_day = True
-            arrival_date = departure_date = date_input + timedelta(1)
+            arrival_day = departure_day = 1
         else:
-            arrival_date = departure_date = date_input
-
-        table_entry = TRA_TableEntry(
-            station_name=station_name,
-            arrival_time=datetime.combine(arrival_date, arrival_time),
-            departure_time=datetime.combine(departure_date, departure_time)
-        )
-        timetable.entries.append(table_entry)
+            arrival_day = departure_day = 0
+
+        stops.append((station_name, minute_of_service_date(arrival_time, arrival_day),
+                      minute_of_service_date(departure_time, departure_day)))
         previous_departure_time = departure_time
+    # Dates with the same stops share one pattern
+    pattern, created = get_or_create_pattern(train, stops, TRA_TimetablePattern, TRA_TableEntry, session)
+    # A pattern reused from a build without trip pairs gets them now
+    if BUILD_TRA_TRIP_PAIRS and not pattern.trip_pairs_built:
+        create_trip_pairs(pattern, TRA_TripPair, TRA_TRIP_PAIR_STATIONS)
+    # Create TRA_TrainTimeTable
+    timetable = TRA_TrainTimeTable(date_input, pattern)
+    timetable.train = train
     session.add(timetable)
     update_TRA_building_status(date_input, 2, session)
 
@@ -197,9 +278,11 @@ def build_TRA_database_by_date(date_input, session, build_anyway=False):
         else:
             all_trains = response
         # Remove the older data and build the database
-        remove_TRA_timetable_by_date(date_input, session)
+        remove_TRA_timetable_by_date(date_input, session, remove_patterns=False)
         for tb in all_trains:
             build_TRA_traintimetable(tb, session, date_input)
+        record_finished_build(date_input, TRA_TrainTimeTable, TRA_TimetablePattern, TRA_BuildingStatusOnDate, session)
+        remove_unused_patterns(TRA_TimetablePattern, session)
         session.commit()
         return ResponseMessage(0)
     except Exception as e:
@@ -235,16 +318,21 @@ def update_THSR_building_status(date_input, status, session):
         create_THSR_building_status_by_date(date_input, status, session)
         return True
     status_object.status = status
+    # Recorded again by record_finished_build once the date is built
+    if status != 2:
+        status_object.trip_pairs = False
     status_object.update_date = datetime.now().date()
     session.commit()
 
 
-def remove_THSR_timetable_by_date(date_input, session):
+def remove_THSR_timetable_by_date(date_input, session, remove_patterns=True):
     q = session.query(THSR_TrainTimeTable).filter_by(date=date_input).all()
     if not q:
         return True
     for table in q:
         session.delete(table)
+    if remove_patterns:
+        remove_unused_patterns(THSR_TimetablePattern, session)
     update_THSR_building_status(date_input, 3, session)
 
 
@@ -305,11 +393,8 @@ def build_THSR_traintimetable(table_input, session, date_input):
         session.add(train)
     # Update THSR_BuildingStatusOnDate for the date with status building
     update_THSR_building_status(date_input, 1, session)
-    # Create THSR_TrainTimeTable
-    timetable = THSR_TrainTimeTable(date_input)
-    timetable.train = train
-
-    # Create a list of TimeTableEntry
+    # Create a list of stops, times are minutes since the start of date_input
+    stops = list()
     cross_day = False
     previous_departure_time = None
     for entry in table_input["StopTimes"]:
@@ -325,24 +410,27 @@ def build_THSR_traintimetable(table_input, session, date_input):
             arrival_time = departure_time
 
         if cross_day:
-            arrival_date = departure_date = date_input + timedelta(1)
+            arrival_day = departure_day = 1
         elif departure_time < arrival_time:
             cross_day = True
-            arrival_date = date_input
-            departure_date = date_input + timedelta(1)
+            arrival_day = 0
+            departure_day = 1
         elif previous_departure_time and arrival_time < previous_departure_time:
             cross_day = True
-            arrival_date = departure_date = date_input + timedelta(1)
+            arrival_day = departure_day = 1
         else:
-            arrival_date = departure_date = date_input
-
-        table_entry = THSR_TableEntry(
-            station_name=station_name,
-            arrival_time=datetime.combine(arrival_date, arrival_time),
-            departure_time=datetime.combine(departure_date, departure_time)
-        )
-        timetable.entries.append(table_entry)
+            arrival_day = departure_day = 0
+
+        stops.append((station_name, minute_of_service_date(arrival_time, arrival_day),
+                      minute_of_service_date(departure_time, departure_day)))
         previous_departure_time = departure_time
+    # Dates with the same stops share one pattern
+    pattern, created = get_or_create_pattern(train, stops, THSR_TimetablePattern, THSR_TableEntry, session)
+    if not pattern.trip_pairs_built:
+        create_trip_pairs(pattern, THSR_TripPair)
+    # Create THSR_TrainTimeTable
+    timetable = THSR_TrainTimeTable(date_input, pattern)
+    timetable.train = train
     session.add(timetable)
     update_THSR_building_status(date_input, 2, session)
 
@@ -364,9 +452,12 @@ def build_THSR_database_by_date(date_input, session, build_anyway=False):
         if isinstance(response, ResponseMessage):
             return response
         # Remove the older data and build the database
-        remove_THSR_timetable_by_date(date_input, session)
+        remove_THSR_timetable_by_date(date_input, session, remove_patterns=False)
         for train in response:
             build_THSR_traintimetable(train, session, date_input)
+        record_finished_build(date_input, THSR_TrainTimeTable, THSR_TimetablePattern, THSR_BuildingStatusOnDate,
+                          session)
+        remove_unused_patterns(THSR_TimetablePattern, session)
         session.commit()
         return ResponseMessage(0)
     except:
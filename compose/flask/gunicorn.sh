@@ -1,2 +1,6 @@
 #!/bin/sh
+# Files of the workers of the previous run, see metrics.py
+if [ -n "$METRICS_DIR" ]; then
+    rm -rf "$METRICS_DIR" && mkdir -p "$METRICS_DIR"
+fi
 /usr/local/bin/gunicorn -w $(( 2 * `cat /proc/cpuinfo | grep 'core id' | wc -l` + 1 )) -b 0.0.0.0:5000 --worker-class=eventlet --chdir=/app wsgi:application
@@ -1,6 +1,8 @@
 """
 TRA_TRAINTYPE_CODE2NAME
 TRA_STATION_CODE2NAME
+THSR_STATION_CODE2NAME
+TRA_TRIP_PAIR_STATIONS
 """
 
 TRA_TRAINTYPE_CODE2NAME = {
@@ -259,3 +261,11 @@ THSR_STATION_CODE2NAME = {
     '1070': '左營',
     '1035': '苗栗'
 } 
+
+# Major TRA stations, only trips between them are precomputed in TRA_TripPair
+TRA_TRIP_PAIR_STATIONS = frozenset([
+    "基隆", "七堵", "瑞芳", "南港", "松山", "臺北", "萬華", "板橋", "樹林", "桃園", "中壢", "新竹",
+    "竹南", "苗栗", "通霄", "大甲", "清水", "沙鹿", "豐原", "臺中", "彰化", "員林", "二水", "斗六",
+    "嘉義", "新營", "臺南", "新左營", "高雄", "屏東", "潮州", "宜蘭", "羅東", "蘇澳新", "花蓮", "玉里",
+    "池上", "臺東",
+])
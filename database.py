@@ -0,0 +1,227 @@
+"""
+Engine and sessions of the web app.
+
+Every thread, or every greenlet under gunicorn's eventlet worker, gets its own session from the
+scoped Session, so webhooks handled side by side never share one. Under eventlet psycopg2 is made
+to wait for the database through the eventlet hub, so a greenlet waiting for a query lets the
+others run.
+The statements of the engine are counted and timed per thread, see query_stats, and the same
+statement run again and again, e.g. a query inside a loop, is reported by warn_repeated_queries.
+"""
+import os
+import re
+import sys
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import extensions
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+# Connections kept open, and opened on top of them under load
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+# Seconds a greenlet waits for a free connection
+POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 10))
+# Seconds after which a connection is replaced, before postgres or a proxy drops it
+POOL_RECYCLE = 1800
+# Seconds to wait for the database to accept connections at startup
+WAIT_DEADLINE = int(os.getenv("DB_WAIT_SECONDS", 60))
+WAIT_FIRST_DELAY = 0.05
+WAIT_MAX_DELAY = 2
+# Runs of one statement shape within an event or a build reported as a query inside a loop
+REPEATED_QUERY_THRESHOLD = int(os.getenv("REPEATED_QUERY_THRESHOLD", 10))
+
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LIST_PATTERN = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+PARAMETER_PATTERN = re.compile(r"%\(\w+\)s|%s")
+SAVEPOINT_PATTERN = re.compile(r"\bsa_savepoint_\d+\b")
+
+
+def eventlet_wait_callback(conn, timeout=-1):
+    from eventlet.hubs import trampoline
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            trampoline(conn.fileno(), read=True)
+        elif state == extensions.POLL_WRITE:
+            trampoline(conn.fileno(), write=True)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+
+def is_eventlet_patched():
+    # eventlet is only imported if the worker already uses it
+    if "eventlet" not in sys.modules:
+        return False
+    from eventlet import patcher
+    return patcher.is_monkey_patched("socket")
+
+
+def make_psycopg2_green():
+    """
+    :return: True if psycopg2 now yields to eventlet while waiting
+    """
+    if not is_eventlet_patched():
+        return False
+    extensions.set_wait_callback(eventlet_wait_callback)
+    return True
+
+
+def statement_shape(statement):
+    """
+    :return: statement with its parameters and literals replaced by "?", and whitespace collapsed
+    """
+    shape = PARAMETER_PATTERN.sub("?", statement)
+    shape = LITERAL_PATTERN.sub("?", shape)
+    shape = IN_LIST_PATTERN.sub("(?)", shape)
+    shape = SAVEPOINT_PATTERN.sub("sa_savepoint_?", shape)
+    return " ".join(shape.split())
+
+
+class QueryStats(object):
+    __slots__ = ("count", "seconds", "shapes")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # statement shape -> number of runs
+        self.shapes = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=REPEATED_QUERY_THRESHOLD):
+        """
+        :return: list of (shape, runs) run at least threshold times, most runs first
+        """
+        return [(shape, runs) for shape, runs in self.shapes.most_common() if runs >= threshold]
+
+
+_query_stats = threading.local()
+
+
+def _stats_stack():
+    # The first QueryStats is the one of query_stats, the others are of count_queries blocks
+    stack = getattr(_query_stats, "stack", None)
+    if stack is None:
+        stack = _query_stats.stack = [QueryStats()]
+    return stack
+
+
+def query_stats():
+    """
+    :return: QueryStats of the statements run by this thread since reset_query_stats
+    """
+    return _stats_stack()[0]
+
+
+def reset_query_stats():
+    stack = _stats_stack()
+    stack[0] = QueryStats()
+    return stack[0]
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the statements run by this thread inside the with block, e.g.
+
+        with count_queries() as stats:
+            build_TRA_database_by_date(date, session)
+        warn_repeated_queries(stats, "TRA {0}".format(date))
+    """
+    stats = QueryStats()
+    stack = _stats_stack()
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.remove(stats)
+
+
+def warn_repeated_queries(stats, context, threshold=REPEATED_QUERY_THRESHOLD):
+    """
+    Print the statement shapes run at least threshold times
+    :return: list of (shape, runs) printed
+    """
+    repeated = stats.repeated(threshold)
+    for shape, runs in repeated:
+        print("Repeated statement in {0}, run {1} times: {2}".format(context, runs, shape[:300]))
+    return repeated
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    seconds = time.time() - started
+    for stats in _stats_stack():
+        stats.record(statement, seconds)
+
+
+def instrument_engine(engine):
+    """
+    Count and time the statements of engine, an engine is only instrumented once
+    """
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    return engine
+
+
+def pool_arguments(uri):
+    """
+    Sizes of the pool, only a QueuePool takes them, e.g. sqlite files use a NullPool
+    """
+    url = make_url(uri)
+    if not issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        return {}
+    return {"pool_size": POOL_SIZE, "max_overflow": MAX_OVERFLOW, "pool_timeout": POOL_TIMEOUT}
+
+
+def create_database_engine(uri):
+    make_psycopg2_green()
+    engine = create_engine(uri, pool_recycle=POOL_RECYCLE, pool_pre_ping=True, **pool_arguments(uri))
+    return instrument_engine(engine)
+
+
+def wait_for_database(engine, deadline=WAIT_DEADLINE, first_delay=WAIT_FIRST_DELAY, max_delay=WAIT_MAX_DELAY):
+    """
+    Wait until the database accepts connections, retrying with exponential backoff
+    :return: True as soon as it does, False if it still does not after deadline seconds
+    """
+    give_up_at = time.time() + deadline
+    delay = first_delay
+    while True:
+        try:
+            with engine.connect() as connection:
+                connection.execute("SELECT 1")
+            return True
+        except DBAPIError as e:
+            remaining = give_up_at - time.time()
+            if remaining <= 0:
+                print("Database is not reachable after {0}s: {1}".format(deadline, e.orig))
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+
+def create_session_factories(engine=None):
+    """
+    :param engine: bound later with session_factory.configure(bind=engine) if None
+    :return: (sessionmaker for background threads, scoped Session for requests)
+    """
+    session_factory = sessionmaker(bind=engine)
+    return session_factory, scoped_session(session_factory)
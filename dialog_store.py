@@ -0,0 +1,374 @@
+"""
+Store of the dialog states of the users.
+
+The state of an ongoing dialog is kept keyed by (user, group) for DIALOG_STATE_TTL after its last
+step, so answering a step does not read the database. The "sqlite" backend keeps them in a local
+file shared by every gunicorn worker. The "memory" backend keeps them in the process, so it only fits
+a single worker, the next step of a dialog may reach another worker otherwise.
+A source found without a dialog in the database is kept as an empty entry for DIALOG_STATE_TTL too,
+so the messages of users and groups not searching do not read the database either. Starting a dialog
+replaces it.
+Every change is also written to TRA_QuestionState / THSR_QuestionState for analytics. The writes
+are queued and done by a background thread unless the store is in sync mode, where they are done
+right away in the session of the request (used by the tests).
+"""
+import sys
+import json
+import uuid
+import queue
+import sqlite3
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from models import TRA_QuestionState, THSR_QuestionState
+
+DIALOG_STATE_TTL = timedelta(hours=6)
+DEFAULT_SQLITE_PATH = "/tmp/dialog_state.sqlite3"
+# Maximum number of queued writes committed together
+WRITE_BATCH_SIZE = 100
+# Number of rows deleted by every statement of delete_expired_rows
+SWEEP_BATCH_SIZE = 1000
+# Expired states of the backends are dropped at most this often
+PURGE_INTERVAL = timedelta(minutes=10)
+
+QUESTION_STATE_CLASSES = {"TRA": TRA_QuestionState, "THSR": THSR_QuestionState}
+STATE_FIELDS = ("train_type", "token", "group", "user", "departure_station", "destination_station",
+                "departure_time", "search_result", "result_cursor", "update")
+DATETIME_FIELDS = ("departure_time", "update")
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# Entry of a source known to have no ongoing dialog
+NO_DIALOG = {}
+
+
+class DialogState(object):
+    """
+    Detached copy of a QuestionState, changing it does not change the store until it is saved
+    """
+    __slots__ = STATE_FIELDS
+
+    def __init__(self, train_type, group, user, token=None, departure_station="", destination_station="",
+                 departure_time=None, search_result=None, result_cursor=None, update=None):
+        self.train_type = train_type
+        self.token = token or uuid.uuid4().hex
+        self.group = group
+        self.user = user
+        self.departure_station = departure_station
+        self.destination_station = destination_station
+        self.departure_time = departure_time
+        self.search_result = search_result
+        self.result_cursor = result_cursor
+        self.update = update or datetime.now()
+
+    @classmethod
+    def from_row(cls, train_type, row):
+        return cls(train_type, row.group, row.user, row.token, row.departure_station, row.destination_station,
+                   row.departure_time, row.search_result, row.result_cursor, row.update)
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in STATE_FIELDS}
+        for field in DATETIME_FIELDS:
+            if data[field] is not None:
+                data[field] = data[field].strftime(DATETIME_FORMAT)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        for field in DATETIME_FIELDS:
+            if data[field] is not None:
+                data[field] = datetime.strptime(data[field], DATETIME_FORMAT)
+        return cls(**data)
+
+
+class MemoryBackend(object):
+    """
+    States of this process only, fits a single worker
+    """
+    def __init__(self):
+        # user -> group -> (expiry, state as dict)
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def get(self, user, group, now):
+        with self._lock:
+            entry = self._entries.get(user, {}).get(group)
+        if entry is None or entry[0] <= now:
+            return None
+        return entry[1]
+
+    def put(self, user, group, expiry, data):
+        with self._lock:
+            self._entries.setdefault(user, dict())[group] = (expiry, data)
+
+    def delete_user(self, user):
+        with self._lock:
+            self._entries.pop(user, None)
+
+    def purge_expired(self, now):
+        """
+        :return: number of states removed
+        """
+        removed = 0
+        with self._lock:
+            for user in list(self._entries):
+                groups = self._entries[user]
+                for group in [g for g, entry in groups.items() if entry[0] <= now]:
+                    del groups[group]
+                    removed += 1
+                if not groups:
+                    del self._entries[user]
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteBackend(object):
+    """
+    States kept in a sqlite file, every process on the host sees the same states
+    """
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        # The file is opened by the first call of every thread, not on import
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS dialog_state ("
+                             "user TEXT NOT NULL, grp TEXT NOT NULL, expiry REAL NOT NULL, data TEXT NOT NULL, "
+                             "PRIMARY KEY (user, grp))")
+        return conn
+
+    def get(self, user, group, now):
+        row = self.connection().execute("SELECT data FROM dialog_state WHERE user = ? AND grp = ? AND expiry > ?",
+                                        (user, group or "", now.timestamp())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, user, group, expiry, data):
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO dialog_state (user, grp, expiry, data) VALUES (?, ?, ?, ?)",
+                         (user, group or "", expiry.timestamp(), json.dumps(data)))
+
+    def delete_user(self, user):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM dialog_state WHERE user = ?", (user,))
+
+    def purge_expired(self, now):
+        with self.connection() as conn:
+            return conn.execute("DELETE FROM dialog_state WHERE expiry <= ?", (now.timestamp(),)).rowcount
+
+    def clear(self):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM dialog_state")
+
+
+def write_state(session, state):
+    """
+    Copy a DialogState to its QuestionState row, a row changed by a later step is kept
+    """
+    question_state_class = QUESTION_STATE_CLASSES[state.train_type]
+    row = session.query(question_state_class).filter_by(token=state.token).first()
+    if row is None:
+        row = question_state_class(group=state.group, user=state.user)
+        row.token = state.token
+        session.add(row)
+    elif row.update is not None and row.update > state.update:
+        return
+    for field in ("departure_station", "destination_station", "departure_time", "search_result",
+                  "result_cursor", "update"):
+        setattr(row, field, getattr(state, field))
+
+
+def expire_user_rows(session, user):
+    for question_state_class in QUESTION_STATE_CLASSES.values():
+        session.query(question_state_class).filter_by(expired=False).filter_by(user=user) \
+            .update({"expired": True}, synchronize_session="evaluate")
+
+
+def expire_stale_rows(session, cutoff):
+    """
+    Expire the question states of dialogs abandoned before cutoff, with one UPDATE per table
+    :return: number of rows expired
+    """
+    count = 0
+    for question_state_class in QUESTION_STATE_CLASSES.values():
+        count += session.query(question_state_class) \
+            .filter(question_state_class.expired.is_(False), question_state_class.update < cutoff) \
+            .update({"expired": True}, synchronize_session=False)
+    session.commit()
+    return count
+
+
+def delete_expired_rows(session, cutoff, batch_size=SWEEP_BATCH_SIZE):
+    """
+    Delete expired question states last changed before cutoff, committing every batch_size rows so
+    that the tables are never locked for long
+    :return: number of rows deleted
+    """
+    count = 0
+    for question_state_class in QUESTION_STATE_CLASSES.values():
+        while True:
+            batch = session.query(question_state_class.id) \
+                .filter(question_state_class.expired.is_(True), question_state_class.update < cutoff) \
+                .limit(batch_size).subquery()
+            deleted = session.query(question_state_class) \
+                .filter(question_state_class.id.in_(batch)) \
+                .delete(synchronize_session=False)
+            session.commit()
+            count += deleted
+            if deleted < batch_size:
+                break
+    return count
+
+
+class DialogStateWriter(object):
+    """
+    Writes queued changes of the states to the database in a background thread
+    """
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, operation):
+        """
+        :param operation: ("state", DialogState) or ("expire", user)
+        """
+        self._queue.put(operation)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def write(self, batch):
+        # Only the latest change of every state is written, in the order the states were first changed
+        latest = OrderedDict()
+        for index, (kind, value) in enumerate(batch):
+            key = ("state", value.token) if kind == "state" else ("expire", index)
+            latest[key] = (kind, value)
+        session = self.session_factory()
+        try:
+            for kind, value in latest.values():
+                if kind == "expire":
+                    expire_user_rows(session, value)
+                else:
+                    write_state(session, value)
+            session.commit()
+        except Exception:
+            session.rollback()
+            traceback.print_exc(file=sys.stdout)
+        finally:
+            session.close()
+
+    def join(self):
+        """
+        Wait until every queued change is written
+        """
+        self._queue.join()
+
+
+class DialogStore(object):
+    def __init__(self, backend, writer=None, ttl=DIALOG_STATE_TTL, sync=False):
+        """
+        :param writer: DialogStateWriter, required unless sync is True
+        """
+        self.backend = backend
+        self.writer = writer
+        self.ttl = ttl
+        self.sync = sync
+        self.last_purge = datetime.now()
+
+    def get(self, user, group):
+        data = self.backend.get(user, group, datetime.now())
+        return DialogState.from_dict(data) if data else None
+
+    def get_or_load(self, user, group, load):
+        """
+        :param load: called when the store does not know the source, returns the DialogState of the
+                     database or None
+        :return: DialogState, None if the source has no ongoing dialog
+        """
+        now = datetime.now()
+        data = self.backend.get(user, group, now)
+        if data is not None:
+            return DialogState.from_dict(data) if data else None
+        state = load()
+        if state is None:
+            self.backend.put(user, group, now + self.ttl, NO_DIALOG)
+        else:
+            self.backend.put(user, group, state.update + self.ttl, state.to_dict())
+        return state
+
+    def put(self, state, session=None):
+        """
+        :param session: session of the request, used in sync mode
+        """
+        self.backend.put(state.user, state.group, state.update + self.ttl, state.to_dict())
+        self.persist(("state", DialogState.from_dict(state.to_dict())), session)
+        if datetime.now() - self.last_purge > PURGE_INTERVAL:
+            self.purge_expired()
+
+    def start(self, train_type, user, group, session=None):
+        """
+        Begin a new dialog, every other dialog of the user ends
+        """
+        self.expire_user(user, session)
+        state = DialogState(train_type, group, user)
+        self.put(state, session)
+        return state
+
+    def expire_user(self, user, session=None):
+        self.backend.delete_user(user)
+        self.persist(("expire", user), session)
+
+    def persist(self, operation, session):
+        if self.sync:
+            kind, value = operation
+            if kind == "expire":
+                expire_user_rows(session, value)
+            else:
+                write_state(session, value)
+        else:
+            self.writer.submit(operation)
+
+    def purge_expired(self):
+        self.last_purge = datetime.now()
+        return self.backend.purge_expired(self.last_purge)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_dialog_store(session_factory, backend="sqlite", path=DEFAULT_SQLITE_PATH, sync=False):
+    """
+    :param backend: "sqlite" or "memory"
+    :param sync: write the question state tables in the session of the request
+    """
+    if backend == "sqlite":
+        store_backend = SqliteBackend(path)
+    elif backend == "memory":
+        store_backend = MemoryBackend()
+    else:
+        raise ValueError("Unknown dialog store backend {0}".format(backend))
+    return DialogStore(store_backend, DialogStateWriter(session_factory), sync=sync)
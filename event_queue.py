@@ -0,0 +1,99 @@
+"""
+Queue of webhook events handled by background workers.
+
+The webhook only verifies and parses a delivery, puts its events here and answers LINE at once.
+The events of a delivery are grouped by source (user, group or room) and every source is always
+handled by the same worker, so the events of one user are handled together in the order they
+arrived while different users are handled side by side.
+The number of queued events is bounded, a delivery which does not fit is refused as a whole.
+"""
+import time
+import zlib
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import histogram, gauge, counter
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_DEPTH = 1000
+
+QUEUE_LATENCY = histogram("webhook_queue_seconds", "Time from receiving an event to the start of its handling")
+HANDLING_TIME = histogram("webhook_handling_seconds", "Time spent handling an event")
+QUEUE_DEPTH = gauge("webhook_queue_depth", "Events waiting or being handled")
+REJECTED_EVENTS = counter("webhook_rejected_events_total", "Events refused because the queue was full")
+
+
+def source_key(event):
+    source = event.source
+    return getattr(source, "user_id", None) or getattr(source, "group_id", None) or \
+        getattr(source, "room_id", None) or ""
+
+
+class EventQueue(object):
+    def __init__(self, handle, workers=DEFAULT_WORKERS, max_depth=DEFAULT_MAX_DEPTH, logger=None):
+        """
+        :param handle: called in a worker with the list of events of one source in a delivery
+        :param logger: logs the failures of handle, e.g. the logger of the app
+        """
+        self.handle = handle
+        self.logger = logger or logging.getLogger(__name__)
+        self.workers = workers
+        self.max_depth = max_depth
+        self.depth = 0
+        self._shards = [queue.Queue() for _ in range(workers)]
+        self._threads = list()
+        self._lock = threading.Lock()
+
+    def shard_of(self, key):
+        return zlib.crc32(key.encode("utf-8")) % self.workers
+
+    def submit(self, events):
+        """
+        :return: False if the events do not fit in the queue, none of them is queued then
+        """
+        with self._lock:
+            if self.depth + len(events) > self.max_depth:
+                REJECTED_EVENTS.inc(len(events))
+                return False
+            self.depth += len(events)
+            QUEUE_DEPTH.set(self.depth)
+            if not self._threads:
+                self.start()
+        received = time.time()
+        sources = OrderedDict()
+        for event in events:
+            sources.setdefault(source_key(event), list()).append(event)
+        for key, source_events in sources.items():
+            self._shards[self.shard_of(key)].put((received, source_events))
+        return True
+
+    def start(self):
+        for shard in self._shards:
+            thread = threading.Thread(target=self.run, args=(shard,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self, shard):
+        while True:
+            received, events = shard.get()
+            started = time.time()
+            QUEUE_LATENCY.observe(started - received)
+            try:
+                self.handle(events)
+            except Exception:
+                self.logger.exception("Handling {0} events of a source failed.".format(len(events)))
+            finally:
+                HANDLING_TIME.observe(time.time() - started)
+                with self._lock:
+                    self.depth -= len(events)
+                    QUEUE_DEPTH.set(self.depth)
+                shard.task_done()
+
+    def join(self):
+        """
+        Wait until every queued event is handled
+        """
+        for shard in self._shards:
+            shard.join()
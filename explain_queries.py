@@ -0,0 +1,116 @@
+"""
+Report the query plans of the statements issued by handlers.py and the nightly rebuild.
+
+    python explain_queries.py --date 2018-06-02 --departure 新竹 --destination 高雄 --time 07:00
+
+Every plan is printed twice. "before" is planned in a transaction where the indexes declared in
+models.py are dropped and rolled back afterwards, "after" uses the current schema.
+Dropping an index locks its table for every other connection until the rollback, so the plans are
+made on TESTING_DATABASE_URI, or on --database, e.g. a copy of production, with --allow-locks.
+"""
+import os
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker
+
+# Load env variables
+dotenv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path=dotenv_path)
+
+from models import (  # noqa
+    Base, User, TRA_QuestionState, TRA_TrainTimeTable, THSR_QuestionState
+)
+from handlers import build_matching_train_query, build_trip_pair_query  # noqa
+from timetable_index import build_day_index_query  # noqa
+
+
+def build_queries(session, args):
+    departure_time = datetime.strptime("{0} {1}".format(args.date, args.time), "%Y-%m-%d %H:%M")
+    tra_qs = TRA_QuestionState(group=None, user=args.user, departure_station=args.departure,
+                               destination_station=args.destination, departure_time=departure_time)
+    thsr_qs = THSR_QuestionState(group=None, user=args.user, departure_station=args.thsr_departure,
+                                 destination_station=args.thsr_destination, departure_time=departure_time)
+    return [
+        ("request_TRA_matching_train", build_matching_train_query(session, tra_qs, "TRA")),
+        ("request_THSR_matching_train", build_matching_train_query(session, thsr_qs, "THSR")),
+        ("TRA trip pairs", build_trip_pair_query(session, tra_qs, "TRA")),
+        ("THSR trip pairs", build_trip_pair_query(session, thsr_qs, "THSR")),
+        ("timetable index of TRA date", build_day_index_query(session, "TRA", departure_time.date())),
+        ("ask_question_states", session.query(TRA_QuestionState).filter_by(expired=False)
+            .filter_by(user=args.user)),
+        ("unfollow_user", session.query(User).filter_by(user_id=args.user).filter_by(following=True)),
+        ("remove_TRA_timetable_by_date", session.query(TRA_TrainTimeTable)
+            .filter_by(date=departure_time.date())),
+    ]
+
+
+def explain(connection, query, analyze=False):
+    compiled = query.statement.compile(dialect=connection.dialect)
+    prefix = "EXPLAIN ANALYZE " if analyze else "EXPLAIN "
+    return "\n".join(row[0] for row in connection.execute(prefix + str(compiled), compiled.params))
+
+
+def explain_without_indexes(connection, queries, analyze=False):
+    transaction = connection.begin()
+    try:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute('DROP INDEX IF EXISTS "{0}"'.format(index.name))
+        return [explain(connection, q, analyze) for _, q in queries]
+    finally:
+        transaction.rollback()
+
+
+def check_target(database, allow_locks):
+    """
+    :return: why the plans may not be made on database, None if they may
+    """
+    if not database:
+        return "Set TESTING_DATABASE_URI or pass --database."
+    if database != os.getenv("TESTING_DATABASE_URI") and not allow_locks:
+        return "Dropping the indexes locks the tables of {0}, pass --allow-locks if it is a scratch " \
+               "database.".format(make_url(database).database)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show query plans before and after the timetable indexes")
+    parser.add_argument("--date", default=datetime.now().strftime("%Y-%m-%d"), help="YYYY-MM-DD")
+    parser.add_argument("--time", default="08:00", help="HH:MM")
+    parser.add_argument("--departure", default="臺北")
+    parser.add_argument("--destination", default="臺中")
+    parser.add_argument("--thsr-departure", default="臺北")
+    parser.add_argument("--thsr-destination", default="左營")
+    parser.add_argument("--user", default="U0000000000000000000000000000000")
+    parser.add_argument("--analyze", action="store_true", help="run EXPLAIN ANALYZE")
+    parser.add_argument("--database", default=os.getenv("TESTING_DATABASE_URI"),
+                        help="database URI, TESTING_DATABASE_URI by default")
+    parser.add_argument("--allow-locks", action="store_true",
+                        help="lock the tables of --database while the plans are made, never on production")
+    args = parser.parse_args()
+    error = check_target(args.database, args.allow_locks)
+    if error:
+        parser.error(error)
+
+    engine = create_engine(args.database)
+    connection = engine.connect()
+    session = sessionmaker()(bind=connection)
+    queries = build_queries(session, args)
+    before = explain_without_indexes(connection, queries, args.analyze)
+    for (name, q), plan in zip(queries, before):
+        print("=" * 20, name, "=" * 20)
+        print("-- before --")
+        print(plan)
+        print("-- after --")
+        print(explain(connection, q, args.analyze))
+        print()
+    session.close()
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import re
-import os
+from timeit import default_timer as timer
 from datetime import datetime, timedelta, time
 from flask import current_app
 from linebot.models import (
@@ -9,15 +9,22 @@ from linebot.models import (
 )
 from linebot.exceptions import LineBotApiError
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 from models import (
-    User, Group, TRA_QuestionState, TRA_TableEntry, TRA_TrainTimeTable,
-    THSR_QuestionState, THSR_TableEntry, THSR_TrainTimeTable
+    User, Group, TRA_QuestionState, TRA_TableEntry, TRA_TrainTimeTable, TRA_TripPair,
+    THSR_QuestionState, THSR_TableEntry, THSR_TrainTimeTable, THSR_TripPair
 )
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from data import TRA_STATION_CODE2NAME, THSR_STATION_CODE2NAME
-from utils import pre_process_text
+from sqlalchemy.orm import aliased, contains_eager
+from data import TRA_TRIP_PAIR_STATIONS
+from station_names import TRA_STATIONS, THSR_STATIONS
+from timetable_index import timetable_index, minutes_since, get_timetable_version, IndexedEntry
+from search_cache import search_cache, compact_trips, expand_trips
+from journey_planner import journey_planner
+from dialog_store import DialogState
+from database import create_database_engine, create_session_factories, reset_query_stats, warn_repeated_queries
+from metrics import histogram, counter
+from request_log import log_failed_event
+from slow_query_log import enable_slow_query_log
 
 INTRO_TEXT = "嗨~ 我是火車時刻機器人🚆\n" \
              "輸入: 大寫或小寫T \n" \
@@ -31,8 +38,30 @@ INTRO_TEXT = "嗨~ 我是火車時刻機器人🚆\n" \
              "- Issue (回報問題)\n" \
              "- Github (歡迎共同開發)"
 
-engine = create_engine(os.environ["DATABASE_URI"])
-Session = sessionmaker(bind=engine)
+# Trains leaving within this period after the requested time are listed
+SEARCH_TIME_RANGE = timedelta(hours=5)
+# Number of trains listed by every "列出更多"
+RESULT_PAGE_SIZE = 20
+# Upper bounds of the histograms of trains found by a search and statements run by an event
+RESULT_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float("inf"))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, float("inf"))
+
+# Session is scoped to the thread or greenlet handling an event, session_factory is for background threads.
+# Both are bound to the engine by init_database, which app.create_app calls
+session_factory, Session = create_session_factories()
+engine = None
+
+
+def init_database(uri):
+    """
+    Create the engine of uri and bind the sessions to it, once per uri
+    """
+    global engine
+    if engine is None or str(engine.url) != uri:
+        engine = create_database_engine(uri)
+        enable_slow_query_log(engine)
+        session_factory.configure(bind=engine)
+    return engine
 
 
 def create_error_text_message(text=""):
@@ -41,10 +70,18 @@ def create_error_text_message(text=""):
     return TextSendMessage(text=text)
 
 
-def request_matching_train(qs, train_type):
+def get_request_date(departure_time):
     """
-    Since the algorithm is same for both TRA and THSR,
-    I believe this function can be an independent function
+    Trains leaving after midnight belong to the timetable of the previous date
+    """
+    if time(0) < departure_time.time() < time(3):
+        return departure_time.date() - timedelta(1)
+    return departure_time.date()
+
+
+def build_matching_train_query(session, qs, train_type, time_range=SEARCH_TIME_RANGE, request_date=None):
+    """
+    One statement joining the departure and the destination stop of the same timetable pattern
     """
     if train_type == "TRA":
         timetableclass = TRA_TrainTimeTable
@@ -52,58 +89,207 @@ def request_matching_train(qs, train_type):
     elif train_type == "THSR":
         timetableclass = THSR_TrainTimeTable
         table_entry_class = THSR_TableEntry
-    if time(0) < qs.departure_time.time() < time(3):
-        request_date = qs.departure_time.date() - timedelta(1)
-    else:
-        request_date = qs.departure_time.date()
-    q = current_app.session.query(timetableclass).filter(timetableclass.date == request_date) \
-        .filter(
-        and_(timetableclass.entries.any(and_(
-            table_entry_class.station_name == qs.departure_station,
-            table_entry_class.departure_time > qs.departure_time,
-            table_entry_class.departure_time < qs.departure_time + timedelta(hours=5)
-        )),
-            timetableclass.entries.any(and_(table_entry_class.station_name == qs.destination_station,
-                                            table_entry_class.arrival_time > qs.departure_time))
-        )
-    )
+    request_date = request_date or get_request_date(qs.departure_time)
+    start = minutes_since(request_date, qs.departure_time)
+    end = start + int(time_range.total_seconds() // 60)
+    dep_entry = aliased(table_entry_class)
+    dest_entry = aliased(table_entry_class)
+    earliest_entry = aliased(table_entry_class)
+    in_time_range = and_(dep_entry.departure_minute > start, dep_entry.departure_minute < end)
+    # A train passing the departure station twice only counts with its earliest departure
+    earliest_departure = session.query(func.min(earliest_entry.departure_minute)) \
+        .filter(earliest_entry.pattern_id == timetableclass.pattern_id) \
+        .filter(earliest_entry.station_name == qs.departure_station) \
+        .filter(earliest_entry.departure_minute > start, earliest_entry.departure_minute < end) \
+        .correlate(timetableclass).as_scalar()
+    return session.query(timetableclass, dep_entry, dest_entry) \
+        .join(timetableclass.train) \
+        .join(dep_entry, dep_entry.pattern_id == timetableclass.pattern_id) \
+        .join(dest_entry, dest_entry.pattern_id == timetableclass.pattern_id) \
+        .options(contains_eager(timetableclass.train)) \
+        .filter(timetableclass.date == request_date) \
+        .filter(dep_entry.station_name == qs.departure_station) \
+        .filter(in_time_range) \
+        .filter(dep_entry.departure_minute == earliest_departure) \
+        .filter(dest_entry.station_name == qs.destination_station) \
+        .filter(dest_entry.arrival_minute > dep_entry.departure_minute) \
+        .order_by(dep_entry.departure_minute, timetableclass.id, dest_entry.departure_minute)
+
+
+def build_trip_pair_query(session, qs, train_type, time_range=SEARCH_TIME_RANGE, request_date=None):
+    """
+    Range scan on the trips precomputed at ingest time
+    """
+    if train_type == "TRA":
+        timetableclass = TRA_TrainTimeTable
+        trip_pair_class = TRA_TripPair
+    elif train_type == "THSR":
+        timetableclass = THSR_TrainTimeTable
+        trip_pair_class = THSR_TripPair
+    request_date = request_date or get_request_date(qs.departure_time)
+    start = minutes_since(request_date, qs.departure_time)
+    end = start + int(time_range.total_seconds() // 60)
+    return session.query(timetableclass, trip_pair_class) \
+        .join(trip_pair_class, trip_pair_class.pattern_id == timetableclass.pattern_id) \
+        .join(timetableclass.train) \
+        .options(contains_eager(timetableclass.train)) \
+        .filter(timetableclass.date == request_date) \
+        .filter(trip_pair_class.departure_station == qs.departure_station) \
+        .filter(trip_pair_class.destination_station == qs.destination_station) \
+        .filter(trip_pair_class.departure_minute > start, trip_pair_class.departure_minute < end) \
+        .order_by(trip_pair_class.departure_minute, timetableclass.id, trip_pair_class.arrival_minute)
+
+
+def has_trip_pairs(qs, train_type):
+    if train_type == "TRA":
+        return qs.departure_station in TRA_TRIP_PAIR_STATIONS and \
+            qs.destination_station in TRA_TRIP_PAIR_STATIONS
+    return True
+
+
+def request_matching_train(qs, train_type, time_range=SEARCH_TIME_RANGE, request_date=None, trip_pairs=None):
+    """
+    Since the algorithm is same for both TRA and THSR,
+    I believe this function can be an independent function
+    :param trip_pairs: whether every pattern of the date has its trip pairs, read from its building status if None
+    :return: list of [timetable, dep_entry, dest_entry], the entries are IndexedEntry holding datetimes
+    """
+    request_date = request_date or get_request_date(qs.departure_time)
+    start = datetime.combine(request_date, time(0))
+    if not has_trip_pairs(qs, train_type):
+        trip_pairs = False
+    elif trip_pairs is None:
+        version = get_timetable_version(current_app.session, train_type, request_date)
+        trip_pairs = version is not None and version[2]
+    # Only a date whose patterns all have their trip pairs is answered by them, even when nothing is found
+    if trip_pairs:
+        suitable_trains = list()
+        seen = set()
+        for t, pair in build_trip_pair_query(current_app.session, qs, train_type, time_range, request_date):
+            if t.id in seen:
+                continue
+            seen.add(t.id)
+            # A trip pair holds both the departure time and the arrival time
+            suitable_trains.append([
+                t,
+                IndexedEntry(pair.departure_station, None, start + timedelta(minutes=pair.departure_minute)),
+                IndexedEntry(pair.destination_station, start + timedelta(minutes=pair.arrival_minute), None)
+            ])
+        return suitable_trains
+    return request_joined_matching_train(qs, train_type, time_range, request_date)
+
+
+def request_joined_matching_train(qs, train_type, time_range=SEARCH_TIME_RANGE, request_date=None):
+    """
+    Search joining the stops of the timetables, the reference every faster search has to agree with
+    """
+    request_date = request_date or get_request_date(qs.departure_time)
+    start = datetime.combine(request_date, time(0))
+    q = build_matching_train_query(current_app.session, qs, train_type, time_range, request_date)
+    # Rows come ordered by departure, so the first row of each timetable holds its earliest arrival
     suitable_trains = list()
-    for t in q:
-        dep_q = current_app.session.query(table_entry_class) \
-            .filter(table_entry_class.timetable == t) \
-            .filter_by(station_name=qs.departure_station) \
-            .filter(and_(table_entry_class.departure_time > qs.departure_time,
-                         table_entry_class.departure_time < qs.departure_time + timedelta(hours=5))) \
-            .order_by(table_entry_class.departure_time)
-        try:
-            dep_entry = dep_q.one()
-        except MultipleResultsFound:
-            dep_entry = dep_q.first()
-        dest_q = current_app.session.query(table_entry_class) \
-            .filter(table_entry_class.timetable == t) \
-            .filter_by(station_name=qs.destination_station) \
-            .filter(dep_entry.departure_time < table_entry_class.arrival_time) \
-            .order_by(table_entry_class.departure_time)
-        try:
-            dest_entry = dest_q.one()
-        except MultipleResultsFound:
-            dest_entry = dest_q.first()
-        except NoResultFound:
+    seen = set()
+    for t, dep, dest in q:
+        if t.id in seen:
             continue
-        suitable_trains.append([t, dep_entry, dest_entry])
-    suitable_trains = sorted(suitable_trains, key=lambda x: x[1].departure_time)
+        seen.add(t.id)
+        suitable_trains.append([t, make_indexed_entry(start, dep), make_indexed_entry(start, dest)])
     return suitable_trains
 
 
-def expire_user_all_questionstates(user_id):
-    old_states = current_app.session.query(TRA_QuestionState).filter_by(expired=False) \
-        .filter_by(user=user_id).all()
-    for s in old_states:
-        s.expired = True
-    old_states = current_app.session.query(THSR_QuestionState).filter_by(expired=False) \
-        .filter_by(user=user_id).all()
-    for s in old_states:
-        s.expired = True
+def make_indexed_entry(start, entry):
+    return IndexedEntry(entry.station_name, start + timedelta(minutes=entry.arrival_minute),
+                        start + timedelta(minutes=entry.departure_minute))
+
+
+class SearchQuestion(object):
+    def __init__(self, departure_station, destination_station, departure_time):
+        self.departure_station = departure_station
+        self.destination_station = destination_station
+        self.departure_time = departure_time
+
+
+def search_trains(train_type, question, request_date, version, time_range=SEARCH_TIME_RANGE):
+    """
+    Answer from the in-memory timetable index when the date is loaded,
+    otherwise query the database and load the date for the following searches
+    """
+    day = timetable_index.get(train_type, request_date, version) if version else None
+    if day is None:
+        if version:
+            timetable_index.schedule_load(session_factory, train_type, request_date)
+        return request_matching_train(question, train_type, time_range, request_date,
+                                      trip_pairs=version is not None and version[2])
+    start = minutes_since(request_date, question.departure_time)
+    return day.search(question.departure_station, question.destination_station,
+                      start, start + int(time_range.total_seconds() // 60))
+
+
+def find_matching_train(qs, train_type):
+    """
+    Search results are shared through search_cache by every question starting in the same
+    time bucket, and filtered down to the requested departure time
+    """
+    started = timer()
+    trains = find_cached_matching_train(qs, train_type)
+    labels = {"train_type": train_type}
+    histogram("train_search_seconds", "Time of a train search", labels=labels).observe(timer() - started)
+    histogram("train_search_results", "Trains found by a search", RESULT_COUNT_BUCKETS,
+              labels=labels).observe(len(trains))
+    return trains
+
+
+def find_cached_matching_train(qs, train_type):
+    request_date = get_request_date(qs.departure_time)
+    version = get_timetable_version(current_app.session, train_type, request_date)
+    if version is None:
+        # The date is not built or is being rebuilt
+        return search_trains(train_type, qs, request_date, version)
+    start = minutes_since(request_date, qs.departure_time)
+    end = start + int(SEARCH_TIME_RANGE.total_seconds() // 60)
+    bucket = search_cache.bucket_of(start)
+    key = (train_type, qs.departure_station, qs.destination_station, request_date, bucket)
+    trips = search_cache.get(key, version)
+    if trips is None:
+        question = SearchQuestion(qs.departure_station, qs.destination_station,
+                                  datetime.combine(request_date, time(0)) + timedelta(minutes=bucket))
+        time_range = SEARCH_TIME_RANGE + timedelta(minutes=search_cache.bucket_minutes)
+        suitable_trains = search_trains(train_type, question, request_date, version, time_range)
+        trips = compact_trips(request_date, suitable_trains)
+        search_cache.put(key, version, trips)
+    trips = [trip for trip in trips if start < trip.departure < end]
+    return expand_trips(request_date, qs.departure_station, qs.destination_station, trips)
+
+
+def find_journey(qs):
+    """
+    Earliest arrival journey of TRA and THSR trains, changing trains if needed
+    """
+    request_date = get_request_date(qs.departure_time)
+    return journey_planner.plan(current_app.session, qs.departure_station, qs.destination_station,
+                                request_date, minutes_since(request_date, qs.departure_time), qs.train_type)
+
+
+def format_minutes(minutes):
+    return "{0:0>2}:{1:0>2}".format(*divmod(minutes % (24 * 60), 60))
+
+
+def render_journey(qs, legs):
+    if not legs:
+        return "無適合轉乘方案"
+    operator_names = {"TRA": "臺鐵", "THSR": "高鐵"}
+    text = "轉乘方案  {0} → {1} \n".format(qs.departure_station, qs.destination_station)
+    for leg in legs:
+        if leg.timetable is None:
+            text = text + "轉乘 {0} → {1}\n".format(leg.departure_station, leg.destination_station)
+            continue
+        train = leg.timetable.train
+        text = text + " ".join(filter(None, [operator_names[leg.train_type], "{0:0>4}".format(train.train_no),
+                                             train.train_type])) + "\n"
+        text = text + "  {0} {1} → {2} {3}\n".format(leg.departure_station, format_minutes(leg.departure),
+                                                      leg.destination_station, format_minutes(leg.arrival))
+    text = text + "抵達時間 {0}".format(format_minutes(legs[-1].arrival))
+    return text
 
 
 def request_main_menu():
@@ -138,25 +324,25 @@ def request_issue():
                                 "thank you 👍")
 
 
+def get_group_id(event):
+    return None if not hasattr(event.source, "group_id") else event.source.group_id
+
+
+def is_private_chat(event):
+    """
+    Every message of a chat with the bot is addressed to it, unlike the chatter of a group or room
+    """
+    return not hasattr(event.source, "group_id") and not hasattr(event.source, "room_id")
+
+
 def search_TRA_train(event):
-    expire_user_all_questionstates(event.source.user_id)
-    q_state = TRA_QuestionState(group=None if not hasattr(event.source, "group_id") else event.source.group_id,
-                                user=event.source.user_id)
-    current_app.session.add(q_state)
-    current_app.session.commit()
+    current_app.dialog_store.start("TRA", event.source.user_id, get_group_id(event), current_app.session)
     message = TextSendMessage(text="請輸入起程站")
     return message
 
 
 def match_TRA_station_name(text):
-    if len(text) > 5:
-        return None
-    stations_name = TRA_STATION_CODE2NAME.values()
-    text = pre_process_text(text)
-    for s in stations_name:
-        if re.match(s, text):
-            return s
-    return None
+    return TRA_STATIONS.match(text)
 
 
 def request_TRA_matching_train(qs):
@@ -164,75 +350,123 @@ def request_TRA_matching_train(qs):
 
 
 def search_THSR_train(event):
-    expire_user_all_questionstates(event.source.user_id)
-    q_state = THSR_QuestionState(group=None if not hasattr(event.source, "group_id") else event.source.group_id,
-                                 user=event.source.user_id)
-    current_app.session.add(q_state)
-    current_app.session.commit()
+    current_app.dialog_store.start("THSR", event.source.user_id, get_group_id(event), current_app.session)
     message = TextSendMessage(text="請輸入起程站")
     return message
 
 
 def match_THSR_station_name(text):
-    if len(text) > 4:
-        return None
-    stations_name = THSR_STATION_CODE2NAME.values()
-    text = pre_process_text(text)
-    text = re.sub(r'高雄', '左營', text)
-    for s in stations_name:
-        if re.match(s, text):
-            return s
-    return None
+    return THSR_STATIONS.match(text)
+
+
+def find_station_candidates(text, train_type, anywhere=True):
+    """
+    :param anywhere: find the names anywhere in text, otherwise text has to be a name
+    :return: list of station names, a single name if text is resolved, otherwise the closest ones
+    """
+    stations = TRA_STATIONS if train_type == "TRA" else THSR_STATIONS
+    candidates = stations.resolve(text, anywhere)
+    if not candidates:
+        counter("station_match_misses_total", "Station names matching no station",
+                labels={"train_type": train_type}).inc()
+    elif len(candidates) > 1:
+        counter("station_match_ambiguous_total", "Station names matching several stations",
+                labels={"train_type": train_type}).inc()
+    return candidates
+
+
+def create_station_choices_message(title, candidates):
+    return TemplateSendMessage(
+        alt_text=title,
+        template=ButtonsTemplate(
+            title=title,
+            text='是指以下哪一站？',
+            actions=[MessageTemplateAction(label=name, text=name) for name in candidates]
+        )
+    )
 
 
 def request_THSR_matching_train(qs):
     return request_matching_train(qs, "THSR")
 
 
-def ask_question_states(event):
-    now = datetime.now()
-    train_type = ""
-    qs = current_app.session.query(TRA_QuestionState).filter_by(expired=False) \
-        .filter_by(user=event.source.user_id)
-    if hasattr(event.source, "group_id"):
-        qs = qs.filter_by(group=event.source.group_id)
-    try:
-        qs = qs.one()
-        train_type = "TRA"
-    except NoResultFound:
-        pass
-    except MultipleResultsFound:
-        for i in qs.all():
-            i.expired = True
+def search_result_rows(suitable_trains):
+    """
+    :return: list of [timetable id, train no, train type, departure, arrival] in the order of the search,
+             times are formatted as HH:MM
+    """
+    rows = list()
+    for _l in suitable_trains:
+        rows.append([str(_l[0].id), _l[0].train.train_no, getattr(_l[0].train, "train_type", None) or "",
+                     _l[1].departure_time.strftime("%H:%M"), _l[2].arrival_time.strftime("%H:%M")])
+    return rows
+
+
+def dump_search_result(rows):
+    """
+    Serialize rows as "id,train_no,train_type,HH:MM,HH:MM" separated by ";"
+    """
+    return ";".join(",".join(row) for row in rows)
+
+
+def load_search_result(text):
+    if not text:
+        return []
+    return [row.split(",") for row in text.split(";")]
+
 
-    if not train_type:
-        qs = current_app.session.query(THSR_QuestionState).filter_by(expired=False) \
-            .filter_by(user=event.source.user_id)
+def load_question_state(event):
+    """
+    Read the dialog from the database when dialog_store does not know the source,
+    e.g. after a restart or when it was started by a worker not sharing the store
+    :return: DialogState, None if the user has no ongoing dialog
+    """
+    since = datetime.now() - current_app.dialog_store.ttl
+    for train_type, question_state_class in (("TRA", TRA_QuestionState), ("THSR", THSR_QuestionState)):
+        q = current_app.session.query(question_state_class).filter_by(expired=False) \
+            .filter_by(user=event.source.user_id).filter(question_state_class.update > since)
+        if hasattr(event.source, "group_id"):
+            q = q.filter_by(group=event.source.group_id)
         try:
-            qs = qs.one()
-            train_type = "THSR"
+            row = q.one()
         except NoResultFound:
-            return None
+            continue
         except MultipleResultsFound:
-            for i in qs.all():
+            for i in q.all():
                 i.expired = True
-            return None
+            continue
+        state = DialogState.from_row(train_type, row)
+        row.token = state.token
+        return state
+    return None
+
+
+def ask_question_states(event):
+    now = datetime.now()
+    qs = current_app.dialog_store.get_or_load(event.source.user_id, get_group_id(event),
+                                              lambda: load_question_state(event))
+    if qs is None:
+        return None
+    train_type = qs.train_type
 
     message = None
+    # A sentence in a group only answers the dialog when it is a station name
+    anywhere = is_private_chat(event)
     if not qs.departure_station:
-        if train_type == "TRA":
-            res = match_TRA_station_name(event.message.text)
-        else:
-            res = match_THSR_station_name(event.message.text)
-        if res:
-            qs.departure_station = res
+        candidates = find_station_candidates(event.message.text, train_type, anywhere)
+        if len(candidates) == 1:
+            qs.departure_station = candidates[0]
             message = TextSendMessage(text="請輸入目的站")
+        elif candidates:
+            message = create_station_choices_message("請選擇起程站", candidates)
     elif not qs.destination_station:
-        if train_type == "TRA":
-            res = match_TRA_station_name(event.message.text)
-        else:
-            res = match_THSR_station_name(event.message.text)
-        if res and res != qs.departure_station:
+        candidates = find_station_candidates(event.message.text, train_type, anywhere)
+        if len(candidates) > 1:
+            candidates = [name for name in candidates if name != qs.departure_station]
+        res = candidates[0] if len(candidates) == 1 else None
+        if len(candidates) > 1:
+            message = create_station_choices_message("請選擇目的站", candidates)
+        elif res and res != qs.departure_station:
             qs.destination_station = res
             title = '請選擇搭乘時間: {0} → {1}'.format(qs.departure_station, qs.destination_station)
             message = TemplateSendMessage(
@@ -254,45 +488,38 @@ def ask_question_states(event):
             dt = event.postback.params["datetime"]
             dt = datetime.strptime(dt, "%Y-%m-%dT%H:%M")
             qs.departure_time = dt
-            if qs.group:
-                current_app.linebot.push_message(qs.group, TextSendMessage(text="搜尋中..."))
-            else:
-                current_app.linebot.push_message(qs.user, TextSendMessage(text="搜尋中..."))
-            if train_type == "TRA":
-                suitable_trains = request_TRA_matching_train(qs)
-            else:
-                suitable_trains = request_THSR_matching_train(qs)
+            # The notice is sent in the background, the search does not wait for LINE. It is dropped
+            # when the search is replied before it is sent
+            current_app.line_dispatcher.push_async(qs.group or qs.user, TextSendMessage(text="搜尋中..."),
+                                                   event.reply_token)
+            rows = search_result_rows(find_matching_train(qs, train_type))
+            qs.search_result = dump_search_result(rows)
             actions = [DatetimePickerTemplateAction(label='更換搭乘時間', data='datetime_postback', mode='datetime'),
                        MessageTemplateAction(label='新的搜尋', text='T')]
-            if not suitable_trains:
+            count = 0
+            if not rows:
                 text = "無適合班次"
             elif train_type == "TRA":
                 text = "車次   車種      開車         抵達\n"
                 fmt = "{0:0>4}  {1:^2}     {2}       {3}\n"
-                count = 0
-                for _l in suitable_trains:
-                    text = text + fmt.format(_l[0].train.train_no, _l[0].train.train_type,
-                                             _l[1].departure_time.strftime("%H:%M"),
-                                             _l[2].arrival_time.strftime("%H:%M"))
+                for _, train_no, train_kind, departure, arrival in rows:
+                    text = text + fmt.format(train_no, train_kind, departure, arrival)
                     count += 1
                     # Total word number of a post is limited
                     if len(text) > 125:
                         break
-                if len(suitable_trains) > count:
-                    actions.insert(0, MessageTemplateAction(label='列出更多', text='列出更多'))
             else:
-                text = "車次     開車時間    抵達時間\n".format(qs.departure_station, qs.destination_station)
+                text = "車次     開車時間    抵達時間\n"
                 fmt = "{0:0>4}       {1}          {2}\n"
-                count = 0
-                for _l in suitable_trains:
-                    text = text + fmt.format(_l[0].train.train_no,
-                                             _l[1].departure_time.strftime("%H:%M"),
-                                             _l[2].arrival_time.strftime("%H:%M"))
+                for _, train_no, _, departure, arrival in rows:
+                    text = text + fmt.format(train_no, departure, arrival)
                     count += 1
                     if len(text) > 125:
                         break
-                if len(suitable_trains) > count:
-                    actions.insert(0, MessageTemplateAction(label='列出更多', text='列出更多'))
+            qs.result_cursor = count
+            actions.insert(0, MessageTemplateAction(label='轉乘', text='轉乘'))
+            if len(rows) > count:
+                actions.insert(0, MessageTemplateAction(label='列出更多', text='列出更多'))
             message = TemplateSendMessage(
                 alt_text='搜尋結果: {0} → {1}'.format(qs.departure_station, qs.destination_station),
                 template=ButtonsTemplate(text=text, actions=actions)
@@ -300,41 +527,40 @@ def ask_question_states(event):
         except KeyError:
             pass
     elif event.message.text == "列出更多" and qs.departure_station and qs.destination_station and qs.departure_time:
-        if qs.group:
-            current_app.linebot.push_message(qs.group, TextSendMessage(text="搜尋中..."))
-        else:
-            current_app.linebot.push_message(qs.user, TextSendMessage(text="搜尋中..."))
-        if train_type == "TRA":
-            suitable_trains = request_TRA_matching_train(qs)
-        else:
-            suitable_trains = request_THSR_matching_train(qs)
-        if not suitable_trains:
+        if qs.search_result is None:
+            # Question states created before results were kept
+            qs.search_result = dump_search_result(search_result_rows(find_matching_train(qs, train_type)))
+            qs.result_cursor = 0
+        rows = load_search_result(qs.search_result)
+        cursor = qs.result_cursor or 0
+        page = rows[cursor:cursor + RESULT_PAGE_SIZE]
+        if not rows:
             text = "無適合班次"
-        elif train_type == "TRA":
-            text = "適合班次如下  {0} → {1} \n" \
-                   "車次   車種  開車時間  抵達時間\n".format(qs.departure_station, qs.destination_station)
-            fmt = "{0:0>4}  {1:^2}     {2}        {3}\n"
-            for _l in suitable_trains:
-                text = text + fmt.format(_l[0].train.train_no, _l[0].train.train_type,
-                                         _l[1].departure_time.strftime("%H:%M"),
-                                         _l[2].arrival_time.strftime("%H:%M"))
-                if len(text) > 1000:
-                    text = text + "More..."
-                    break
+        elif not page:
+            text = "沒有更多班次了"
         else:
             text = "適合班次如下  {0} → {1} \n" \
-                   "車次     開車時間    抵達時間\n".format(qs.departure_station, qs.destination_station)
-            fmt = "{0:0>4}       {1}          {2}\n"
-            for _l in suitable_trains:
-                text = text + fmt.format(_l[0].train.train_no,
-                                         _l[1].departure_time.strftime("%H:%M"),
-                                         _l[2].arrival_time.strftime("%H:%M"))
-                if len(text) > 1000:
-                    text = text + "More..."
-                    break
+                   "第{2}~{3}班，共{4}班\n".format(qs.departure_station, qs.destination_station,
+                                              cursor + 1, cursor + len(page), len(rows))
+            if train_type == "TRA":
+                text = text + "車次   車種  開車時間  抵達時間\n"
+                fmt = "{0:0>4}  {1:^2}     {2}        {3}\n"
+                for _, train_no, train_kind, departure, arrival in page:
+                    text = text + fmt.format(train_no, train_kind, departure, arrival)
+            else:
+                text = text + "車次     開車時間    抵達時間\n"
+                fmt = "{0:0>4}       {1}          {2}\n"
+                for _, train_no, _, departure, arrival in page:
+                    text = text + fmt.format(train_no, departure, arrival)
+            qs.result_cursor = cursor + len(page)
+            if len(rows) > qs.result_cursor:
+                text = text + "輸入「列出更多」顯示下一頁"
         message = TextSendMessage(text=text)
+    elif event.message.text == "轉乘" and qs.departure_station and qs.destination_station and qs.departure_time:
+        message = TextSendMessage(text=render_journey(qs, find_journey(qs)))
     if message:
         qs.update = now
+        current_app.dialog_store.put(qs, current_app.session)
     return message
 
 
@@ -381,7 +607,6 @@ def handle_follow_event(event):
     unfollow_user(user_id=event.source.user_id)
     new_user = User(event.source.user_id)
     current_app.session.add(new_user)
-    current_app.session.commit()
     return TextSendMessage(text=text)
 
 
@@ -402,7 +627,6 @@ def handle_join_event(event):
     leave_group(event.source.group_id)
     new_group = Group(event.source.group_id)
     current_app.session.add(new_group)
-    current_app.session.commit()
     return TextSendMessage(text=text)
 
 
@@ -414,28 +638,64 @@ def handle_postback_event(event):
     return ask_question_states(event)
 
 
+def handle_event(ev):
+    """
+    :return: the message replied to the event, None if there is none
+    """
+    response = None
+    if isinstance(ev, MessageEvent):
+        response = handle_message_event(ev)
+    elif isinstance(ev, FollowEvent):
+        response = handle_follow_event(ev)
+    elif isinstance(ev, UnfollowEvent):
+        handle_unfollow_event(ev)
+    elif isinstance(ev, JoinEvent):
+        response = handle_join_event(ev)
+    elif isinstance(ev, LeaveEvent):
+        handle_leave_event(ev)
+    elif isinstance(ev, PostbackEvent):
+        response = handle_postback_event(ev)
+    else:
+        pass
+    return response
+
+
 def handle_events(events):
-    for ev in events:
-        # Create new session for each request and tear it down after the process ends
-        # For more information look at the link below:
-        # http://docs.sqlalchemy.org/en/latest/orm/session_basics.html#when-do-i-construct-a-session-when-do-i-commit-it-and-when-do-i-close-it
-        current_app.session = Session()
-        response = None
-        if isinstance(ev, MessageEvent):
-            response = handle_message_event(ev)
-        elif isinstance(ev, FollowEvent):
-            response = handle_follow_event(ev)
-        elif isinstance(ev, UnfollowEvent):
-            handle_unfollow_event(ev)
-        elif isinstance(ev, JoinEvent):
-            response = handle_join_event(ev)
-        elif isinstance(ev, LeaveEvent):
-            handle_leave_event(ev)
-        elif isinstance(ev, PostbackEvent):
-            response = handle_postback_event(ev)
-        else:
-            pass
+    """
+    Handle the events of one source in one transaction, every event within a savepoint so that a failed
+    event does not undo the others. The replies are sent side by side once the transaction is committed.
+    """
+    # current_app.session is the scoped Session, every thread or greenlet gets a new session for the
+    # events which is torn down after the process ends. For more information look at the link below:
+    # http://docs.sqlalchemy.org/en/latest/orm/session_basics.html#when-do-i-construct-a-session-when-do-i-commit-it-and-when-do-i-close-it
+    replies = list()
+    try:
+        for ev in events:
+            labels = {"event_type": type(ev).__name__}
+            started = timer()
+            stats = reset_query_stats()
+            try:
+                with current_app.session.begin_nested():
+                    response = handle_event(ev)
+            except Exception:
+                current_app.logger.exception("Handling a {0} failed.".format(labels["event_type"]))
+                log_failed_event(ev)
+                counter("webhook_failed_events_total", "Events whose handling failed", labels=labels).inc()
+                continue
+            finally:
+                histogram("webhook_event_seconds", "Time handling an event", labels=labels).observe(
+                    timer() - started)
+                histogram("webhook_event_queries", "Database statements run by an event", QUERY_COUNT_BUCKETS,
+                          labels=labels).observe(stats.count)
+                histogram("webhook_event_query_seconds", "Time an event waits for the database",
+                          labels=labels).observe(stats.seconds)
+                warn_repeated_queries(stats, labels["event_type"])
+            if response is not None:
+                replies.append((ev.reply_token, response))
         current_app.session.commit()
-        current_app.session.close()
-        if response is not None:
-            current_app.linebot.reply_message(ev.reply_token, response)
+    except Exception:
+        current_app.session.rollback()
+        raise
+    finally:
+        Session.remove()
+    current_app.line_dispatcher.reply_all(replies)
@@ -0,0 +1,37 @@
+"""
+Liveness and readiness of the web app.
+
+/healthz only tells that the process answers. /readyz tells that it answers searches at full
+speed: the database is reachable, and the timetables of the current service date are built and
+loaded into the timetable index. A date built but not loaded yet is scheduled for loading, so the
+first probes of a new worker warm its index up.
+"""
+from sqlalchemy.exc import DBAPIError
+
+from timetable_index import timetable_index, get_timetable_version
+
+TRAIN_TYPES = ("TRA", "THSR")
+
+
+def check_readiness(session_factory, service_date):
+    """
+    :return: (True if ready, dict of every check)
+    """
+    checks = {"database": False, "timetable": dict(), "index": dict()}
+    session = session_factory()
+    try:
+        session.execute("SELECT 1")
+        checks["database"] = True
+        for train_type in TRAIN_TYPES:
+            version = get_timetable_version(session, train_type, service_date)
+            loaded = version is not None and timetable_index.get(train_type, service_date, version) is not None
+            if version is not None and not loaded:
+                timetable_index.schedule_load(session_factory, train_type, service_date)
+            checks["timetable"][train_type] = version is not None
+            checks["index"][train_type] = loaded
+    except DBAPIError:
+        checks["database"] = False
+    finally:
+        session.close()
+    ready = checks["database"] and all(checks["timetable"].values()) and all(checks["index"].values())
+    return ready, checks
@@ -0,0 +1,251 @@
+"""
+Journey planner across TRA and THSR.
+
+Every two consecutive stops of a train form an elementary connection. All connections of a service
+date are kept in arrays sorted by departure time, so an earliest arrival query is a single scan over
+them (Connection Scan Algorithm). Stations are told apart by operator, the stations where the two
+operators meet are linked by the time needed to change between them. A TRA and a THSR station of
+the same name are different places, e.g. 新竹, and only reached from each other through those links.
+"""
+import bisect
+import threading
+from collections import OrderedDict
+
+from timetable_index import timetable_index, get_timetable_version
+
+# Minutes needed to change trains of the same operator within one station
+MIN_TRANSFER_MINUTES = {"TRA": 5, "THSR": 5}
+# (TRA station, THSR station, minutes needed to change between the operators)
+TRANSFER_STATIONS = [
+    ("南港", "南港", 10),
+    ("臺北", "臺北", 10),
+    ("板橋", "板橋", 10),
+    ("中壢", "桃園", 30),
+    ("六家", "新竹", 5),
+    ("豐富", "苗栗", 5),
+    ("新烏日", "臺中", 10),
+    ("沙崙", "臺南", 5),
+    ("新左營", "左營", 10),
+]
+# Only keep the connections of the most recently planned dates in memory
+MAX_PLANNED_DAYS = 4
+
+INFINITY = float("inf")
+# Marks the stops a journey starts from
+ORIGIN = -1
+
+
+class JourneyLeg(object):
+    """
+    One train ridden between two stations, or a change between the operators if timetable is None.
+    Times are minutes since the start of the service date.
+    """
+    def __init__(self, train_type, timetable, departure_station, departure, destination_station, arrival):
+        self.train_type = train_type
+        self.timetable = timetable
+        self.departure_station = departure_station
+        self.departure = departure
+        self.destination_station = destination_station
+        self.arrival = arrival
+
+
+class ConnectionDay(object):
+    """
+    Elementary connections of TRA and THSR on one service date
+    """
+    def __init__(self, service_date, days, versions=None):
+        """
+        :param days: DayIndex of every train type to plan with
+        """
+        self.date = service_date
+        self.versions = versions
+        # stop id -> (train type, station name)
+        self.stops = list()
+        self.stop_ids = dict()
+        # trip id -> (DayIndex, trip of the DayIndex)
+        self.trips = list()
+        # stop id -> list of (stop id, minutes)
+        self.footpaths = dict()
+        connections = list()
+        for day in days:
+            stop_ids = [self.stop_id(day.train_type, name) for name in day.stations.names]
+            stop_stations, stop_arrivals, stop_departures = day.stop_stations, day.stop_arrivals, day.stop_departures
+            for day_trip in range(len(day)):
+                trip = len(self.trips)
+                self.trips.append((day, day_trip))
+                for position in range(day.trip_offsets[day_trip], day.trip_offsets[day_trip + 1] - 1):
+                    departure = stop_departures[position]
+                    arrival = stop_arrivals[position + 1]
+                    if arrival < departure:
+                        continue
+                    connections.append((departure, arrival, stop_ids[stop_stations[position]],
+                                        stop_ids[stop_stations[position + 1]], trip))
+        connections.sort()
+        self.departures = [c[0] for c in connections]
+        self.arrivals = [c[1] for c in connections]
+        self.from_stops = [c[2] for c in connections]
+        self.to_stops = [c[3] for c in connections]
+        self.connection_trips = [c[4] for c in connections]
+        self.transfer_minutes = [MIN_TRANSFER_MINUTES[train_type] for train_type, _ in self.stops]
+        for tra_station, thsr_station, minutes in TRANSFER_STATIONS:
+            tra_stop = self.stop_ids.get(("TRA", tra_station))
+            thsr_stop = self.stop_ids.get(("THSR", thsr_station))
+            if tra_stop is None or thsr_stop is None:
+                continue
+            self.footpaths.setdefault(tra_stop, []).append((thsr_stop, minutes))
+            self.footpaths.setdefault(thsr_stop, []).append((tra_stop, minutes))
+
+    def stop_id(self, train_type, station_name):
+        key = (train_type, station_name)
+        stop = self.stop_ids.get(key)
+        if stop is None:
+            stop = self.stop_ids[key] = len(self.stops)
+            self.stops.append(key)
+        return stop
+
+    def plan(self, departure_station, destination_station, start, train_type):
+        """
+        Earliest arrival journey leaving departure_station after start minutes.
+        Both stations are the ones of train_type, the other operator is reached by changing between them.
+        :return: list of JourneyLeg, None if destination_station can not be reached on the date
+        """
+        source = self.stop_ids.get((train_type, departure_station))
+        target = self.stop_ids.get((train_type, destination_station))
+        if source is None or target is None or source == target:
+            return None
+        sources = [source]
+        # Stops the target is reached from, and the minutes needed to change to it
+        targets = {target: 0}
+        for stop, minutes in self.footpaths.get(target, ()):
+            targets[stop] = minutes
+        # Earliest arrival at every stop, and the (enter, exit) connections of the train arriving there
+        arrival = [INFINITY] * len(self.stops)
+        arrived_by = [None] * len(self.stops)
+        # Earliest time a train can be boarded at every stop, and the stop it was reached from
+        ready = [INFINITY] * len(self.stops)
+        ready_from = [None] * len(self.stops)
+        trip_enter = [None] * len(self.trips)
+        for stop in sources:
+            ready[stop] = start
+            ready_from[stop] = ORIGIN
+        for stop in sources:
+            for next_stop, minutes in self.footpaths.get(stop, ()):
+                if start + minutes < ready[next_stop]:
+                    ready[next_stop] = start + minutes
+                    ready_from[next_stop] = stop
+
+        departures, arrivals = self.departures, self.arrivals
+        from_stops, to_stops, connection_trips = self.from_stops, self.to_stops, self.connection_trips
+        best = INFINITY
+        for i in range(bisect.bisect_right(departures, start), len(departures)):
+            departure = departures[i]
+            if departure >= best:
+                break
+            trip = connection_trips[i]
+            if trip_enter[trip] is None:
+                if ready[from_stops[i]] > departure:
+                    continue
+                trip_enter[trip] = i
+            stop = to_stops[i]
+            arrive = arrivals[i]
+            if arrive >= arrival[stop]:
+                continue
+            arrival[stop] = arrive
+            arrived_by[stop] = (trip_enter[trip], i)
+            if stop in targets and arrive + targets[stop] < best:
+                best = arrive + targets[stop]
+            if arrive + self.transfer_minutes[stop] < ready[stop]:
+                ready[stop] = arrive + self.transfer_minutes[stop]
+                ready_from[stop] = stop
+            for next_stop, minutes in self.footpaths.get(stop, ()):
+                if arrive + minutes < ready[next_stop]:
+                    ready[next_stop] = arrive + minutes
+                    ready_from[next_stop] = stop
+        if best == INFINITY:
+            return None
+        stop = min(targets, key=lambda s: arrival[s] + targets[s])
+        legs = self.build_journey(stop, arrived_by, ready, ready_from, sources)
+        if stop != target:
+            legs.append(JourneyLeg(None, None, self.stops[stop][1], arrival[stop], self.stops[target][1], best))
+        return legs
+
+    def build_journey(self, target, arrived_by, ready, ready_from, sources):
+        legs = list()
+        stop = target
+        while True:
+            enter, exit = arrived_by[stop]
+            day, day_trip = self.trips[self.connection_trips[enter]]
+            stop = self.from_stops[enter]
+            legs.append(JourneyLeg(day.train_type, day.timetable(day_trip), self.stops[stop][1], self.departures[enter],
+                                   self.stops[self.to_stops[exit]][1], self.arrivals[exit]))
+            previous = ready_from[stop]
+            if previous == ORIGIN:
+                break
+            if previous != stop:
+                legs.append(JourneyLeg(None, None, self.stops[previous][1], ready[stop] - self.footpath_minutes(
+                    previous, stop), self.stops[stop][1], ready[stop]))
+                stop = previous
+                # Changed operator right at the origin
+                if stop in sources:
+                    break
+        legs.reverse()
+        return legs
+
+    def footpath_minutes(self, from_stop, to_stop):
+        for stop, minutes in self.footpaths.get(from_stop, ()):
+            if stop == to_stop:
+                return minutes
+        return 0
+
+
+class JourneyPlanner(object):
+    """
+    Holds the ConnectionDay of recently planned dates
+    """
+    def __init__(self, max_days=MAX_PLANNED_DAYS):
+        self.max_days = max_days
+        self._days = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_connection_day(self, session, service_date):
+        """
+        Connections are built from the timetable index, a date which is not loaded yet is loaded here.
+        :return: None if neither TRA nor THSR is built on the date
+        """
+        versions = tuple(get_timetable_version(session, train_type, service_date)
+                         for train_type in ("TRA", "THSR"))
+        if versions == (None, None):
+            return None
+        with self._lock:
+            connection_day = self._days.get(service_date)
+            if connection_day is not None and connection_day.versions == versions:
+                self._days.move_to_end(service_date)
+                return connection_day
+        days = list()
+        for train_type, version in zip(("TRA", "THSR"), versions):
+            if version is None:
+                continue
+            day = timetable_index.get(train_type, service_date, version)
+            if day is None:
+                day = timetable_index.load(session, train_type, service_date)
+            days.append(day)
+        connection_day = ConnectionDay(service_date, days, versions)
+        with self._lock:
+            self._days[service_date] = connection_day
+            self._days.move_to_end(service_date)
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+        return connection_day
+
+    def plan(self, session, departure_station, destination_station, service_date, start, train_type):
+        connection_day = self.get_connection_day(session, service_date)
+        if connection_day is None:
+            return None
+        return connection_day.plan(departure_station, destination_station, start, train_type)
+
+    def clear(self):
+        with self._lock:
+            self._days.clear()
+
+
+journey_planner = JourneyPlanner()
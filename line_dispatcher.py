@@ -0,0 +1,210 @@
+"""
+Sending messages to the LINE Messaging API.
+
+LineBotApi posts every message with requests.post, opening a new HTTPS connection each time.
+PooledHttpClient keeps the connections alive in a pool instead. LineDispatcher sends replies right
+away, and queues notices nobody waits for (e.g. "搜尋中...") for a background thread which retries
+them when LINE fails. A notice given the reply token of its event never comes after that reply: it
+is dropped if it is still queued when the reply is sent, and the reply waits for a notice being
+sent. The time of every call is recorded apart from our own handling time.
+"""
+import sys
+import time
+import queue
+import threading
+import traceback
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.exceptions import LineBotApiError
+
+from metrics import histogram, counter
+
+# (connect timeout, read timeout) of every call in seconds
+LINE_API_TIMEOUT = (3.05, 10)
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+# Attempts of a queued message, waiting RETRY_BACKOFF * 2 ** attempt seconds in between
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5
+MAX_QUEUED_MESSAGES = 1000
+# Replies of one delivery sent at the same time
+MAX_PARALLEL_REPLIES = 8
+# States of the notice of a reply token
+NOTICE_QUEUED = "queued"
+NOTICE_SENDING = "sending"
+
+REPLY_LATENCY = histogram("line_reply_seconds", "Time of LINE reply_message calls")
+PUSH_LATENCY = histogram("line_push_seconds", "Time of LINE push_message calls")
+API_ERRORS = counter("line_api_errors_total", "Failed LINE API calls, retried ones included")
+DROPPED_MESSAGES = counter("line_dropped_messages_total", "Queued messages given up or refused")
+SKIPPED_NOTICES = counter("line_skipped_notices_total", "Queued notices dropped as their reply was sent first")
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """
+    RequestsHttpClient sending through one requests.Session, whose connections are kept alive
+    """
+    def __init__(self, timeout=LINE_API_TIMEOUT):
+        super(PooledHttpClient, self).__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream,
+                                    timeout=timeout if timeout is not None else self.timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data,
+                                     timeout=timeout if timeout is not None else self.timeout)
+        return RequestsHttpResponse(response)
+
+
+def is_retryable(error):
+    if isinstance(error, LineBotApiError):
+        return error.status_code >= 500
+    return isinstance(error, requests.RequestException)
+
+
+class LineDispatcher(object):
+    def __init__(self, api, max_attempts=MAX_ATTEMPTS, backoff=RETRY_BACKOFF, max_queued=MAX_QUEUED_MESSAGES):
+        """
+        :param api: LineBotApi
+        """
+        self.api = api
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._executor = None
+        # reply token -> NOTICE_QUEUED or NOTICE_SENDING
+        self._notices = dict()
+        self._notices_changed = threading.Condition()
+
+    def call(self, histogram, method, *args):
+        started = time.time()
+        try:
+            return method(*args)
+        except Exception:
+            API_ERRORS.inc()
+            raise
+        finally:
+            histogram.observe(time.time() - started)
+
+    def reply(self, reply_token, messages):
+        self.cancel_notice(reply_token)
+        return self.call(REPLY_LATENCY, self.api.reply_message, reply_token, messages)
+
+    def reply_all(self, replies):
+        """
+        Send replies side by side, a failed reply does not stop the others
+        :param replies: list of (reply token, messages)
+        :return: number of replies sent
+        """
+        if len(replies) <= 1:
+            return sum(self.try_reply(token, messages) for token, messages in replies)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_REPLIES)
+        futures = [self._executor.submit(self.try_reply, token, messages) for token, messages in replies]
+        return sum(future.result() for future in futures)
+
+    def try_reply(self, reply_token, messages):
+        try:
+            self.reply(reply_token, messages)
+            return True
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            return False
+
+    def push(self, to, messages):
+        return self.call(PUSH_LATENCY, self.api.push_message, to, messages)
+
+    def push_async(self, to, messages, reply_token=None):
+        """
+        Push without waiting for LINE
+        :param reply_token: reply token of the event, the message is not sent after its reply
+        :return: False if too many messages are waiting already
+        """
+        if reply_token is not None:
+            with self._notices_changed:
+                self._notices[reply_token] = NOTICE_QUEUED
+        try:
+            self._queue.put_nowait((to, messages, reply_token))
+        except queue.Full:
+            self.release_notice(reply_token, True)
+            DROPPED_MESSAGES.inc()
+            return False
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+        return True
+
+    def run(self):
+        while True:
+            to, messages, reply_token = self._queue.get()
+            try:
+                self.send_with_retries(to, messages, reply_token)
+            finally:
+                self._queue.task_done()
+
+    def send_with_retries(self, to, messages, reply_token=None):
+        for attempt in range(self.max_attempts):
+            if not self.claim_notice(reply_token):
+                SKIPPED_NOTICES.inc()
+                return False
+            try:
+                self.push(to, messages)
+                self.release_notice(reply_token, True)
+                return True
+            except Exception as e:
+                given_up = not is_retryable(e) or attempt == self.max_attempts - 1
+                self.release_notice(reply_token, given_up)
+                if given_up:
+                    DROPPED_MESSAGES.inc()
+                    traceback.print_exc(file=sys.stdout)
+                    return False
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def claim_notice(self, reply_token):
+        """
+        :return: False if the reply of reply_token is sent already
+        """
+        if reply_token is None:
+            return True
+        with self._notices_changed:
+            if reply_token not in self._notices:
+                return False
+            self._notices[reply_token] = NOTICE_SENDING
+            return True
+
+    def release_notice(self, reply_token, done):
+        if reply_token is None:
+            return
+        with self._notices_changed:
+            if done:
+                self._notices.pop(reply_token, None)
+            elif reply_token in self._notices:
+                self._notices[reply_token] = NOTICE_QUEUED
+            self._notices_changed.notify_all()
+
+    def cancel_notice(self, reply_token):
+        """
+        Drop the queued notice of reply_token, a notice being sent is waited for
+        """
+        with self._notices_changed:
+            while self._notices.get(reply_token) == NOTICE_SENDING:
+                self._notices_changed.wait()
+            self._notices.pop(reply_token, None)
+
+    def join(self):
+        """
+        Wait until every queued message is sent or given up
+        """
+        self._queue.join()
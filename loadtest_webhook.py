@@ -0,0 +1,328 @@
+"""
+Load test of the /callback path with signed LINE webhook deliveries.
+
+    LINE_API_ENDPOINT=http://127.0.0.1:8090 gunicorn ... wsgi:application
+    python loadtest_webhook.py --url http://127.0.0.1:5000/callback --stub-port 8090 --users 20 --dialogs 5
+
+Every simulated user follows the bot and runs whole searches: "T", "臺鐵", the departure station,
+the destination station and the datetime postback. Deliveries are signed with CHANNEL_SECRET like
+WebhookParser expects. The LINE API is replaced by a local stub, which records the reply and push
+calls after waiting --latency seconds; the app has to send to it through LINE_API_ENDPOINT.
+Without --url the app is run in this process and pointed to the stub.
+
+The latency of a step is the time from posting its delivery to the stub receiving its reply, the
+webhook only acknowledges a delivery and replies from its event queue. Reported are the requests
+per second, the acknowledge and reply latency of every step, and its HTTP errors, replies timed
+out and error replies.
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import uuid
+import base64
+import hashlib
+import argparse
+import threading
+import traceback
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import requests
+from dotenv import load_dotenv
+
+# Load env variables
+dotenv_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path=dotenv_path)
+
+from metrics import percentile  # noqa
+
+STEPS = ["follow", "menu", "train_type", "departure", "destination", "datetime"]
+# Replies which tell the user something went wrong
+ERROR_TEXTS = ("系統發生錯誤",)
+DEFAULT_PAIRS = [("臺北", "臺中"), ("新竹", "高雄"), ("板橋", "桃園"), ("臺南", "嘉義")]
+
+
+def sign(body, channel_secret):
+    """
+    :return: X-Line-Signature of body, see linebot.SignatureValidator
+    """
+    digest = hmac.new(channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def make_event(event_type, user_id, **fields):
+    event = {
+        "type": event_type,
+        "replyToken": uuid.uuid4().hex,
+        "source": {"type": "user", "userId": user_id},
+        "timestamp": int(time.time() * 1000),
+    }
+    event.update(fields)
+    return event
+
+
+def follow_event(user_id):
+    return make_event("follow", user_id)
+
+
+def text_event(user_id, text):
+    return make_event("message", user_id, message={"id": uuid.uuid4().hex[:14], "type": "text", "text": text})
+
+
+def datetime_event(user_id, departure_time):
+    params = {"datetime": departure_time.strftime("%Y-%m-%dT%H:%M")}
+    return make_event("postback", user_id, postback={"data": "datetime_postback", "params": params})
+
+
+def make_body(events):
+    return json.dumps({"destination": "U" + "0" * 32, "events": events}, ensure_ascii=False)
+
+
+def dialog_events(user_id, departure, destination, departure_time, follow=True):
+    """
+    :return: list of (step, event) of one search
+    """
+    events = [("follow", follow_event(user_id))] if follow else []
+    return events + [
+        ("menu", text_event(user_id, "T")),
+        ("train_type", text_event(user_id, "臺鐵")),
+        ("departure", text_event(user_id, departure)),
+        ("destination", text_event(user_id, destination)),
+        ("datetime", datetime_event(user_id, departure_time)),
+    ]
+
+
+class LineApiStub(ThreadingMixIn, HTTPServer):
+    """
+    Local server answering the reply and push calls of LineBotApi after a delay
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0):
+        super(LineApiStub, self).__init__(("127.0.0.1", port), LineApiStubHandler)
+        self.latency = latency
+        self.replies = dict()
+        self.pushes = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+    def record(self, path, payload):
+        with self._condition:
+            if path.endswith("/reply"):
+                self.replies[payload.get("replyToken")] = (time.time(), payload.get("messages", []))
+                self._condition.notify_all()
+            else:
+                self.pushes += 1
+
+    def wait_for_reply(self, reply_token, timeout):
+        """
+        :return: (time received, messages) of the reply, None if it did not arrive within timeout
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while reply_token not in self.replies:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+            return self.replies.pop(reply_token)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class LineApiStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            payload = {}
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.record(self.path, payload)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def is_error_reply(messages):
+    return any(any(text in m.get("text", "") for text in ERROR_TEXTS) for m in messages)
+
+
+class StepStats(object):
+    def __init__(self):
+        self.acknowledged = list()
+        self.replied = list()
+        self.http_errors = 0
+        self.timeouts = 0
+        self.error_replies = 0
+        self.lock = threading.Lock()
+
+    def report(self):
+        acknowledged = sorted(self.acknowledged)
+        replied = sorted(self.replied)
+        requests_sent = len(acknowledged) + self.http_errors
+        report = {"requests": requests_sent, "http_errors": self.http_errors, "timeouts": self.timeouts,
+                  "error_replies": self.error_replies,
+                  "error_rate": round((self.http_errors + self.timeouts + self.error_replies) / requests_sent, 4)
+                  if requests_sent else 0.0}
+        for name, values in (("ack", acknowledged), ("reply", replied)):
+            for p in (50, 95, 99):
+                value = percentile(values, p)
+                report["{0}_p{1}_ms".format(name, p)] = round(value * 1000, 2) if value is not None else None
+        return report
+
+
+class LoadTest(object):
+    def __init__(self, post, stub, channel_secret, users=10, dialogs=3, pairs=DEFAULT_PAIRS,
+                 departure_time=None, reply_timeout=10.0):
+        """
+        :param post: function posting (body, headers) to /callback and returning the status code
+        """
+        self.post = post
+        self.stub = stub
+        self.channel_secret = channel_secret
+        self.users = users
+        self.dialogs = dialogs
+        self.pairs = pairs
+        self.departure_time = departure_time or (datetime.now() + timedelta(hours=1)).replace(second=0,
+                                                                                               microsecond=0)
+        self.reply_timeout = reply_timeout
+        self.steps = OrderedDict((step, StepStats()) for step in STEPS)
+
+    def send(self, step, event):
+        stats = self.steps[step]
+        body = make_body([event])
+        headers = {"X-Line-Signature": sign(body, self.channel_secret), "Content-Type": "application/json"}
+        started = time.time()
+        try:
+            status = self.post(body, headers)
+        except Exception:
+            status = None
+        acknowledged = time.time()
+        with stats.lock:
+            if status != 200:
+                stats.http_errors += 1
+                return
+            stats.acknowledged.append(acknowledged - started)
+        reply = self.stub.wait_for_reply(event["replyToken"], self.reply_timeout)
+        with stats.lock:
+            if reply is None:
+                stats.timeouts += 1
+                return
+            stats.replied.append(reply[0] - started)
+            if is_error_reply(reply[1]):
+                stats.error_replies += 1
+
+    def run_user(self, index):
+        user_id = "U" + uuid.uuid4().hex
+        try:
+            for i in range(self.dialogs):
+                departure, destination = self.pairs[(index + i) % len(self.pairs)]
+                for step, event in dialog_events(user_id, departure, destination, self.departure_time,
+                                                 follow=(i == 0)):
+                    self.send(step, event)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+
+    def run(self):
+        started = time.time()
+        threads = [threading.Thread(target=self.run_user, args=(i,)) for i in range(self.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        steps = OrderedDict((step, stats.report()) for step, stats in self.steps.items() if
+                            stats.acknowledged or stats.http_errors)
+        total = sum(report["requests"] for report in steps.values())
+        return {"users": self.users, "dialogs": self.dialogs, "seconds": round(elapsed, 3), "requests": total,
+                "requests_per_second": round(total / elapsed, 2) if elapsed else 0.0,
+                "pushes": self.stub.pushes, "steps": steps}
+
+
+def http_poster(url):
+    session = requests.Session()
+
+    def post(body, headers):
+        return session.post(url, data=body.encode("utf-8"), headers=headers, timeout=30).status_code
+    return post
+
+
+def in_process_poster(stub):
+    """
+    Run the app in this process, sending to the stub
+    """
+    from app import create_app
+    app = create_app({"LINE_API_ENDPOINT": stub.url})
+    local = threading.local()
+
+    def post(body, headers):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        return local.client.post("/callback", data=body.encode("utf-8"), headers=headers).status_code
+    return post, app.config["CHANNEL_SECRET"]
+
+
+def print_report(result):
+    print("{0} requests in {1:.2f}s, {2:.2f} requests/s, {3} pushes".format(
+        result["requests"], result["seconds"], result["requests_per_second"], result["pushes"]))
+    print("{0:<12} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>8}".format(
+        "step", "requests", "ack p50", "ack p99", "reply p50", "reply p95", "reply p99", "errors"))
+    for step, report in result["steps"].items():
+        print("{0:<12} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10} {7:>7.2%}".format(
+            step, report["requests"], str(report["ack_p50_ms"]), str(report["ack_p99_ms"]),
+            str(report["reply_p50_ms"]), str(report["reply_p95_ms"]), str(report["reply_p99_ms"]),
+            report["error_rate"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive signed LINE dialogs against the webhook")
+    parser.add_argument("--url", help="URL of /callback, the app is run in this process without it")
+    parser.add_argument("--users", type=int, default=10, help="Users sending side by side")
+    parser.add_argument("--dialogs", type=int, default=3, help="Searches run by every user")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the stub waits before answering")
+    parser.add_argument("--stub-port", type=int, default=0, help="Port of the LINE API stub")
+    parser.add_argument("--departure-time", help="YYYY-MM-DDTHH:MM picked in the datetime postback")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Seconds to wait for a reply")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    stub = LineApiStub(args.stub_port, args.latency).start()
+    if args.url:
+        post, channel_secret = http_poster(args.url), os.environ["CHANNEL_SECRET"]
+    else:
+        post, channel_secret = in_process_poster(stub)
+    departure_time = datetime.strptime(args.departure_time, "%Y-%m-%dT%H:%M") if args.departure_time else None
+    try:
+        result = LoadTest(post, stub, channel_secret, args.users, args.dialogs, departure_time=departure_time,
+                          reply_timeout=args.timeout).run()
+    finally:
+        stub.stop()
+    print_report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+In-process counters, gauges and latency histograms, exported in the Prometheus text format.
+
+Metrics are created once by name and labels, e.g.
+
+    QUEUE_LATENCY = histogram("webhook_queue_seconds", "Time events wait in the webhook queue")
+    QUEUE_LATENCY.observe(0.02)
+    counter("webhook_events_total", "Handled events", labels={"event_type": "message"}).inc()
+
+Every gunicorn worker has its own metrics. With METRICS_DIR set, every process writes its metrics
+to a file of its own there every few seconds, and /metrics merges the files of every process:
+counters and histograms are added up, gauges are added up over the processes still running.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import traceback
+
+# Upper bounds in seconds, the last bucket counts everything
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+# Seconds between two writes of the metrics of a process
+DUMP_INTERVAL = 5
+
+_registry = dict()
+_registry_lock = threading.Lock()
+# Functions returning extra samples when collecting, see register_collector
+_collectors = list()
+_dumper = None
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, name, description="", labels=None):
+        self.name = name
+        self.description = description
+        self.labels = dict(labels or {})
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name, description="", labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = dict(labels or {})
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def snapshot(self):
+        """
+        :return: count, sum and the cumulative count of every bucket
+        """
+        with self._lock:
+            cumulative = list()
+            total = 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+            return {"count": self.count, "sum": self.sum, "buckets": list(zip(self.buckets, cumulative))}
+
+
+def _get_or_create(metric_class, name, description, labels, **kwargs):
+    key = (name, tuple(sorted((labels or {}).items())))
+    with _registry_lock:
+        metric = _registry.get(key)
+        if metric is None:
+            metric = _registry[key] = metric_class(name, description, labels, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError("Metric {0} is already a {1}".format(name, type(metric).__name__))
+        return metric
+
+
+def counter(name, description="", labels=None):
+    return _get_or_create(Counter, name, description, labels)
+
+
+def gauge(name, description="", labels=None):
+    return _get_or_create(Gauge, name, description, labels)
+
+
+def histogram(name, description="", buckets=DEFAULT_BUCKETS, labels=None):
+    return _get_or_create(Histogram, name, description, labels, buckets=buckets)
+
+
+def register_collector(collector):
+    """
+    :param collector: function returning a list of samples, i.e. dicts with name, type ("counter" or
+                      "gauge"), description, labels and value, computed when the metrics are collected
+    """
+    _collectors.append(collector)
+
+
+def collect():
+    """
+    :return: list of samples of this process, dicts with name, type, description, labels and the
+             snapshot of the metric
+    """
+    with _registry_lock:
+        metrics = list(_registry.values())
+    samples = list()
+    for metric in metrics:
+        sample = {"name": metric.name, "type": metric.type, "description": metric.description,
+                  "labels": metric.labels}
+        sample.update(metric.snapshot())
+        samples.append(sample)
+    for collector in _collectors:
+        try:
+            samples.extend(collector())
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+    return samples
+
+
+def dump(directory, pid=None):
+    """
+    Write the samples of this process to its file in directory
+    """
+    pid = pid or os.getpid()
+    path = os.path.join(directory, "metrics_{0}.json".format(pid))
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump({"pid": pid, "samples": collect()}, f)
+    os.replace(temporary, path)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(processes):
+    """
+    :param processes: list of {"pid": pid, "samples": samples}
+    :return: list of samples added up over the processes
+    """
+    merged = dict()
+    for process in processes:
+        running = None
+        for sample in process["samples"]:
+            if sample["type"] == "gauge":
+                if running is None:
+                    running = is_running(process["pid"])
+                if not running:
+                    continue
+            key = (sample["name"], tuple(sorted(sample["labels"].items())))
+            total = merged.get(key)
+            if total is None:
+                merged[key] = json.loads(json.dumps(sample))
+            elif sample["type"] == "histogram":
+                total["count"] += sample["count"]
+                total["sum"] += sample["sum"]
+                total["buckets"] = [[bound, count + other] for (bound, count), (_, other)
+                                    in zip(total["buckets"], sample["buckets"])]
+            else:
+                total["value"] += sample["value"]
+    return list(merged.values())
+
+
+def collect_all(directory=None):
+    """
+    :return: samples of every process writing to directory, of this process only without directory
+    """
+    if not directory:
+        return collect()
+    dump(directory)
+    processes = list()
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                processes.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return merge(processes)
+
+
+def start_dumper(directory, interval=DUMP_INTERVAL):
+    """
+    Write the metrics of this process to directory every interval seconds and at exit
+    """
+    global _dumper
+    os.makedirs(directory, exist_ok=True)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(directory)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+
+    with _registry_lock:
+        if _dumper is not None and _dumper.is_alive():
+            return
+        _dumper = threading.Thread(target=run, daemon=True)
+        _dumper.start()
+    atexit.register(dump, directory)
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of sorted values
+    """
+    if not values:
+        return None
+    rank = max(1, int(-(-p * len(values) // 100)))
+    return values[rank - 1]
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels, extra=None):
+    items = sorted(labels.items()) + list(extra or [])
+    if not items:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in items) + "}"
+
+
+def render(samples):
+    """
+    :return: samples in the Prometheus text format
+    """
+    lines = list()
+    described = set()
+    for sample in sorted(samples, key=lambda s: (s["name"], sorted(s["labels"].items()))):
+        name = sample["name"]
+        if name not in described:
+            described.add(name)
+            lines.append("# HELP {0} {1}".format(name, sample["description"]))
+            lines.append("# TYPE {0} {1}".format(name, sample["type"]))
+        labels = sample["labels"]
+        if sample["type"] == "histogram":
+            for bound, count in sample["buckets"]:
+                lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels, [("le", format_value(bound))]),
+                                                        count))
+            lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), format_value(sample["sum"])))
+            lines.append("{0}_count{1} {2}".format(name, format_labels(labels), sample["count"]))
+        else:
+            lines.append("{0}{1} {2}".format(name, format_labels(labels), format_value(sample["value"])))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,92 @@
+"""initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2018-06-10 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def create_questionstate_table(name):
+    op.create_table(name,
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('group', sa.String(length=100), nullable=True),
+                    sa.Column('user', sa.String(length=100), nullable=True),
+                    sa.Column('departure_station', sa.String(length=100), nullable=True),
+                    sa.Column('destination_station', sa.String(length=100), nullable=True),
+                    sa.Column('departure_time', sa.DateTime(), nullable=True),
+                    sa.Column('expired', sa.Boolean(), nullable=True),
+                    sa.Column('update', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+
+
+def create_timetable_tables(prefix, train_columns):
+    op.create_table('{0}_train'.format(prefix),
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('train_no', sa.String(length=10), nullable=True),
+                    *train_columns,
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('train_no'))
+    op.create_table('{0}_traintimetable'.format(prefix),
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('date', sa.Date(), nullable=True),
+                    sa.Column('train_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['train_id'], ['{0}_train.id'.format(prefix)]),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('{0}_tableentry'.format(prefix),
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('station_name', sa.String(length=50), nullable=True),
+                    sa.Column('arrival_time', sa.DateTime(), nullable=True),
+                    sa.Column('departure_time', sa.DateTime(), nullable=True),
+                    sa.Column('timetable_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['timetable_id'], ['{0}_traintimetable.id'.format(prefix)]),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('{0}_dataupdatestatus'.format(prefix),
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('assigned_date', sa.Date(), nullable=True),
+                    sa.Column('update_date', sa.Date(), nullable=True),
+                    sa.Column('status', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('assigned_date'))
+
+
+def upgrade():
+    create_questionstate_table('tra_questionstate')
+    create_questionstate_table('thsr_questionstate')
+    create_timetable_tables('tra', [sa.Column('train_type', sa.String(length=10), nullable=True)])
+    create_timetable_tables('thsr', [])
+    op.create_table('user',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('user_id', sa.String(length=100), nullable=True),
+                    sa.Column('following', sa.Boolean(), nullable=True),
+                    sa.Column('follow_datetime', sa.DateTime(), nullable=True),
+                    sa.Column('unfollow_datetime', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('group',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('group_id', sa.String(length=100), nullable=True),
+                    sa.Column('joinning', sa.Boolean(), nullable=True),
+                    sa.Column('join_datetime', sa.DateTime(), nullable=True),
+                    sa.Column('leave_datetime', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('group')
+    op.drop_table('user')
+    for prefix in ('thsr', 'tra'):
+        op.drop_table('{0}_dataupdatestatus'.format(prefix))
+        op.drop_table('{0}_tableentry'.format(prefix))
+        op.drop_table('{0}_traintimetable'.format(prefix))
+        op.drop_table('{0}_train'.format(prefix))
+    op.drop_table('thsr_questionstate')
+    op.drop_table('tra_questionstate')
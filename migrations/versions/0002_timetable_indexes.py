@@ -0,0 +1,38 @@
+"""indexes for the timetable search and the dialog lookups
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_tra_tableentry_timetable_station_departure', 'tra_tableentry',
+     ['timetable_id', 'station_name', 'departure_time']),
+    ('ix_thsr_tableentry_timetable_station_departure', 'thsr_tableentry',
+     ['timetable_id', 'station_name', 'departure_time']),
+    ('ix_tra_traintimetable_date_train', 'tra_traintimetable', ['date', 'train_id']),
+    ('ix_thsr_traintimetable_date_train', 'thsr_traintimetable', ['date', 'train_id']),
+    ('ix_tra_questionstate_user_expired', 'tra_questionstate', ['user', 'expired']),
+    ('ix_thsr_questionstate_user_expired', 'thsr_questionstate', ['user', 'expired']),
+    ('ix_user_user_id_following', 'user', ['user_id', 'following']),
+    ('ix_group_group_id_joinning', 'group', ['group_id', 'joinning']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
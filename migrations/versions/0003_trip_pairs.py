@@ -0,0 +1,40 @@
+"""origin-destination trip pairs built at ingest time
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for prefix in ('tra', 'thsr'):
+        table = '{0}_trippair'.format(prefix)
+        op.create_table(table,
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('date', sa.Date(), nullable=True),
+                        sa.Column('departure_station', sa.String(length=50), nullable=True),
+                        sa.Column('destination_station', sa.String(length=50), nullable=True),
+                        sa.Column('departure_time', sa.DateTime(), nullable=True),
+                        sa.Column('arrival_time', sa.DateTime(), nullable=True),
+                        sa.Column('timetable_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['timetable_id'], ['{0}_traintimetable.id'.format(prefix)]),
+                        sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_{0}_date_stations_departure'.format(table), table,
+                        ['date', 'departure_station', 'destination_station', 'departure_time'])
+
+
+def downgrade():
+    for prefix in ('thsr', 'tra'):
+        table = '{0}_trippair'.format(prefix)
+        op.drop_index('ix_{0}_date_stations_departure'.format(table), table_name=table)
+        op.drop_table(table)
@@ -0,0 +1,28 @@
+"""keep the last search result on question states
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('tra_questionstate', 'thsr_questionstate'):
+        op.add_column(table, sa.Column('search_result', sa.Text(), nullable=True))
+        op.add_column(table, sa.Column('result_cursor', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    for table in ('thsr_questionstate', 'tra_questionstate'):
+        op.drop_column(table, 'result_cursor')
+        op.drop_column(table, 'search_result')
@@ -0,0 +1,109 @@
+"""store every distinct stop list of a train once as a timetable pattern
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 00:00:00.000000
+
+Entries and trip pairs move from the timetables to the patterns and their times become minutes
+since the start of the service date. The timetables are downloaded again anyway, so instead of
+converting them the timetables are dropped and the building status is reset, the routine rebuilds
+every date on its next run.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+PREFIXES = ('tra', 'thsr')
+
+
+def clear_timetables(prefix):
+    op.drop_table('{0}_trippair'.format(prefix))
+    op.drop_table('{0}_tableentry'.format(prefix))
+    op.execute('DELETE FROM {0}_traintimetable'.format(prefix))
+    op.execute('DELETE FROM {0}_dataupdatestatus'.format(prefix))
+
+
+def upgrade():
+    for prefix in PREFIXES:
+        clear_timetables(prefix)
+        pattern_table = '{0}_timetablepattern'.format(prefix)
+        op.create_table(pattern_table,
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('stop_hash', sa.String(length=40), nullable=True),
+                        sa.Column('train_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['train_id'], ['{0}_train.id'.format(prefix)]),
+                        sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_{0}_train_hash'.format(pattern_table), pattern_table, ['train_id', 'stop_hash'])
+
+        timetable_table = '{0}_traintimetable'.format(prefix)
+        op.add_column(timetable_table, sa.Column('pattern_id', sa.Integer(), nullable=True))
+        op.create_foreign_key('{0}_pattern_id_fkey'.format(timetable_table), timetable_table, pattern_table,
+                              ['pattern_id'], ['id'])
+        op.create_index('ix_{0}_pattern_date'.format(timetable_table), timetable_table, ['pattern_id', 'date'])
+
+        entry_table = '{0}_tableentry'.format(prefix)
+        op.create_table(entry_table,
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('station_name', sa.String(length=50), nullable=True),
+                        sa.Column('arrival_minute', sa.Integer(), nullable=True),
+                        sa.Column('departure_minute', sa.Integer(), nullable=True),
+                        sa.Column('pattern_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['pattern_id'], ['{0}.id'.format(pattern_table)]),
+                        sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_{0}_pattern_station_departure'.format(entry_table), entry_table,
+                        ['pattern_id', 'station_name', 'departure_minute'])
+
+        pair_table = '{0}_trippair'.format(prefix)
+        op.create_table(pair_table,
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('departure_station', sa.String(length=50), nullable=True),
+                        sa.Column('destination_station', sa.String(length=50), nullable=True),
+                        sa.Column('departure_minute', sa.Integer(), nullable=True),
+                        sa.Column('arrival_minute', sa.Integer(), nullable=True),
+                        sa.Column('pattern_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['pattern_id'], ['{0}.id'.format(pattern_table)]),
+                        sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_{0}_stations_departure'.format(pair_table), pair_table,
+                        ['departure_station', 'destination_station', 'departure_minute'])
+
+
+def downgrade():
+    for prefix in reversed(PREFIXES):
+        clear_timetables(prefix)
+        timetable_table = '{0}_traintimetable'.format(prefix)
+        op.drop_index('ix_{0}_pattern_date'.format(timetable_table), table_name=timetable_table)
+        op.drop_constraint('{0}_pattern_id_fkey'.format(timetable_table), timetable_table, type_='foreignkey')
+        op.drop_column(timetable_table, 'pattern_id')
+        op.drop_table('{0}_timetablepattern'.format(prefix))
+
+        entry_table = '{0}_tableentry'.format(prefix)
+        op.create_table(entry_table,
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('station_name', sa.String(length=50), nullable=True),
+                        sa.Column('arrival_time', sa.DateTime(), nullable=True),
+                        sa.Column('departure_time', sa.DateTime(), nullable=True),
+                        sa.Column('timetable_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['timetable_id'], ['{0}.id'.format(timetable_table)]),
+                        sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_{0}_timetable_station_departure'.format(entry_table), entry_table,
+                        ['timetable_id', 'station_name', 'departure_time'])
+
+        pair_table = '{0}_trippair'.format(prefix)
+        op.create_table(pair_table,
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('date', sa.Date(), nullable=True),
+                        sa.Column('departure_station', sa.String(length=50), nullable=True),
+                        sa.Column('destination_station', sa.String(length=50), nullable=True),
+                        sa.Column('departure_time', sa.DateTime(), nullable=True),
+                        sa.Column('arrival_time', sa.DateTime(), nullable=True),
+                        sa.Column('timetable_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['timetable_id'], ['{0}.id'.format(timetable_table)]),
+                        sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_{0}_date_stations_departure'.format(pair_table), pair_table,
+                        ['date', 'departure_station', 'destination_station', 'departure_time'])
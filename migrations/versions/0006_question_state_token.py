@@ -0,0 +1,28 @@
+"""identify question states of dialog_store by a token
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('tra_questionstate', 'thsr_questionstate'):
+        op.add_column(table, sa.Column('token', sa.String(length=32), nullable=True))
+        op.create_index('ix_{0}_token'.format(table), table, ['token'])
+
+
+def downgrade():
+    for table in ('thsr_questionstate', 'tra_questionstate'):
+        op.drop_index('ix_{0}_token'.format(table), table_name=table)
+        op.drop_column(table, 'token')
@@ -0,0 +1,25 @@
+"""index question states by expired and update for the sweeper
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 00:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('tra_questionstate', 'thsr_questionstate'):
+        op.create_index('ix_{0}_expired_update'.format(table), table, ['expired', 'update'])
+
+
+def downgrade():
+    for table in ('thsr_questionstate', 'tra_questionstate'):
+        op.drop_index('ix_{0}_expired_update'.format(table), table_name=table)
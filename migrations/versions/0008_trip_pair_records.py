@@ -0,0 +1,44 @@
+"""record which patterns and dates have their trip pairs
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 00:00:00.000000
+
+A search on a date only uses the trip pairs when every pattern running on it has them, which
+depends on BUILD_TRA_TRIP_PAIRS of every build the patterns were created or reused by. The records
+of the patterns and dates already built are set from the trip pairs they have. A TRA pattern with
+no pair between TRA_TRIP_PAIR_STATIONS counts as missing them until the next build of its dates.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+PREFIXES = ('tra', 'thsr')
+
+
+def upgrade():
+    for prefix in PREFIXES:
+        op.add_column('{0}_timetablepattern'.format(prefix),
+                      sa.Column('trip_pairs_built', sa.Boolean(), nullable=True, server_default=sa.false()))
+        op.add_column('{0}_dataupdatestatus'.format(prefix),
+                      sa.Column('trip_pairs', sa.Boolean(), nullable=True, server_default=sa.false()))
+        op.execute('UPDATE {0}_timetablepattern SET trip_pairs_built = EXISTS '
+                   '(SELECT 1 FROM {0}_trippair WHERE {0}_trippair.pattern_id = {0}_timetablepattern.id)'
+                   .format(prefix))
+        op.execute('UPDATE {0}_dataupdatestatus SET trip_pairs = NOT EXISTS '
+                   '(SELECT 1 FROM {0}_traintimetable JOIN {0}_timetablepattern '
+                   'ON {0}_timetablepattern.id = {0}_traintimetable.pattern_id '
+                   'WHERE {0}_traintimetable.date = {0}_dataupdatestatus.assigned_date '
+                   'AND NOT {0}_timetablepattern.trip_pairs_built)'.format(prefix))
+
+
+def downgrade():
+    for prefix in PREFIXES:
+        op.drop_column('{0}_dataupdatestatus'.format(prefix), 'trip_pairs')
+        op.drop_column('{0}_timetablepattern'.format(prefix), 'trip_pairs_built')
@@ -0,0 +1,31 @@
+"""count the finished builds of every date
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 00:00:00.000000
+
+The status of a date is 2 between the trains of a rebuild too, so the index and the search cache
+of the web workers are stamped with the number of finished builds instead of the update date.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+PREFIXES = ('tra', 'thsr')
+
+
+def upgrade():
+    for prefix in PREFIXES:
+        op.add_column('{0}_dataupdatestatus'.format(prefix),
+                      sa.Column('build', sa.Integer(), nullable=True, server_default='0'))
+
+
+def downgrade():
+    for prefix in PREFIXES:
+        op.drop_column('{0}_dataupdatestatus'.format(prefix), 'build')
@@ -1,22 +1,73 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Date, Boolean
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String, DateTime, Date, Boolean, Index, Text
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship, backref
 
 Base = declarative_base()
 
 
+class TimetablePattern(object):
+    """
+    A distinct stop list of a train. Most trains run the same stops every day, so the entries of a
+    pattern are stored once and shared by the TrainTimeTable of every date the pattern runs on.
+    """
+    id = Column(Integer, primary_key=True)
+    # sha1 of the stop list, see build_database.hash_stops
+    stop_hash = Column(String(40))
+    # Whether the trip pairs of the pattern are created, a pattern can be reused by a build creating them
+    trip_pairs_built = Column(Boolean, default=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (Index("ix_{0}_train_hash".format(cls.__tablename__), "train_id", "stop_hash"),)
+
+    def __init__(self, stop_hash):
+        self.stop_hash = stop_hash
+
+
 class TableEntry(object):
+    """
+    Times are minutes since the start of the service date, stops after midnight are larger than 1440
+    """
     id = Column(Integer, primary_key=True)
     station_name = Column(String(50))
-    arrival_time = Column(DateTime)
-    departure_time = Column(DateTime)
+    arrival_minute = Column(Integer)
+    departure_minute = Column(Integer)
+
+    @declared_attr
+    def __table_args__(cls):
+        # Searches look up the stops of a pattern by station and departure time
+        return (Index("ix_{0}_pattern_station_departure".format(cls.__tablename__),
+                      "pattern_id", "station_name", "departure_minute"),)
 
-    def __init__(self, station_name, arrival_time, departure_time):
+    def __init__(self, station_name, arrival_minute, departure_minute):
         self.station_name = station_name
-        self.arrival_time = arrival_time
-        self.departure_time = departure_time
+        self.arrival_minute = arrival_minute
+        self.departure_minute = departure_minute
+
+
+class TripPair(object):
+    """
+    An ordered pair of stops of one pattern, emitted at ingest time so that a search is a single
+    range scan on (departure_station, destination_station, departure_minute)
+    """
+    id = Column(Integer, primary_key=True)
+    departure_station = Column(String(50))
+    destination_station = Column(String(50))
+    departure_minute = Column(Integer)
+    arrival_minute = Column(Integer)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (Index("ix_{0}_stations_departure".format(cls.__tablename__),
+                      "departure_station", "destination_station", "departure_minute"),)
+
+    def __init__(self, departure_station, destination_station, departure_minute, arrival_minute):
+        self.departure_station = departure_station
+        self.destination_station = destination_station
+        self.departure_minute = departure_minute
+        self.arrival_minute = arrival_minute
 
 
 class QuestionState(object):
@@ -28,6 +79,18 @@ class QuestionState(object):
     departure_time = Column(DateTime)
     expired = Column(Boolean)
     update = Column(DateTime)
+    # Ordered rows of the last search, see handlers.dump_search_result
+    search_result = Column(Text)
+    # Number of rows of search_result already shown
+    result_cursor = Column(Integer)
+    # Identifies the dialog in dialog_store, its changes are written to the row of the same token
+    token = Column(String(32))
+
+    @declared_attr
+    def __table_args__(cls):
+        return (Index("ix_{0}_user_expired".format(cls.__tablename__), "user", "expired"),
+                Index("ix_{0}_token".format(cls.__tablename__), "token"),
+                Index("ix_{0}_expired_update".format(cls.__tablename__), "expired", "update"))
 
     def __init__(self, group, user, departure_station="", destination_station="", departure_time=None,
                  expired=False):
@@ -45,12 +108,17 @@ class BuildingStatusOnDate(object):
         :param assigned_date : the date that this class is responsible for
         :param update_date : the latest update date
         :param status : 0: not built yet, 1: building, 2: built, 3: remove
+        :param trip_pairs : every pattern running on the date has its trip pairs,
+                            searches join the stops of the timetables otherwise
+        :param build : number of finished builds of the date, the version of its timetable
     """
 
     id = Column(Integer, primary_key=True)
     assigned_date = Column(Date, unique=True)
     update_date = Column(Date)
     status = Column(Integer)
+    trip_pairs = Column(Boolean, default=False)
+    build = Column(Integer, default=0)
 
     def __init__(self, assigned_date, update_date=None, status=0):
         self.assigned_date = assigned_date
@@ -69,7 +137,7 @@ class TRA_Train(Base):
     """
     1. This class represents each train according to its train number and train type.
     2. Every TRA_Train has only one TRA_TrainTimeTable on each dates and TRA_TrainTimeTable
-    may vary from date to date.
+    may vary from date to date. Dates with the same stops share one TRA_TimetablePattern.
     3. Call traintimetable attribute to access TRA_TrainTimeTable.
     """
     __tablename__ = 'tra_train'
@@ -83,30 +151,58 @@ class TRA_Train(Base):
         self.train_type = train_type
 
 
-class TRA_TrainTimeTable(Base):
+class TRA_TimetablePattern(TimetablePattern, Base):
     """
     Call ".entries" attribute to access TRA_TableEntry
     """
+    __tablename__ = 'tra_timetablepattern'
+
+    train_id = Column(Integer, ForeignKey('tra_train.id'))
+    train = relationship("TRA_Train",
+                         backref=backref("patterns", cascade="all, delete-orphan"))
+
+
+class TRA_TrainTimeTable(Base):
+    """
+    A TRA_TimetablePattern running on a date.
+    Call ".pattern.entries" attribute to access TRA_TableEntry
+    """
     __tablename__ = 'tra_traintimetable'
+    __table_args__ = (Index("ix_tra_traintimetable_date_train", "date", "train_id"),
+                      Index("ix_tra_traintimetable_pattern_date", "pattern_id", "date"))
 
     id = Column(Integer, primary_key=True)
     date = Column(Date)
     train_id = Column(Integer, ForeignKey('tra_train.id'))
     train = relationship("TRA_Train",
                          backref=backref("traintimetable", cascade="all, delete-orphan"))
+    pattern_id = Column(Integer, ForeignKey('tra_timetablepattern.id'))
+    pattern = relationship("TRA_TimetablePattern", backref="timetables")
 
-    def __init__(self, date):
+    def __init__(self, date, pattern=None):
         self.date = date
+        self.pattern = pattern
 
 
 class TRA_TableEntry(TableEntry, Base):
     __tablename__ = "tra_tableentry"
 
-    timetable_id = Column(Integer, ForeignKey('tra_traintimetable.id'))
-    timetable = relationship("TRA_TrainTimeTable",
-                             backref=backref("entries",
-                                             cascade="all, delete-orphan",
-                                             order_by='TRA_TableEntry.arrival_time'))
+    pattern_id = Column(Integer, ForeignKey('tra_timetablepattern.id'))
+    pattern = relationship("TRA_TimetablePattern",
+                           backref=backref("entries",
+                                           cascade="all, delete-orphan",
+                                           order_by='TRA_TableEntry.arrival_minute'))
+
+
+class TRA_TripPair(TripPair, Base):
+    """
+    Only built between TRA_TRIP_PAIR_STATIONS
+    """
+    __tablename__ = "tra_trippair"
+
+    pattern_id = Column(Integer, ForeignKey('tra_timetablepattern.id'))
+    pattern = relationship("TRA_TimetablePattern",
+                           backref=backref("trip_pairs", cascade="all, delete-orphan"))
 
 
 class TRA_BuildingStatusOnDate(BuildingStatusOnDate, Base):
@@ -130,27 +226,48 @@ class THSR_Train(Base):
         self.train_no = train_no
 
 
+class THSR_TimetablePattern(TimetablePattern, Base):
+    __tablename__ = 'thsr_timetablepattern'
+
+    train_id = Column(Integer, ForeignKey('thsr_train.id'))
+    train = relationship("THSR_Train",
+                         backref=backref("patterns", cascade="all, delete-orphan"))
+
+
 class THSR_TrainTimeTable(Base):
     __tablename__ = 'thsr_traintimetable'
+    __table_args__ = (Index("ix_thsr_traintimetable_date_train", "date", "train_id"),
+                      Index("ix_thsr_traintimetable_pattern_date", "pattern_id", "date"))
 
     id = Column(Integer, primary_key=True)
     date = Column(Date)
     train_id = Column(Integer, ForeignKey('thsr_train.id'))
     train = relationship("THSR_Train",
                          backref=backref("traintimetable", cascade="all, delete-orphan"))
+    pattern_id = Column(Integer, ForeignKey('thsr_timetablepattern.id'))
+    pattern = relationship("THSR_TimetablePattern", backref="timetables")
 
-    def __init__(self, date):
+    def __init__(self, date, pattern=None):
         self.date = date
+        self.pattern = pattern
 
 
 class THSR_TableEntry(TableEntry, Base):
     __tablename__ = "thsr_tableentry"
 
-    timetable_id = Column(Integer, ForeignKey('thsr_traintimetable.id'))
-    timetable = relationship("THSR_TrainTimeTable",
-                             backref=backref("entries",
-                                             cascade="all, delete-orphan",
-                                             order_by='THSR_TableEntry.arrival_time'))
+    pattern_id = Column(Integer, ForeignKey('thsr_timetablepattern.id'))
+    pattern = relationship("THSR_TimetablePattern",
+                           backref=backref("entries",
+                                           cascade="all, delete-orphan",
+                                           order_by='THSR_TableEntry.arrival_minute'))
+
+
+class THSR_TripPair(TripPair, Base):
+    __tablename__ = "thsr_trippair"
+
+    pattern_id = Column(Integer, ForeignKey('thsr_timetablepattern.id'))
+    pattern = relationship("THSR_TimetablePattern",
+                           backref=backref("trip_pairs", cascade="all, delete-orphan"))
 
 
 class THSR_BuildingStatusOnDate(BuildingStatusOnDate, Base):
@@ -164,6 +281,7 @@ Consider these classes as a method of recording User's and Group's activity.
 """
 class User(Base):
     __tablename__ = 'user'
+    __table_args__ = (Index("ix_user_user_id_following", "user_id", "following"),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(String(100))
@@ -180,6 +298,7 @@ class User(Base):
 
 class Group(Base):
     __tablename__ = 'group'
+    __table_args__ = (Index("ix_group_group_id_joinning", "group_id", "joinning"),)
 
     id = Column(Integer, primary_key=True)
     group_id = Column(String(100))
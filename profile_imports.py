@@ -0,0 +1,111 @@
+"""
+Profile the time it takes to import the modules the web workers start with.
+
+    python profile_imports.py
+    python profile_imports.py --modules handlers app --runs 5 --top 10 --output imports.json
+
+Every module is imported in a fresh interpreter without DATABASE_URI and the LINE credentials, so
+an import which connects, reads keys or needs the config fails here instead of slowing every worker
+start. The fastest of --runs imports is reported with the modules it loaded and the imports which
+took longest by themselves, excluding the imports they made. The packages of a dotted name which
+are not loaded yet count towards that name. The exit status is 1 when a module takes longer than its
+budget in IMPORT_BUDGETS.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+# Seconds, generous enough for a busy CI runner, the imports take about 0.4s on a laptop
+IMPORT_BUDGETS = {"utils": 1.0, "handlers": 2.0, "views": 2.0, "app": 2.0}
+# The config is read by app.create_app, importing must not need it
+UNSET_VARIABLES = ("DATABASE_URI", "CHANNEL_ACCESS_TOKEN", "CHANNEL_SECRET")
+
+# Run in the fresh interpreter, times every import of a module which is not loaded yet
+CHILD = """
+import sys, json, time, builtins, importlib
+_import = builtins.__import__
+imports = dict()
+children = [0.0]
+
+
+def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level or name in sys.modules:
+        return _import(name, globals, locals, fromlist, level)
+    children.append(0.0)
+    started = time.perf_counter()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - started
+        nested = children.pop()
+        children[-1] += elapsed
+        imports.setdefault(name, (elapsed, elapsed - nested))
+
+
+loaded = len(sys.modules)
+builtins.__import__ = timed_import
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - started
+builtins.__import__ = _import
+print(json.dumps({"seconds": seconds, "modules": len(sys.modules) - loaded,
+                  "imports": sorted(([k] + list(v) for k, v in imports.items()), key=lambda i: -i[2])}))
+"""
+
+
+def child_environment():
+    env = dict(os.environ)
+    for name in UNSET_VARIABLES:
+        env.pop(name, None)
+    return env
+
+
+def profile_import(module, runs=3):
+    """
+    :return: dict of the seconds of the fastest import of module in a fresh interpreter, the number
+             of modules it loaded and the list of (name, seconds, seconds by itself) of its imports
+    """
+    best = None
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", CHILD, module], cwd=ROOT, env=child_environment())
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    best["module"] = module
+    best["budget"] = IMPORT_BUDGETS.get(module)
+    return best
+
+
+def over_budget(result):
+    return result["budget"] is not None and result["seconds"] > result["budget"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import time of the modules of the web workers")
+    parser.add_argument("--modules", nargs="*", default=sorted(IMPORT_BUDGETS), help="Modules to import")
+    parser.add_argument("--runs", type=int, default=3, help="Imports of every module, the fastest is reported")
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports listed for every module")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = [profile_import(module, args.runs) for module in args.modules]
+    print("{0:<16} {1:>10} {2:>10} {3:>8}".format("module", "import ms", "budget ms", "modules"))
+    for result in results:
+        budget = "-" if result["budget"] is None else "{0:.0f}".format(result["budget"] * 1000)
+        print("{0:<16} {1:>10.1f} {2:>10} {3:>8}{4}".format(
+            result["module"], result["seconds"] * 1000, budget, result["modules"],
+            "  over budget" if over_budget(result) else ""))
+        for name, seconds, own in result["imports"][:args.top]:
+            print("    {0:<40} {1:>8.1f} ms by itself, {2:>8.1f} ms in total".format(name, own * 1000,
+                                                                                   seconds * 1000))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if any(over_budget(result) for result in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Logging of webhook deliveries.
+
+Only a sample of the deliveries is logged, as one structured line with the event types and the
+body cut to REQUEST_LOG_MAX_LENGTH characters. Ids of users, groups and rooms are replaced by a
+short hash, so lines of the same user can still be matched, and reply tokens are dropped.
+The whole event is logged when handling it failed.
+Records are handed to a queue and written to stdout by a background thread, so a worker never
+waits for the log.
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Fraction of the deliveries logged
+SAMPLE_RATE = float(os.getenv("REQUEST_LOG_SAMPLE_RATE", 0.01))
+MAX_LENGTH = int(os.getenv("REQUEST_LOG_MAX_LENGTH", 512))
+LOGGER_NAME = "webhook"
+ID_KEYS = ("userId", "groupId", "roomId")
+DROPPED_KEYS = ("replyToken",)
+
+_listener = None
+_lock = threading.Lock()
+
+
+def get_logger():
+    """
+    The logger writes through a queue, the listener thread is started on the first call
+    """
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    with _lock:
+        if _listener is None:
+            records = queue.Queue(-1)
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+            _listener = QueueListener(records, handler)
+            _listener.start()
+            atexit.register(_listener.stop)
+            logger.addHandler(QueueHandler(records))
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+    return logger
+
+
+def pseudonym(value):
+    return value[:1] + hashlib.sha1(value.encode("utf-8")).hexdigest()[:10]
+
+
+def redact(data):
+    """
+    :return: copy of the parsed JSON with ids hashed and reply tokens dropped
+    """
+    if isinstance(data, dict):
+        redacted = dict()
+        for key, value in data.items():
+            if key in DROPPED_KEYS:
+                continue
+            if key in ID_KEYS and isinstance(value, str):
+                redacted[key] = pseudonym(value)
+            else:
+                redacted[key] = redact(value)
+        return redacted
+    if isinstance(data, list):
+        return [redact(value) for value in data]
+    return data
+
+
+def truncate(text, max_length=MAX_LENGTH):
+    if len(text) <= max_length:
+        return text
+    return text[:max_length] + "...({0} more)".format(len(text) - max_length)
+
+
+def log_request(body, sample_rate=None):
+    """
+    :return: True if the delivery was sampled
+    """
+    sample_rate = SAMPLE_RATE if sample_rate is None else sample_rate
+    if random.random() >= sample_rate:
+        return False
+    try:
+        data = json.loads(body)
+    except ValueError:
+        get_logger().info(json.dumps({"invalid_body": truncate(body)}, ensure_ascii=False))
+        return True
+    events = data.get("events", []) if isinstance(data, dict) else []
+    record = {
+        "events": len(events),
+        "types": [event.get("type") for event in events if isinstance(event, dict)],
+        "body": truncate(json.dumps(redact(data), ensure_ascii=False)),
+    }
+    get_logger().info(json.dumps(record, ensure_ascii=False))
+    return True
+
+
+def log_failed_event(event):
+    """
+    Log the whole event which failed, ids are still hashed
+    :param event: linebot.models.Event
+    """
+    try:
+        data = redact(json.loads(event.as_json_string()))
+    except (TypeError, ValueError, AttributeError):
+        # Logging must not fail the handling of the other events
+        data = type(event).__name__
+    get_logger().error(json.dumps({"failed_event": data}, ensure_ascii=False))
@@ -3,16 +3,21 @@ import time
 from utils import convert_date_to_string
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
+from alembic import command
+from alembic.config import Config
 
 from build_database import (
     build_TRA_database_by_date, remove_TRA_timetable_by_date,
     build_THSR_database_by_date, remove_THSR_timetable_by_date
 )
 from models import (
-    Base, TRA_BuildingStatusOnDate, THSR_BuildingStatusOnDate
+    TRA_BuildingStatusOnDate, THSR_BuildingStatusOnDate
 )
+from dialog_store import DIALOG_STATE_TTL, expire_stale_rows, delete_expired_rows
+from database import instrument_engine, count_queries, warn_repeated_queries, wait_for_database
+from slow_query_log import enable_slow_query_log
 
 # Load env variables
 dotenv_path = os.path.join(os.getcwd(), '.env')
@@ -24,12 +29,41 @@ try:
 except KeyError:
     raise KeyError("Please specify DATABASE_URI in environment")
 
-time.sleep(10)  # wait for postgresql to start
-engine = create_engine(DATABASE_URI)
-Base.metadata.create_all(engine)
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "migrations")
+# The revision matching the tables created by Base.metadata.create_all before migrations were added
+INITIAL_REVISION = "0001"
+# Question states untouched for this long are expired, expired ones are deleted after the retention
+QUESTION_STATE_TTL = timedelta(hours=int(os.getenv("QUESTION_STATE_TTL_HOURS",
+                                                   DIALOG_STATE_TTL.total_seconds() // 3600)))
+QUESTION_STATE_RETENTION = timedelta(days=int(os.getenv("QUESTION_STATE_RETENTION_DAYS", 30)))
+
+
+def upgrade_database(engine):
+    """
+    Bring the schema to the latest migration.
+    A database created before migrations existed is stamped with the initial revision first.
+    """
+    config = Config(os.path.join(MIGRATIONS_DIR, "alembic.ini"))
+    config.set_main_option("script_location", MIGRATIONS_DIR)
+    config.set_main_option("sqlalchemy.url", DATABASE_URI)
+    tables = inspect(engine).get_table_names()
+    if tables and "alembic_version" not in tables:
+        command.stamp(config, INITIAL_REVISION)
+    command.upgrade(config, "head")
+
+
+engine = instrument_engine(create_engine(DATABASE_URI))
+enable_slow_query_log(engine)
+if not wait_for_database(engine):
+    raise RuntimeError("Database at DATABASE_URI is not reachable")
+upgrade_database(engine)
 Session = sessionmaker(bind=engine)
 
 
+def format_query_stats(stats):
+    return "{0} statements in {1:.2f}s".format(stats.count, stats.seconds)
+
+
 def build_TRA():
     """
     台鐵提供近60天每日時刻表
@@ -42,9 +76,11 @@ def build_TRA():
     for i in range(60):
         d = today + timedelta(i)
         print("Start building TRA DATABASE on {0}".format(convert_date_to_string(d)))
-        resp = build_TRA_database_by_date(d, session)
-        print("Finish TRA DATABASE on {0}, result={1}".format(convert_date_to_string(d),
-                                                              resp.message))
+        with count_queries() as stats:
+            resp = build_TRA_database_by_date(d, session)
+        print("Finish TRA DATABASE on {0}, result={1}, {2}".format(convert_date_to_string(d),
+                                                                   resp.message, format_query_stats(stats)))
+        warn_repeated_queries(stats, "TRA DATABASE on {0}".format(convert_date_to_string(d)))
     session.close()
 
 
@@ -69,9 +105,11 @@ def build_THSR():
     for i in range(45):
         d = today + timedelta(i)
         print("Start building THSR DATABASE on {0}".format(convert_date_to_string(d)))
-        resp = build_THSR_database_by_date(d, session)
-        print("Finish THSR DATABASE on {0}, result={1}".format(convert_date_to_string(d),
-                                                               resp.message))
+        with count_queries() as stats:
+            resp = build_THSR_database_by_date(d, session)
+        print("Finish THSR DATABASE on {0}, result={1}, {2}".format(convert_date_to_string(d),
+                                                                    resp.message, format_query_stats(stats)))
+        warn_repeated_queries(stats, "THSR DATABASE on {0}".format(convert_date_to_string(d)))
     session.close()
 
 
@@ -87,10 +125,26 @@ def clear_THSR_history():
     session.close()
 
 
+def sweep_question_states():
+    """
+    Expire abandoned question states and delete the old expired ones
+    """
+    session = Session()
+    started = time.time()
+    now = datetime.now()
+    try:
+        expired = expire_stale_rows(session, now - QUESTION_STATE_TTL)
+        deleted = delete_expired_rows(session, now - QUESTION_STATE_RETENTION)
+    finally:
+        session.close()
+    print("Swept question states: expired={0}, deleted={1}, took {2:.2f}s".format(expired, deleted,
+                                                                                 time.time() - started))
+
+
 # 24-HOUR
 RUN_JOBS_AT_TIME = "00:00"
 # Specify periodic jobs here
-JOB_QUEUE = [build_TRA, clear_TRA_history, build_THSR, clear_THSR_history]
+JOB_QUEUE = [build_TRA, clear_TRA_history, build_THSR, clear_THSR_history, sweep_question_states]
 
 
 def run_all_job():
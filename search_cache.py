@@ -0,0 +1,121 @@
+"""
+Bounded LRU cache of search results.
+
+Results are cached per (train type, departure station, destination station, service date,
+departure time bucket), so every search starting within the same bucket shares one entry and is
+filtered down to its exact departure time. Every entry carries the version of the timetable it was
+computed from (see timetable_index.get_timetable_version), a rebuilt date therefore misses. Dates
+are rebuilt by the routine container, not by the web workers, so the version is what invalidates.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, time
+
+from timetable_index import IndexedTrain, IndexedTimetable, IndexedEntry
+from metrics import register_collector
+
+CACHE_MAX_SIZE = 2048
+BUCKET_MINUTES = 10
+
+
+class CachedTrip(object):
+    __slots__ = ("timetable_id", "train_no", "train_type", "departure", "arrival")
+
+    def __init__(self, timetable_id, train_no, train_type, departure, arrival):
+        self.timetable_id = timetable_id
+        self.train_no = train_no
+        self.train_type = train_type
+        # minutes since the start of the service date
+        self.departure = departure
+        self.arrival = arrival
+
+
+class SearchResultCache(object):
+    def __init__(self, max_size=CACHE_MAX_SIZE, bucket_minutes=BUCKET_MINUTES):
+        self.max_size = max_size
+        self.bucket_minutes = bucket_minutes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket_of(self, minute):
+        return minute - minute % self.bucket_minutes
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, trips):
+        with self._lock:
+            self._entries[key] = (version, trips)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+            }
+
+
+def compact_trips(service_date, suitable_trains):
+    """
+    Keep only what rendering needs, ORM objects must not outlive their session
+    """
+    start = datetime.combine(service_date, time(0))
+    trips = list()
+    for t, dep_entry, dest_entry in suitable_trains:
+        trips.append(CachedTrip(t.id, t.train.train_no, getattr(t.train, "train_type", None),
+                                int((dep_entry.departure_time - start).total_seconds() // 60),
+                                int((dest_entry.arrival_time - start).total_seconds() // 60)))
+    return trips
+
+
+def expand_trips(service_date, departure_station, destination_station, trips):
+    """
+    Turn cached trips back into [timetable, dep_entry, dest_entry].
+    The departure entry only has its departure time and the destination entry its arrival time.
+    """
+    start = datetime.combine(service_date, time(0))
+    suitable_trains = list()
+    for trip in trips:
+        timetable = IndexedTimetable(trip.timetable_id, service_date, IndexedTrain(trip.train_no, trip.train_type))
+        suitable_trains.append([
+            timetable,
+            IndexedEntry(departure_station, None, start + timedelta(minutes=trip.departure)),
+            IndexedEntry(destination_station, start + timedelta(minutes=trip.arrival), None)
+        ])
+    return suitable_trains
+
+
+def collect_cache_metrics():
+    stats = search_cache.stats()
+    return [
+        {"name": "search_cache_hits_total", "type": "counter", "description": "Searches answered from the cache",
+         "labels": {}, "value": stats["hits"]},
+        {"name": "search_cache_misses_total", "type": "counter", "description": "Searches missing the cache",
+         "labels": {}, "value": stats["misses"]},
+        {"name": "search_cache_entries", "type": "gauge", "description": "Entries in the search cache",
+         "labels": {}, "value": stats["size"]},
+    ]
+
+
+search_cache = SearchResultCache()
+register_collector(collect_cache_metrics)
@@ -0,0 +1,214 @@
+"""
+Log of the statements slower than SLOW_QUERY_MS, with their query plan.
+
+Every slow statement is written as one JSON line to a rotating file of the process, SLOW_QUERY_LOG
+with the pid before its extension, e.g. slow_queries.1234.log, since a file rotated by several
+gunicorn workers loses records. A line holds the time of the statement, its shape (see
+database.statement_shape), the statement, its parameters with strings replaced by a short hash
+and, for a SELECT on postgres, the plan of a follow-up EXPLAIN. The EXPLAIN runs in a savepoint so
+a failing one never breaks the transaction of the statement.
+SLOW_QUERY_EXPLAIN_ANALYZE=True runs EXPLAIN ANALYZE instead, which runs the statement again.
+
+The worst statement shapes of the files of every process are summarized by
+
+    python slow_query_log.py --file slow_queries.log --top 10
+"""
+import os
+import sys
+import json
+import time
+import glob
+import logging
+import argparse
+import traceback
+from datetime import datetime, date
+from logging.handlers import RotatingFileHandler
+from sqlalchemy import event
+
+from database import statement_shape
+from request_log import pseudonym
+
+# Statements taking at least this many milliseconds are logged, none with 0
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", 500))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "slow_queries.log")
+SLOW_QUERY_EXPLAIN_ANALYZE = os.getenv("SLOW_QUERY_EXPLAIN_ANALYZE") == "True"
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+LOGGER_NAME = "slow_query"
+
+
+class SlowQueryLog(object):
+    def __init__(self, path=SLOW_QUERY_LOG, threshold_ms=SLOW_QUERY_MS, analyze=SLOW_QUERY_EXPLAIN_ANALYZE):
+        self.path = path
+        self.threshold = threshold_ms / 1000
+        self.analyze = analyze
+        self._pid = None
+        self._logger = None
+
+    @property
+    def logger(self):
+        # Opened by the process writing, a log created before gunicorn forks gets a file per worker
+        pid = os.getpid()
+        if self._pid != pid:
+            self._logger = open_logger(process_log_path(self.path, pid))
+            self._pid = pid
+        return self._logger
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_started", []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.time() - conn.info["slow_query_started"].pop()
+        if seconds < self.threshold:
+            return
+        try:
+            self.record(conn, statement, parameters, seconds, executemany)
+        except Exception:
+            # The log must never fail the statement
+            traceback.print_exc(file=sys.stdout)
+
+    def record(self, conn, statement, parameters, seconds, executemany=False):
+        plan = None
+        if not executemany and conn.dialect.name == "postgresql" and is_select(statement):
+            plan = self.explain(conn, statement, parameters)
+        self.logger.info(json.dumps({
+            "time": datetime.now().isoformat(),
+            "seconds": round(seconds, 4),
+            "shape": statement_shape(statement),
+            "statement": statement,
+            "parameters": redact_parameters(parameters),
+            "plan": plan,
+        }, ensure_ascii=False))
+
+    def explain(self, conn, statement, parameters):
+        """
+        :return: lines of the plan, None if EXPLAIN failed
+        """
+        prefix = "EXPLAIN ANALYZE " if self.analyze else "EXPLAIN "
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = [row[0] for row in cursor.fetchall()]
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                plan = None
+            cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        finally:
+            cursor.close()
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        return self
+
+
+def process_log_path(path, pid=None):
+    root, extension = os.path.splitext(path)
+    return "{0}.{1}{2}".format(root, pid or os.getpid(), extension)
+
+
+def open_logger(path):
+    logger = logging.getLogger("{0}.{1}".format(LOGGER_NAME, path))
+    if not logger.handlers:
+        handler = RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding="utf-8",
+                                      delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def is_select(statement):
+    return statement.lstrip().upper().startswith(("SELECT", "WITH"))
+
+
+def redact_value(value):
+    if isinstance(value, str):
+        return pseudonym(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return type(value).__name__
+
+
+def redact_parameters(parameters):
+    if isinstance(parameters, dict):
+        return {key: redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact_parameters(value) if isinstance(value, (dict, list, tuple)) else redact_value(value)
+                for value in parameters]
+    return redact_value(parameters)
+
+
+def enable_slow_query_log(engine, path=None, threshold_ms=None):
+    """
+    Log the slow statements of engine, nothing is logged if the threshold is 0
+    :return: SlowQueryLog, None if disabled
+    """
+    threshold_ms = SLOW_QUERY_MS if threshold_ms is None else threshold_ms
+    if threshold_ms <= 0:
+        return None
+    return SlowQueryLog(path or SLOW_QUERY_LOG, threshold_ms).attach(engine)
+
+
+def read_records(path):
+    """
+    Records of the files of every process and of their rotated files, unreadable lines are skipped
+    """
+    root, extension = os.path.splitext(path)
+    names = list()
+    for base in [path] + sorted(glob.glob(glob.escape(root) + ".[0-9]*" + glob.escape(extension))):
+        for name in [base] + sorted(glob.glob(glob.escape(base) + ".[0-9]*")):
+            if name not in names and os.path.exists(name):
+                names.append(name)
+    for name in names:
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize(records):
+    """
+    :return: list of dicts per statement shape, the largest total time first
+    """
+    shapes = dict()
+    for record in records:
+        summary = shapes.get(record["shape"])
+        if summary is None:
+            summary = shapes[record["shape"]] = {"shape": record["shape"], "count": 0, "total": 0.0,
+                                                 "max": 0.0, "plan": None}
+        summary["count"] += 1
+        summary["total"] += record["seconds"]
+        if record["seconds"] >= summary["max"]:
+            summary["max"] = record["seconds"]
+            summary["plan"] = record.get("plan") or summary["plan"]
+    return sorted(shapes.values(), key=lambda s: s["total"], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the worst statement shapes of the slow query log")
+    parser.add_argument("--file", default=SLOW_QUERY_LOG,
+                        help="SLOW_QUERY_LOG, the files of every process and their rotated files are read")
+    parser.add_argument("--top", type=int, default=10, help="number of statement shapes shown")
+    parser.add_argument("--plans", action="store_true", help="show the plan of the slowest run of every shape")
+    args = parser.parse_args()
+
+    for i, summary in enumerate(summarize(read_records(args.file))[:args.top], 1):
+        print("{0}. {1} runs, total {2:.2f}s, mean {3:.3f}s, max {4:.3f}s".format(
+            i, summary["count"], summary["total"], summary["total"] / summary["count"], summary["max"]))
+        print("   " + summary["shape"])
+        if args.plans and summary["plan"]:
+            print("\n".join("      " + line for line in summary["plan"]))
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Resolve station names in free text.
+
+Station names and their aliases are kept in a prefix trie built once at import, so a lookup walks
+the text once and always prefers the longest name, e.g. "臺中港" over "臺中".
+A name is only looked for anywhere in the text of a chat with the bot. In a group the whole text,
+without NOISE_WORDS, has to be a name, so a sentence mentioning a city is not taken for an answer.
+Text which does not contain a name is matched against a bigram index of the names to deal with
+typos, the closest names are offered when more than one is equally close.
+"""
+from collections import Counter
+
+from data import TRA_STATION_CODE2NAME, THSR_STATION_CODE2NAME, TRA_TRIP_PAIR_STATIONS
+from utils import pre_process_text
+
+# Key of a trie node holding the station name ending at that node
+END = None
+# Names are padded before taking bigrams so that a name of two characters still shares one with a typo
+PAD_START = "^"
+PAD_END = "$"
+# Words around a station name which are not part of it
+NOISE_WORDS = ["火車站", "高鐵站", "車站", "高鐵", "臺鐵", "站"]
+# Longer text is a sentence rather than a mistyped name
+MAX_FUZZY_LENGTH = 6
+MAX_EDIT_DISTANCE = 1
+MAX_CANDIDATES = 3
+
+TRA_STATION_ALIASES = {
+    "北車": "臺北",
+}
+THSR_STATION_ALIASES = {
+    "高雄": "左營",
+    "新左營": "左營",
+    "北車": "臺北",
+    "烏日": "臺中",
+    "新烏日": "臺中",
+    "竹北": "新竹",
+    "六家": "新竹",
+    "沙崙": "臺南",
+    "豐富": "苗栗",
+    "中壢": "桃園",
+    "青埔": "桃園",
+}
+
+
+class StationTrie(object):
+    def __init__(self, names, aliases=None):
+        """
+        :param aliases: alias -> station name
+        """
+        self.root = dict()
+        for name in names:
+            self.add(name, name)
+        for alias, name in (aliases or {}).items():
+            self.add(alias, name)
+
+    def add(self, key, name):
+        node = self.root
+        for char in pre_process_text(key):
+            node = node.setdefault(char, dict())
+        node[END] = name
+
+    def longest_prefix(self, text, start=0):
+        """
+        :param text: text processed by pre_process_text
+        :return: (station name, end of the match) of the longest name starting at start,
+                 (None, start) if there is none
+        """
+        node = self.root
+        result = (None, start)
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+            if END in node:
+                result = (node[END], i + 1)
+        return result
+
+    def match(self, text):
+        """
+        :return: the station name the text starts with, None if it does not start with one
+        """
+        return self.longest_prefix(pre_process_text(text))[0]
+
+    def scan(self, text):
+        """
+        Find the station names anywhere in the text, from left to right without overlapping
+        :return: list of (start, end, station name)
+        """
+        text = pre_process_text(text)
+        found = list()
+        i = 0
+        while i < len(text):
+            name, end = self.longest_prefix(text, i)
+            if name is None:
+                i += 1
+                continue
+            found.append((i, end, name))
+            i = end
+        return found
+
+
+def bigrams(text):
+    text = PAD_START + text + PAD_END
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+class StationIndex(object):
+    """
+    Station names of one train type with their trie and bigram index
+    """
+    def __init__(self, names, aliases=None, major_stations=None):
+        """
+        :param aliases: alias -> station name, aliases have to be typed exactly
+        :param major_stations: offered first among equally close names
+        """
+        self.names = list(dict.fromkeys(names))
+        major_stations = major_stations if major_stations is not None else self.names
+        # Rank of the names among equally close candidates
+        self.order = {name: (name not in major_stations, i) for i, name in enumerate(self.names)}
+        self.trie = StationTrie(self.names, aliases)
+        # bigram -> station names containing it
+        self.bigram_index = dict()
+        for name in self.names:
+            for bigram in bigrams(pre_process_text(name)):
+                self.bigram_index.setdefault(bigram, set()).add(name)
+
+    def resolve(self, text, anywhere=True):
+        """
+        :param anywhere: find names anywhere in the text, otherwise the text is a name or a typo of one
+        :return: list of station names, a single name if the text is resolved, up to MAX_CANDIDATES
+                 names if it is ambiguous, empty if nothing is close enough
+        """
+        text = pre_process_text(text).strip()
+        if anywhere:
+            name = self.trie.longest_prefix(text)[0]
+            if name:
+                return [name]
+            found = list(dict.fromkeys(name for _, _, name in self.trie.scan(text)))
+            if found:
+                return found[:MAX_CANDIDATES]
+        for word in NOISE_WORDS:
+            text = text.replace(word, "")
+        if not anywhere:
+            name, end = self.trie.longest_prefix(text)
+            if name and end == len(text):
+                return [name]
+        if not text or len(text) > MAX_FUZZY_LENGTH:
+            return []
+        return self.fuzzy_match(text)
+
+    def fuzzy_match(self, text):
+        overlaps = Counter()
+        for bigram in bigrams(text):
+            for name in self.bigram_index.get(bigram, ()):
+                overlaps[name] += 1
+        ranked = list()
+        for name, overlap in overlaps.items():
+            distance = edit_distance(text, pre_process_text(name))
+            if distance <= MAX_EDIT_DISTANCE:
+                ranked.append(((distance, -overlap), self.order[name], name))
+        ranked.sort()
+        # Only a single closest name is a match, otherwise let the user choose
+        if len(ranked) > 1 and ranked[0][0] < ranked[1][0]:
+            return [ranked[0][2]]
+        return [name for _, _, name in ranked[:MAX_CANDIDATES]]
+
+    def match(self, text, anywhere=True):
+        """
+        :return: the station name if the text resolves to exactly one, otherwise None
+        """
+        names = self.resolve(text, anywhere)
+        return names[0] if len(names) == 1 else None
+
+
+TRA_STATIONS = StationIndex(TRA_STATION_CODE2NAME.values(), TRA_STATION_ALIASES, TRA_TRIP_PAIR_STATIONS)
+THSR_STATIONS = StationIndex(THSR_STATION_CODE2NAME.values(), THSR_STATION_ALIASES)
@@ -1,7 +1,27 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load envirnoment variables
 dotenv_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path=dotenv_path)
+
+# Files of the test apps, e.g. the dialog store, removed when the tests end
+test_directory = tempfile.TemporaryDirectory()
+
+
+def create_test_app(config=None):
+    """
+    App on the testing database with its dialog store in a file of this run, the LINE credentials
+    are only needed to build the clients
+    """
+    from app import create_app
+    test_config = {
+        "DATABASE_URI": os.environ["TESTING_DATABASE_URI"],
+        "CHANNEL_ACCESS_TOKEN": os.getenv("CHANNEL_ACCESS_TOKEN") or "testing",
+        "CHANNEL_SECRET": os.getenv("CHANNEL_SECRET") or "testing",
+        "DIALOG_STORE_PATH": os.path.join(test_directory.name, "dialog_state.sqlite3"),
+    }
+    test_config.update(config or {})
+    return create_app(test_config)
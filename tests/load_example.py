@@ -4,9 +4,12 @@ from build_database import (
     request_TRA_all_train_timetable_by_date,
     build_TRA_traintimetable, check_TRA_building_status_by_date,
     request_THSR_all_train_timetable, check_THSR_building_status_by_date,
-    build_THSR_traintimetable
+    build_THSR_traintimetable, record_finished_build
+)
+from models import (
+    Base, TRA_TrainTimeTable, TRA_TimetablePattern, TRA_BuildingStatusOnDate,
+    THSR_TrainTimeTable, THSR_TimetablePattern, THSR_BuildingStatusOnDate
 )
-from models import Base
 
 FILENAME_FORMAT = "{0}-all-{1}-trains-timetable.pickle"
 
@@ -71,11 +74,14 @@ def load_example_timetable_to_database(session, date_input, train_type="TRA"):
         check_TRA_building_status_by_date(date_input, session)
         for timetable in loader:
             build_TRA_traintimetable(timetable, session, date_input)
+        record_finished_build(date_input, TRA_TrainTimeTable, TRA_TimetablePattern, TRA_BuildingStatusOnDate, session)
 
     elif train_type == "THSR":
         check_THSR_building_status_by_date(date_input, session)
         for timetable in loader:
             build_THSR_traintimetable(timetable, session, date_input)
+        record_finished_build(date_input, THSR_TrainTimeTable, THSR_TimetablePattern, THSR_BuildingStatusOnDate,
+                              session)
     session.commit()
 
 
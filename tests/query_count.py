@@ -0,0 +1,19 @@
+from contextlib import contextmanager
+
+from database import instrument_engine, count_queries
+
+
+@contextmanager
+def assert_max_queries(n, bind):
+    """
+    Fail if more than n statements are sent to the engine inside the with block, e.g.
+
+        with assert_max_queries(1, engine) as stats:
+            request_TRA_matching_train(qs)
+    """
+    instrument_engine(bind)
+    with count_queries() as stats:
+        yield stats
+    if stats.count > n:
+        shapes = "\n".join("{0} x {1}".format(runs, shape) for shape, runs in stats.shapes.most_common())
+        raise AssertionError("{0} statements run, expected at most {1}:\n{2}".format(stats.count, n, shapes))
@@ -0,0 +1,28 @@
+import unittest
+from datetime import date
+from unittest.mock import patch
+
+from benchmark_search import run_benchmark, ENGINES
+from search_cache import search_cache
+
+
+class TestCase_for_benchmark_search(unittest.TestCase):
+    def test_engines_agree_with_sql(self):
+        output = run_benchmark("sqlite://", rounds=2, dates={"THSR": date(2018, 6, 5)})
+        self.assertEqual(list(output["engines"]), [name for name, _ in ENGINES])
+        for name, differences in output["differences"].items():
+            self.assertEqual(differences, [], name)
+        sql = output["engines"]["sql"]
+        self.assertGreater(sql["trains_per_search"], 0)
+        self.assertEqual(sql["statements_per_search"], 1)
+        self.assertLessEqual(sql["p50_ms"], sql["p95_ms"])
+        self.assertLessEqual(sql["p95_ms"], sql["p99_ms"])
+
+    def test_results_served_from_the_cache_are_compared(self):
+        def get(key, version):
+            # Every hit loses its trains
+            return [] if key in search_cache._entries else None
+        with patch.object(search_cache, "get", side_effect=get):
+            output = run_benchmark("sqlite://", rounds=2, engines=["cached"], dates={"THSR": date(2018, 6, 5)})
+        rounds = {difference["round"] for difference in output["differences"]["cached"]}
+        self.assertEqual(rounds, {1})
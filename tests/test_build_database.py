@@ -5,11 +5,15 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from datetime import date
 from models import (
-    Base, THSR_TrainTimeTable, THSR_TableEntry, THSR_Train, THSR_BuildingStatusOnDate,
-    TRA_TrainTimeTable, TRA_Train, TRA_TableEntry, TRA_BuildingStatusOnDate
+    Base, THSR_TrainTimeTable, THSR_TableEntry, THSR_Train, THSR_BuildingStatusOnDate, THSR_TripPair,
+    THSR_TimetablePattern, TRA_TrainTimeTable, TRA_Train, TRA_TableEntry, TRA_BuildingStatusOnDate, TRA_TripPair,
+    TRA_TimetablePattern
 )
-from build_database import build_THSR_database_by_date, build_TRA_database_by_date
+import build_database
+from build_database import build_THSR_database_by_date, build_TRA_database_by_date, remove_THSR_timetable_by_date
+from timetable_index import get_timetable_version
 from .load_example import drop_all_table, TimeTableExampleLoader, load_example_timetable_to_database
+from .query_count import assert_max_queries
 
 engine = create_engine(os.environ["TESTING_DATABASE_URI"])
 Session = sessionmaker(bind=engine)
@@ -39,10 +43,13 @@ class TestCase_for_build_TRA_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(TRA_Train).count(), 902)
         self.assertEqual(self.session.query(TRA_TrainTimeTable).count(), 902)
+        self.assertEqual(self.session.query(TRA_TimetablePattern).count(), 902)
         self.assertEqual(self.session.query(TRA_TableEntry).count(), 18319)
+        self.assertEqual(self.session.query(TRA_TripPair).count(), 32872)
         update_status = self.session.query(TRA_BuildingStatusOnDate).one()
         self.assertEqual(update_status.assigned_date, date_input)
         self.assertEqual(update_status.status, 2)
+        self.assertTrue(update_status.trip_pairs)
         # Input second day data
         date_input_2 = date(2018, 6, 6)
         loader = TimeTableExampleLoader(date_input_2)
@@ -54,7 +61,10 @@ class TestCase_for_build_TRA_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(TRA_Train).count(), 940)
         self.assertEqual(self.session.query(TRA_TrainTimeTable).count(), 1811)
-        self.assertEqual(self.session.query(TRA_TableEntry).count(), 36771)
+        # Most trains run the same stops on both dates
+        self.assertEqual(self.session.query(TRA_TimetablePattern).count(), 943)
+        self.assertEqual(self.session.query(TRA_TableEntry).count(), 18965)
+        self.assertEqual(self.session.query(TRA_TripPair).count(), 34260)
         self.assertEqual(self.session.query(TRA_BuildingStatusOnDate).count(), 2)
 
         # Build second day data again
@@ -62,9 +72,34 @@ class TestCase_for_build_TRA_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(TRA_Train).count(), 940)
         self.assertEqual(self.session.query(TRA_TrainTimeTable).count(), 1811)
-        self.assertEqual(self.session.query(TRA_TableEntry).count(), 36771)
+        # Most trains run the same stops on both dates
+        self.assertEqual(self.session.query(TRA_TimetablePattern).count(), 943)
+        self.assertEqual(self.session.query(TRA_TableEntry).count(), 18965)
+        self.assertEqual(self.session.query(TRA_TripPair).count(), 34260)
         self.assertEqual(self.session.query(TRA_BuildingStatusOnDate).count(), 2)
 
+    @patch("build_database.request_TRA_all_train_timetable_by_date")
+    def test_trip_pairs_switched_on_between_builds(self, mock_request):
+        date_input, date_input_2 = date(2018, 6, 2), date(2018, 6, 6)
+        mock_request.return_value = list(TimeTableExampleLoader(date_input))
+        with patch("build_database.BUILD_TRA_TRIP_PAIRS", False):
+            self.assertEqual(build_TRA_database_by_date(date_input, self.session).value, 0)
+        self.assertEqual(self.session.query(TRA_TripPair).count(), 0)
+        status = self.session.query(TRA_BuildingStatusOnDate).filter_by(assigned_date=date_input).one()
+        self.assertFalse(status.trip_pairs)
+        # The patterns reused from the first date get their trip pairs as well
+        mock_request.return_value = list(TimeTableExampleLoader(date_input_2))
+        self.assertEqual(build_TRA_database_by_date(date_input_2, self.session).value, 0)
+        status_2 = self.session.query(TRA_BuildingStatusOnDate).filter_by(assigned_date=date_input_2).one()
+        self.assertTrue(status_2.trip_pairs)
+        # Patterns only running on the first date have none yet
+        self.assertFalse(status.trip_pairs)
+        self.assertLess(self.session.query(TRA_TripPair).count(), 34260)
+        mock_request.return_value = list(TimeTableExampleLoader(date_input))
+        self.assertEqual(build_TRA_database_by_date(date_input, self.session, build_anyway=True).value, 0)
+        self.assertTrue(status.trip_pairs)
+        self.assertEqual(self.session.query(TRA_TripPair).count(), 34260)
+
     @patch("build_database.request_TRA_all_train_timetable_by_date")
     def test_remove_old_data_before_building(self, mock_request_train_no):
         date_input = date(2018, 6, 2)
@@ -80,7 +115,9 @@ class TestCase_for_build_TRA_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(TRA_Train).count(), 902)
         self.assertEqual(self.session.query(TRA_TrainTimeTable).count(), 0)
+        self.assertEqual(self.session.query(TRA_TimetablePattern).count(), 0)
         self.assertEqual(self.session.query(TRA_TableEntry).count(), 0)
+        self.assertEqual(self.session.query(TRA_TripPair).count(), 0)
         build_status = self.session.query(TRA_BuildingStatusOnDate).one()
         self.assertEqual(build_status.status, 3)
 
@@ -88,7 +125,9 @@ class TestCase_for_build_TRA_database_by_date(BaseTestCase):
         date_input = date(2018, 6, 2)
         status = TRA_BuildingStatusOnDate(date_input, status=2)
         self.session.add(status)
-        resp = build_TRA_database_by_date(date_input, self.session)
+        # Adding the status and reading it back, nothing is requested or removed
+        with assert_max_queries(2, engine):
+            resp = build_TRA_database_by_date(date_input, self.session)
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(TRA_Train).count(), 0)
         self.assertEqual(self.session.query(TRA_TrainTimeTable).count(), 0)
@@ -109,7 +148,9 @@ class TestCase_for_build_THSR_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(THSR_Train).count(), 128)
         self.assertEqual(self.session.query(THSR_TrainTimeTable).count(), 128)
+        self.assertEqual(self.session.query(THSR_TimetablePattern).count(), 128)
         self.assertEqual(self.session.query(THSR_TableEntry).count(), 1085)
+        self.assertEqual(self.session.query(THSR_TripPair).count(), 4476)
         self.assertEqual(self.session.query(THSR_BuildingStatusOnDate).count(), 1)
         update_status = self.session.query(THSR_BuildingStatusOnDate).one()
         self.assertEqual(update_status.assigned_date, date_input)
@@ -125,7 +166,9 @@ class TestCase_for_build_THSR_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(THSR_Train).count(), 150)
         self.assertEqual(self.session.query(THSR_TrainTimeTable).count(), 272)
-        self.assertEqual(self.session.query(THSR_TableEntry).count(), 2301)
+        self.assertEqual(self.session.query(THSR_TimetablePattern).count(), 168)
+        self.assertEqual(self.session.query(THSR_TableEntry).count(), 1470)
+        self.assertEqual(self.session.query(THSR_TripPair).count(), 6225)
         self.assertEqual(self.session.query(THSR_BuildingStatusOnDate).count(), 2)
 
         # Build second day data again
@@ -133,7 +176,8 @@ class TestCase_for_build_THSR_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(THSR_Train).count(), 150)
         self.assertEqual(self.session.query(THSR_TrainTimeTable).count(), 272)
-        self.assertEqual(self.session.query(THSR_TableEntry).count(), 2301)
+        self.assertEqual(self.session.query(THSR_TimetablePattern).count(), 168)
+        self.assertEqual(self.session.query(THSR_TableEntry).count(), 1470)
         self.assertEqual(self.session.query(THSR_BuildingStatusOnDate).count(), 2)
 
         # Build first day data again
@@ -146,7 +190,8 @@ class TestCase_for_build_THSR_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(THSR_Train).count(), 150)
         self.assertEqual(self.session.query(THSR_TrainTimeTable).count(), 272)
-        self.assertEqual(self.session.query(THSR_TableEntry).count(), 2301)
+        self.assertEqual(self.session.query(THSR_TimetablePattern).count(), 168)
+        self.assertEqual(self.session.query(THSR_TableEntry).count(), 1470)
         self.assertEqual(self.session.query(THSR_BuildingStatusOnDate).count(), 2)
         self.assertEqual(self.session.query(THSR_BuildingStatusOnDate).count(), 2)
 
@@ -165,15 +210,49 @@ class TestCase_for_build_THSR_database_by_date(BaseTestCase):
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(THSR_Train).count(), 128)
         self.assertEqual(self.session.query(THSR_TrainTimeTable).count(), 0)
+        self.assertEqual(self.session.query(THSR_TimetablePattern).count(), 0)
         self.assertEqual(self.session.query(THSR_TableEntry).count(), 0)
+        self.assertEqual(self.session.query(THSR_TripPair).count(), 0)
         build_status = self.session.query(THSR_BuildingStatusOnDate).one()
         self.assertEqual(build_status.status, 3)
 
+    @patch("build_database.request_THSR_all_train_timetable")
+    def test_version_changes_once_a_rebuild_finishes(self, mock_request):
+        date_input = date(2018, 6, 5)
+        load_example_timetable_to_database(self.session, date_input, "THSR")
+        built = get_timetable_version(self.session, "THSR", date_input)
+        versions = list()
+        build_train = build_database.build_THSR_traintimetable
+
+        def build_and_read_version(*args):
+            build_train(*args)
+            versions.append(get_timetable_version(self.session, "THSR", date_input))
+
+        mock_request.return_value = list(TimeTableExampleLoader(date_input, "THSR"))
+        with patch("build_database.build_THSR_traintimetable", side_effect=build_and_read_version):
+            self.assertEqual(build_THSR_database_by_date(date_input, self.session, build_anyway=True).value, 0)
+        # Read in the middle of the rebuild, the date is counted as the previous build
+        self.assertEqual(versions[0][1], built[1])
+        rebuilt = get_timetable_version(self.session, "THSR", date_input)
+        self.assertEqual(rebuilt[1], built[1] + 1)
+        self.assertNotIn(rebuilt, versions)
+
+    def test_removing_a_date_keeps_shared_patterns(self):
+        load_example_timetable_to_database(self.session, date(2018, 6, 5), "THSR")
+        load_example_timetable_to_database(self.session, date(2018, 6, 9), "THSR")
+        remove_THSR_timetable_by_date(date(2018, 6, 9), self.session)
+        self.session.commit()
+        self.assertEqual(self.session.query(THSR_TrainTimeTable).count(), 128)
+        self.assertEqual(self.session.query(THSR_TimetablePattern).count(), 128)
+        self.assertEqual(self.session.query(THSR_TableEntry).count(), 1085)
+        self.assertEqual(self.session.query(THSR_TripPair).count(), 4476)
+
     def test_if_already_built_then_skip(self):
         date_input = date(2018, 6, 2)
         status = THSR_BuildingStatusOnDate(date_input, status=2)
         self.session.add(status)
-        resp = build_THSR_database_by_date(date_input, self.session)
+        with assert_max_queries(2, engine):
+            resp = build_THSR_database_by_date(date_input, self.session)
         self.assertEqual(resp.value, 0)
         self.assertEqual(self.session.query(THSR_Train).count(), 0)
         self.assertEqual(self.session.query(THSR_TrainTimeTable).count(), 0)
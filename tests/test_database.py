@@ -0,0 +1,95 @@
+import unittest
+import os
+import tempfile
+import threading
+from unittest.mock import MagicMock, patch
+
+from psycopg2 import extensions
+from database import (
+    create_database_engine, create_session_factories, make_psycopg2_green, eventlet_wait_callback,
+    reset_query_stats, query_stats, count_queries, statement_shape, warn_repeated_queries, POOL_SIZE
+)
+
+
+class TestCase_for_database(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_database_engine(os.environ["TESTING_DATABASE_URI"])
+        self.session_factory, self.Session = create_session_factories(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_pool_is_sized(self):
+        self.assertEqual(self.engine.pool.size(), POOL_SIZE)
+
+    def test_sqlite_file_engine_has_no_pool_size(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_database_engine("sqlite:///" + os.path.join(directory, "test.sqlite3"))
+            self.assertEqual(engine.execute("SELECT 1").scalar(), 1)
+            engine.dispose()
+
+    def test_every_thread_has_its_own_session(self):
+        sessions = dict()
+
+        def run(name):
+            sessions[name] = self.Session()
+            self.assertIs(self.Session(), sessions[name])
+            self.assertEqual(self.Session.execute("SELECT 1").scalar(), 1)
+            self.Session.remove()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, sessions.values()))), 3)
+
+    def test_session_is_new_after_remove(self):
+        session = self.Session()
+        self.Session.remove()
+        self.assertIsNot(self.Session(), session)
+        self.Session.remove()
+
+    def test_queries_are_counted_per_thread(self):
+        stats = reset_query_stats()
+        session = self.Session()
+        session.execute("SELECT 1")
+        session.execute("SELECT 2")
+        self.Session.remove()
+        self.assertEqual(stats.count, 2)
+        self.assertGreater(stats.seconds, 0)
+        other = list()
+        thread = threading.Thread(target=lambda: other.append(query_stats().count))
+        thread.start()
+        thread.join()
+        self.assertEqual(other, [0])
+
+    def test_statement_shape(self):
+        self.assertEqual(statement_shape("SELECT a FROM t\n WHERE b = %(b_1)s AND c IN (1, 2, 3) AND d = 'x'"),
+                         "SELECT a FROM t WHERE b = ? AND c IN (?) AND d = ?")
+
+    def test_statements_in_a_loop_are_reported(self):
+        session = self.Session()
+        with count_queries() as stats:
+            for i in range(12):
+                session.execute("SELECT :i", {"i": i})
+            session.execute("SELECT 1 + 1")
+        self.Session.remove()
+        self.assertEqual(stats.count, 13)
+        with patch("sys.stdout"):
+            repeated = warn_repeated_queries(stats, "test", threshold=10)
+        self.assertEqual(repeated, [("SELECT ?", 12)])
+
+    def test_psycopg2_is_left_alone_without_eventlet(self):
+        with patch("database.is_eventlet_patched", return_value=False):
+            self.assertFalse(make_psycopg2_green())
+        self.assertIsNone(extensions.get_wait_callback())
+
+    def test_wait_callback_polls_until_ready(self):
+        conn = MagicMock()
+        conn.poll.side_effect = [extensions.POLL_READ, extensions.POLL_WRITE, extensions.POLL_OK]
+        hubs = MagicMock()
+        with patch.dict("sys.modules", {"eventlet.hubs": hubs}):
+            eventlet_wait_callback(conn)
+        trampoline = hubs.trampoline
+        self.assertEqual([c[1] for c in trampoline.call_args_list], [{"read": True}, {"write": True}])
@@ -0,0 +1,216 @@
+import unittest
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .load_example import drop_all_table
+from .query_count import assert_max_queries
+from models import Base, TRA_QuestionState, THSR_QuestionState
+from dialog_store import (
+    DialogState, DialogStore, DialogStateWriter, MemoryBackend, SqliteBackend, expire_stale_rows,
+    delete_expired_rows, create_dialog_store
+)
+from handlers import ask_question_states, search_TRA_train
+from . import create_test_app, test_directory
+
+app = create_test_app()
+engine = create_engine(os.environ["TESTING_DATABASE_URI"])
+Session = sessionmaker(bind=engine)
+
+
+class BackendTests(object):
+    def test_get_returns_a_copy_until_put(self):
+        store = DialogStore(self.backend, sync=True)
+        store.backend.put("123", None, datetime.now() + timedelta(hours=1),
+                          DialogState("TRA", None, "123", departure_station="新竹").to_dict())
+        state = store.get("123", None)
+        state.departure_station = "高雄"
+        self.assertEqual(store.get("123", None).departure_station, "新竹")
+        self.assertIsNone(store.get("123", "group"))
+
+    def test_expired_state_is_gone(self):
+        now = datetime.now()
+        self.backend.put("123", None, now - timedelta(seconds=1), DialogState("TRA", None, "123").to_dict())
+        self.backend.put("456", None, now + timedelta(hours=1), DialogState("TRA", None, "456").to_dict())
+        self.assertIsNone(self.backend.get("123", None, now))
+        self.assertEqual(self.backend.purge_expired(now), 1)
+        self.assertEqual(self.backend.get("456", None, now)["user"], "456")
+
+    def test_delete_user_removes_every_group(self):
+        expiry = datetime.now() + timedelta(hours=1)
+        self.backend.put("123", None, expiry, DialogState("TRA", None, "123").to_dict())
+        self.backend.put("123", "group", expiry, DialogState("THSR", "group", "123").to_dict())
+        self.backend.delete_user("123")
+        self.assertIsNone(self.backend.get("123", None, datetime.now()))
+        self.assertIsNone(self.backend.get("123", "group", datetime.now()))
+
+
+class TestCase_for_MemoryBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+
+
+class TestCase_for_SqliteBackend(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.backend = SqliteBackend(os.path.join(self.directory.name, "dialog.sqlite3"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_states_are_shared_by_the_file(self):
+        other = SqliteBackend(self.backend.path)
+        self.backend.put("123", None, datetime.now() + timedelta(hours=1), DialogState("TRA", None, "123").to_dict())
+        self.assertEqual(other.get("123", None, datetime.now())["user"], "123")
+
+
+class TestCase_for_create_dialog_store(unittest.TestCase):
+    def test_app_builds_the_store_of_its_config(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "dialog.sqlite3")
+        store = create_test_app({"DIALOG_STORE": "sqlite", "DIALOG_STORE_PATH": path}).dialog_store
+        self.assertIsInstance(store.backend, SqliteBackend)
+        self.assertEqual(store.backend.path, path)
+        self.assertIsInstance(create_test_app({"DIALOG_STORE": "memory"}).dialog_store.backend, MemoryBackend)
+
+    def test_sqlite_is_the_default(self):
+        path = os.path.join(test_directory.name, "default.sqlite3")
+        self.assertIsInstance(create_dialog_store(MagicMock(), path=path).backend, SqliteBackend)
+        self.assertEqual(app.dialog_store.backend.path, os.path.join(test_directory.name, "dialog_state.sqlite3"))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            create_dialog_store(MagicMock(), "redis")
+
+
+class TestCase_for_write_behind(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_all_table(engine)
+
+    def setUp(self):
+        self.store = DialogStore(MemoryBackend(), DialogStateWriter(Session))
+        self.session = Session()
+
+    def tearDown(self):
+        self.session.query(TRA_QuestionState).delete()
+        self.session.query(THSR_QuestionState).delete()
+        self.session.commit()
+        self.session.close()
+
+    def test_changes_are_written_in_background(self):
+        old = THSR_QuestionState(group=None, user="123", departure_station="左營")
+        self.session.add(old)
+        self.session.commit()
+        state = self.store.start("TRA", "123", None)
+        state.departure_station = "新竹"
+        self.store.put(state)
+        self.store.writer.join()
+        self.session.expire_all()
+        self.assertTrue(self.session.query(THSR_QuestionState).one().expired)
+        row = self.session.query(TRA_QuestionState).one()
+        self.assertEqual([row.token, row.departure_station, row.expired], [state.token, "新竹", False])
+
+    def test_older_change_does_not_overwrite(self):
+        state = DialogState("TRA", None, "123", departure_station="新竹")
+        older = DialogState.from_dict(state.to_dict())
+        older.departure_station = ""
+        older.update = state.update - timedelta(seconds=1)
+        self.store.writer.write([("state", state)])
+        self.store.writer.write([("state", older)])
+        self.assertEqual(self.session.query(TRA_QuestionState).one().departure_station, "新竹")
+
+
+class TestCase_for_sweeping_question_states(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_all_table(engine)
+
+    def setUp(self):
+        self.session = Session()
+
+    def tearDown(self):
+        self.session.query(TRA_QuestionState).delete()
+        self.session.query(THSR_QuestionState).delete()
+        self.session.commit()
+        self.session.close()
+
+    def add_state(self, question_state_class, user, age, expired=False):
+        state = question_state_class(group=None, user=user, expired=expired)
+        state.update = datetime.now() - age
+        self.session.add(state)
+
+    def test_abandoned_states_are_expired(self):
+        self.add_state(TRA_QuestionState, "active", timedelta(minutes=5))
+        self.add_state(TRA_QuestionState, "abandoned", timedelta(days=1))
+        self.add_state(THSR_QuestionState, "abandoned", timedelta(days=2))
+        self.session.commit()
+        self.assertEqual(expire_stale_rows(self.session, datetime.now() - timedelta(hours=6)), 2)
+        active = self.session.query(TRA_QuestionState).filter_by(expired=False).all()
+        self.assertEqual([s.user for s in active], ["active"])
+
+    def test_old_expired_states_are_deleted_in_batches(self):
+        for i in range(5):
+            self.add_state(TRA_QuestionState, str(i), timedelta(days=40), expired=True)
+        self.add_state(TRA_QuestionState, "recent", timedelta(days=1), expired=True)
+        self.add_state(THSR_QuestionState, "unexpired", timedelta(days=40))
+        self.session.commit()
+        self.assertEqual(delete_expired_rows(self.session, datetime.now() - timedelta(days=30), batch_size=2), 5)
+        self.assertEqual(self.session.query(TRA_QuestionState).one().user, "recent")
+        self.assertEqual(self.session.query(THSR_QuestionState).count(), 1)
+
+
+class TestCase_for_dialog_without_database_reads(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_all_table(engine)
+
+    def setUp(self):
+        self.app = app
+        self.app.session = MagicMock()
+
+    def test_dialog_steps_read_the_store(self):
+        store = DialogStore(MemoryBackend(), MagicMock())
+        event = MagicMock()
+        event.source.user_id = event.source.group_id = "123"
+        with unittest.mock.patch.object(self.app, "dialog_store", store), self.app.app_context():
+            search_TRA_train(event)
+            event.message.text = "新竹"
+            self.assertEqual(ask_question_states(event).text, "請輸入目的站")
+        self.app.session.query.assert_not_called()
+        self.assertEqual(store.get("123", "123").departure_station, "新竹")
+        # start's expiry, the new state and the departure station
+        self.assertEqual(store.writer.submit.call_count, 3)
+
+    def test_source_without_dialog_reads_the_database_once(self):
+        self.app.session = Session()
+        self.addCleanup(self.app.session.close)
+        store = DialogStore(MemoryBackend(), MagicMock())
+        event = MagicMock()
+        event.source.user_id = event.source.group_id = "456"
+        event.message.text = "明天去新竹玩"
+        with unittest.mock.patch.object(self.app, "dialog_store", store), self.app.app_context():
+            with assert_max_queries(2, engine) as stats:
+                self.assertIsNone(ask_question_states(event))
+            self.assertGreater(stats.count, 0)
+            with assert_max_queries(0, engine):
+                self.assertIsNone(ask_question_states(event))
+            search_TRA_train(event)
+            event.message.text = "新竹"
+            self.assertEqual(ask_question_states(event).text, "請輸入目的站")
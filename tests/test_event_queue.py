@@ -0,0 +1,127 @@
+import unittest
+import time
+import json
+import base64
+import hashlib
+import hmac
+import threading
+from unittest.mock import MagicMock, patch
+
+from event_queue import EventQueue, QUEUE_LATENCY, source_key
+from . import create_test_app
+
+app = create_test_app()
+
+
+def make_event(user_id, text):
+    event = MagicMock()
+    event.source.user_id = user_id
+    event.message.text = text
+    return event
+
+
+class TestCase_for_EventQueue(unittest.TestCase):
+    def test_events_of_a_user_keep_their_order(self):
+        handled = list()
+        lock = threading.Lock()
+
+        def handle(events):
+            # The first user is slow, it must not hold the others back nor be reordered
+            for event in events:
+                if event.source.user_id == "slow":
+                    time.sleep(0.01)
+                with lock:
+                    handled.append((event.source.user_id, event.message.text))
+
+        event_queue = EventQueue(handle, workers=4)
+        users = ["slow", "a", "b", "c"]
+        events = [make_event(user, str(i)) for i in range(5) for user in users]
+        self.assertTrue(event_queue.submit(events))
+        event_queue.join()
+        for user in users:
+            self.assertEqual([text for u, text in handled if u == user], [str(i) for i in range(5)])
+        self.assertEqual(event_queue.depth, 0)
+
+    def test_events_are_grouped_by_source(self):
+        calls = list()
+        event_queue = EventQueue(lambda events: calls.append([e.message.text for e in events]), workers=1)
+        event_queue.submit([make_event("a", "1"), make_event("b", "1"), make_event("a", "2")])
+        event_queue.join()
+        self.assertEqual(calls, [["1", "2"], ["1"]])
+
+    def test_sources_of_a_delivery_are_handled_side_by_side(self):
+        event_queue = EventQueue(lambda events: time.sleep(0.2), workers=10)
+        users = list()
+        shards = set()
+        for i in range(1000):
+            user = "user{0}".format(i)
+            if event_queue.shard_of(user) not in shards:
+                shards.add(event_queue.shard_of(user))
+                users.append(user)
+        started = time.time()
+        event_queue.submit([make_event(user, "T") for user in users])
+        event_queue.join()
+        # Roughly the slowest event instead of the sum of the ten
+        self.assertLess(time.time() - started, 0.2 * 3)
+
+    def test_delivery_over_max_depth_is_refused(self):
+        release = threading.Event()
+        event_queue = EventQueue(lambda events: release.wait(), workers=1, max_depth=3)
+        self.assertTrue(event_queue.submit([make_event("a", "1"), make_event("a", "2")]))
+        self.assertFalse(event_queue.submit([make_event("b", "1"), make_event("b", "2")]))
+        self.assertEqual(event_queue.depth, 2)
+        release.set()
+        event_queue.join()
+
+    def test_queue_latency_is_observed(self):
+        count = QUEUE_LATENCY.snapshot()["count"]
+        event_queue = EventQueue(lambda events: None)
+        event_queue.submit([make_event("a", "1")])
+        event_queue.join()
+        self.assertEqual(QUEUE_LATENCY.snapshot()["count"], count + 1)
+
+    def test_failure_is_logged_by_the_app(self):
+        def handle(events):
+            raise RuntimeError("failed")
+        event_queue = EventQueue(handle, logger=app.logger)
+        with self.assertLogs(app.logger, "ERROR") as logs:
+            event_queue.submit([make_event("a", "1")])
+            event_queue.join()
+        self.assertIn("RuntimeError: failed", logs.output[0])
+        self.assertIs(app.event_queue.logger, app.logger)
+        self.assertEqual(event_queue.depth, 0)
+
+    def test_source_key_falls_back_to_group(self):
+        event = MagicMock()
+        event.source.user_id = None
+        event.source.group_id = "group"
+        self.assertEqual(source_key(event), "group")
+
+
+class TestCase_for_webhook(unittest.TestCase):
+    def post(self, body):
+        secret = app.config["CHANNEL_SECRET"] or ""
+        signature = base64.b64encode(hmac.new(secret.encode("utf-8"), body.encode("utf-8"),
+                                              hashlib.sha256).digest()).decode("utf-8")
+        return app.test_client().post("/callback", data=body, headers={"X-Line-Signature": signature})
+
+    def body(self):
+        return json.dumps({"events": [{
+            "type": "message", "replyToken": "token", "timestamp": 1527868800000,
+            "source": {"type": "user", "userId": "123"},
+            "message": {"type": "text", "id": "1", "text": "T"}
+        }]})
+
+    def test_events_are_queued_and_acknowledged(self):
+        with patch.object(app, "event_queue") as event_queue:
+            event_queue.submit.return_value = True
+            response = self.post(self.body())
+        self.assertEqual(response.status_code, 200)
+        events = event_queue.submit.call_args[0][0]
+        self.assertEqual(events[0].message.text, "T")
+
+    def test_full_queue_answers_503(self):
+        with patch.object(app, "event_queue") as event_queue:
+            event_queue.submit.return_value = False
+            response = self.post(self.body())
+        self.assertEqual(response.status_code, 503)
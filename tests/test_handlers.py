@@ -1,22 +1,29 @@
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import os
 from datetime import datetime
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from linebot.models import PostbackEvent, TemplateSendMessage
+from linebot.models import (
+    PostbackEvent, TemplateSendMessage, FollowEvent, JoinEvent, MessageEvent, SourceUser, SourceGroup
+)
 
 from .load_example import load_example_timetable_to_database, drop_all_table
+from .query_count import assert_max_queries
 from models import (
-    Base, TRA_QuestionState, THSR_QuestionState, User, Group
+    Base, TRA_QuestionState, THSR_QuestionState, User, Group, TRA_BuildingStatusOnDate
 )
 from handlers import (
-    request_TRA_matching_train, request_THSR_matching_train, ask_question_states,
+    request_TRA_matching_train, request_THSR_matching_train, request_matching_train, request_joined_matching_train,
+    ask_question_states,
     handle_follow_event, handle_join_event, handle_unfollow_event,
-    handle_leave_event, match_text_and_assign
+    handle_leave_event, match_text_and_assign, load_search_result, RESULT_PAGE_SIZE,
+    handle_events
 )
-from app import app
+from metrics import counter
+from . import create_test_app
 
+app = create_test_app()
 engine = create_engine(os.environ["TESTING_DATABASE_URI"])
 Session = sessionmaker(bind=engine)
 TEST_DATE_1 = datetime(2018, 6, 2)
@@ -35,6 +42,9 @@ class BaseTestCase(unittest.TestCase):
     def setUp(self):
         self.app = app
         self.app.session = Session()
+        # Dialog states are written in the session of the test
+        self.app.dialog_store.sync = True
+        self.app.dialog_store.clear()
 
     def tearDown(self):
         self.app.session.query(TRA_QuestionState).delete()
@@ -140,6 +150,65 @@ class TestCase_for_request_TRA_matching_train(BaseTRATestCase):
             res = request_TRA_matching_train(qs)
             self.check(correct_list, res)
 
+    def test_search_and_render_with_two_queries(self):
+        with self.app.app_context():
+            qs = TRA_QuestionState(group=None, user='123',
+                                   departure_station="新竹",
+                                   destination_station="高雄",
+                                   departure_time=datetime(2018, 6, 2, 7, 0))
+            # The building status tells whether the trip pairs of the date are complete
+            with assert_max_queries(2, engine) as stats:
+                res = request_TRA_matching_train(qs)
+                # Rendering touches the train of every row
+                rows = [(_l[0].train.train_no, _l[0].train.train_type) for _l in res]
+            self.assertEqual(len(rows), 8)
+            self.assertEqual(stats.count, 2)
+            with assert_max_queries(1, engine):
+                self.assertEqual(len(request_matching_train(qs, "TRA", trip_pairs=True)), 8)
+
+    def test_empty_trip_pair_result_is_the_answer(self):
+        with self.app.app_context():
+            # No train leaves 新竹 for 高雄 between 01:00 and the end of the search range
+            qs = TRA_QuestionState(group=None, user='123',
+                                   departure_station="新竹",
+                                   destination_station="高雄",
+                                   departure_time=datetime(2018, 6, 3, 1, 0))
+            with patch("handlers.request_joined_matching_train") as joined:
+                self.assertEqual(request_TRA_matching_train(qs), [])
+            joined.assert_not_called()
+
+    def test_date_without_complete_trip_pairs_joins_the_stops(self):
+        status = self.app.session.query(TRA_BuildingStatusOnDate).filter_by(assigned_date=TEST_DATE_1.date()).one()
+        status.trip_pairs = False
+        self.app.session.commit()
+        try:
+            with self.app.app_context():
+                qs = TRA_QuestionState(group=None, user='123',
+                                       departure_station="新竹",
+                                       destination_station="高雄",
+                                       departure_time=datetime(2018, 6, 2, 7, 0))
+                with patch("handlers.build_trip_pair_query") as trip_pair_query:
+                    rows = [_l[0].train.train_no for _l in request_TRA_matching_train(qs)]
+                trip_pair_query.assert_not_called()
+                self.assertEqual(rows, [_l[0].train.train_no for _l in request_joined_matching_train(qs, "TRA")])
+                self.assertEqual(len(rows), 8)
+        finally:
+            status.trip_pairs = True
+            self.app.session.commit()
+
+    def test_search_without_trip_pairs_with_one_query(self):
+        with self.app.app_context():
+            # 榮華 is not one of TRA_TRIP_PAIR_STATIONS
+            qs = TRA_QuestionState(group=None, user='123',
+                                   departure_station="榮華",
+                                   destination_station="內灣",
+                                   departure_time=datetime(2018, 6, 2, 6, 0))
+            with assert_max_queries(1, engine) as stats:
+                res = request_TRA_matching_train(qs)
+                rows = [(_l[0].train.train_no, _l[0].train.train_type) for _l in res]
+            self.assertEqual(rows[0], ('1804', '區間'))
+            self.assertEqual(stats.count, 1)
+
 
 class TestCase_for_ask_TRA_question_states(BaseTRATestCase):
     def test_multiple_question_states_exists(self):
@@ -191,6 +260,49 @@ class TestCase_for_ask_TRA_question_states(BaseTRATestCase):
             result = ask_question_states(mock_event)
             self.assertEqual(result.text, "輸入的目的站與起程站皆是新竹，請重新輸入有效目的站")
 
+    def test_sentence_in_a_group_is_not_a_station(self):
+        event = MessageEvent(source=SourceGroup(group_id="456", user_id="123"))
+        event.message = MagicMock(text="明天去新竹玩")
+        qs_1 = TRA_QuestionState(group="456", user="123")
+        self.app.session.add(qs_1)
+        with self.app.app_context():
+            self.assertIsNone(ask_question_states(event))
+            self.assertFalse(qs_1.departure_station)
+            event.message.text = "新竹站"
+            self.assertEqual(ask_question_states(event).text, "請輸入目的站")
+            self.assertEqual(qs_1.departure_station, "新竹")
+
+    def test_sentence_in_a_chat_with_the_bot_is_searched(self):
+        event = MessageEvent(source=SourceUser(user_id="123"))
+        event.message = MagicMock(text="明天去新竹玩")
+        qs_1 = TRA_QuestionState(group=None, user="123")
+        self.app.session.add(qs_1)
+        with self.app.app_context():
+            self.assertEqual(ask_question_states(event).text, "請輸入目的站")
+            self.assertEqual(qs_1.departure_station, "新竹")
+
+    def test_ambiguous_station_name_offers_choices(self):
+        mock_event = MagicMock()
+        mock_event.source.user_id = mock_event.source.group_id = user_id = group = "123"
+        mock_event.message.text = "新行"
+        qs_1 = TRA_QuestionState(group=group, user=user_id)
+        self.app.session.add(qs_1)
+        ambiguous = counter("station_match_ambiguous_total", "Station names matching several stations",
+                            labels={"train_type": "TRA"})
+        count = ambiguous.value
+        with self.app.app_context():
+            result = ask_question_states(mock_event)
+            self.assertEqual(result.template.title, "請選擇起程站")
+            self.assertEqual([a.text for a in result.template.actions], ["新營", "新竹", "新富"])
+            self.assertFalse(qs_1.departure_station)
+            self.assertEqual(ambiguous.value, count + 1)
+            mock_event.message.text = "板僑"
+            result = ask_question_states(mock_event)
+            self.assertEqual(qs_1.departure_station, "板橋")
+            self.assertEqual(result.text, "請輸入目的站")
+            # A name resolved to a single station is not ambiguous
+            self.assertEqual(ambiguous.value, count + 1)
+
     def test_message_choosing_datetime(self):
         correct_items_in_result = ['0051', '莒光', '07:19', '11:16', '0103', '自強', '07:40', '11:32', '0105', '自強',
                                    '08:14', '12:10', '0507', '莒光', '08:53', '14:15']
@@ -206,10 +318,72 @@ class TestCase_for_ask_TRA_question_states(BaseTRATestCase):
                                  departure_station="新竹",
                                  destination_station="高雄")
         self.app.session.add(qs_1)
-        with self.app.app_context():
+        with self.app.app_context(), patch.object(self.app, "line_dispatcher") as dispatcher:
             result = ask_question_states(event)
             for item in correct_items_in_result:
                 self.assertIn(item, result.template.text)
+            self.assertEqual(dispatcher.push_async.call_args[0][0], group)
+
+    def test_message_choosing_datetime_keeps_search_result(self):
+        event = PostbackEvent()
+        mock_source = MagicMock()
+        mock_source.user_id = mock_source.group_id = user_id = group = "123"
+        event.source = mock_source
+        mock_postback = MagicMock()
+        mock_postback.params = {"datetime": "2018-06-02T07:00"}
+        event.postback = mock_postback
+        qs_1 = TRA_QuestionState(group=group, user=user_id,
+                                 departure_station="新竹",
+                                 destination_station="高雄")
+        self.app.session.add(qs_1)
+        with self.app.app_context(), patch.object(self.app, "line_dispatcher"):
+            ask_question_states(event)
+        rows = load_search_result(qs_1.search_result)
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[0][1:], ['51', '莒光', '07:19', '11:16'])
+        self.assertEqual(qs_1.result_cursor, 4)
+
+    @patch("handlers.find_matching_train")
+    def test_list_more_pages_through_kept_result(self, mock_find):
+        mock_event = MagicMock()
+        mock_event.source.user_id = mock_event.source.group_id = user_id = group = "123"
+        mock_event.message.text = "列出更多"
+        rows = ["{0},{1},區間,{2:0>2}:00,{2:0>2}:30".format(i, 1000 + i, i % 24) for i in range(30)]
+        qs_1 = TRA_QuestionState(group=group, user=user_id,
+                                 departure_station="新竹",
+                                 destination_station="高雄",
+                                 departure_time=datetime(2018, 6, 2, 7, 0))
+        qs_1.search_result = ";".join(rows)
+        qs_1.result_cursor = 4
+        self.app.session.add(qs_1)
+        with self.app.app_context():
+            result = ask_question_states(mock_event)
+            self.assertIn("第5~{0}班，共30班".format(4 + RESULT_PAGE_SIZE), result.text)
+            self.assertIn("1004", result.text)
+            self.assertNotIn("1003", result.text)
+            self.assertIn("輸入「列出更多」", result.text)
+            result = ask_question_states(mock_event)
+            self.assertIn("第{0}~30班，共30班".format(5 + RESULT_PAGE_SIZE), result.text)
+            self.assertIn("1029", result.text)
+            self.assertNotIn("輸入「列出更多」", result.text)
+            result = ask_question_states(mock_event)
+            self.assertEqual(result.text, "沒有更多班次了")
+        mock_find.assert_not_called()
+
+    def test_message_transfer_plans_journey(self):
+        mock_event = MagicMock()
+        mock_event.source.user_id = mock_event.source.group_id = user_id = group = "123"
+        mock_event.message.text = "轉乘"
+        qs_1 = TRA_QuestionState(group=group, user=user_id,
+                                 departure_station="臺北",
+                                 destination_station="花蓮",
+                                 departure_time=datetime(2018, 6, 2, 20, 0))
+        self.app.session.add(qs_1)
+        with self.app.app_context():
+            result = ask_question_states(mock_event)
+        self.assertIn("臺鐵 0448", result.text)
+        self.assertIn("臺北 20:15 → 花蓮 22:25", result.text)
+        self.assertTrue(result.text.endswith("抵達時間 22:25"))
 
 
 class TestCase_for_follow_unfollow_join_joinning_event(BaseTestCase):
@@ -264,6 +438,29 @@ class TestCase_for_follow_unfollow_join_joinning_event(BaseTestCase):
         self.assertFalse(result.joinning)
         self.assertIsNotNone(result.leave_datetime)
 
+    def test_statements_of_follow_events(self):
+        events = [FollowEvent(source=SourceUser(user_id=str(i)), reply_token=str(i)) for i in range(5)]
+        # A savepoint, looking up the user and adding it per event
+        with self.app.app_context(), patch.object(self.app, "line_dispatcher"):
+            with assert_max_queries(4 * len(events), engine):
+                handle_events(events)
+        self.assertEqual(self.app.session.query(User).count(), 5)
+
+    @patch("handlers.match_text_and_assign", side_effect=RuntimeError)
+    def test_failed_event_does_not_undo_the_others(self, mock_match):
+        follow, message, join = FollowEvent(), MessageEvent(), JoinEvent()
+        follow.source = message.source = SourceUser(user_id="123")
+        join.source = SourceGroup(group_id="456")
+        follow.reply_token, message.reply_token, join.reply_token = "1", "2", "3"
+        with self.app.app_context(), patch.object(self.app, "line_dispatcher") as dispatcher, \
+                self.assertLogs(self.app.logger, "ERROR") as logs:
+            handle_events([follow, message, join])
+        self.assertIn("Handling a MessageEvent failed.", logs.output[0])
+        self.assertEqual(self.app.session.query(User).one().user_id, "123")
+        self.assertEqual(self.app.session.query(Group).one().group_id, "456")
+        replies = dispatcher.reply_all.call_args[0][0]
+        self.assertEqual([token for token, _ in replies], ["1", "3"])
+
 
 class BaseTHSRTestCase(BaseTestCase):
     @classmethod
@@ -350,6 +547,19 @@ class TestCase_for_request_THSR_matching_train(BaseTHSRTestCase):
             res = request_THSR_matching_train(qs)
             self.check(correct_list, res)
 
+    def test_search_and_render_with_two_queries(self):
+        with self.app.app_context():
+            qs = THSR_QuestionState(group=None, user='123',
+                                    departure_station="新竹",
+                                    destination_station="臺南",
+                                    departure_time=datetime(2018, 6, 5, 10, 0))
+            # The building status tells whether the trip pairs of the date are complete
+            with assert_max_queries(2, engine) as stats:
+                res = request_THSR_matching_train(qs)
+                rows = [_l[0].train.train_no for _l in res]
+            self.assertEqual(len(rows), 11)
+            self.assertEqual(stats.count, 2)
+
 
 class TestCase_for_ask_THSR_question_states(BaseTHSRTestCase):
     def test_multiple_question_states_exists(self):
@@ -415,10 +625,11 @@ class TestCase_for_ask_THSR_question_states(BaseTHSRTestCase):
                                   departure_station="新竹",
                                   destination_station="臺中")
         self.app.session.add(qs_1)
-        with self.app.app_context():
+        with self.app.app_context(), patch.object(self.app, "line_dispatcher") as dispatcher:
             result = ask_question_states(event)
             for item in correct_items_in_result:
                 self.assertIn(item, result.template.text)
+            self.assertEqual(dispatcher.push_async.call_args[0][0], group)
 
 
 class TestCase_for_match_text_and_assign(BaseTestCase):
@@ -0,0 +1,73 @@
+import os
+import unittest
+from datetime import date
+from unittest.mock import MagicMock, patch
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .load_example import drop_all_table
+from models import Base, TRA_BuildingStatusOnDate, THSR_BuildingStatusOnDate
+from database import wait_for_database
+from health import check_readiness
+from . import create_test_app
+
+app = create_test_app()
+engine = create_engine(os.environ["TESTING_DATABASE_URI"])
+Session = sessionmaker(bind=engine)
+SERVICE_DATE = date(2018, 6, 2)
+
+
+class TestCase_for_wait_for_database(unittest.TestCase):
+    def test_returns_at_once_when_reachable(self):
+        with patch("database.time.sleep") as sleep:
+            self.assertTrue(wait_for_database(engine))
+        sleep.assert_not_called()
+
+    def test_backs_off_until_the_deadline(self):
+        unreachable = create_engine("postgresql://postgres@127.0.0.1:1/postgres")
+        with patch("database.time.sleep") as sleep, patch("sys.stdout"):
+            self.assertFalse(wait_for_database(unreachable, deadline=0.5, first_delay=0.01, max_delay=0.04))
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertEqual(delays[:3], [0.01, 0.02, 0.04])
+        self.assertLessEqual(max(delays), 0.04)
+
+
+class TestCase_for_readiness(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.session = Session()
+
+    def tearDown(self):
+        self.session.close()
+        drop_all_table(engine)
+
+    def test_not_ready_without_timetables(self):
+        ready, checks = check_readiness(Session, SERVICE_DATE)
+        self.assertFalse(ready)
+        self.assertTrue(checks["database"])
+        self.assertEqual(checks["timetable"], {"TRA": False, "THSR": False})
+
+    @patch("health.timetable_index")
+    def test_built_dates_are_loaded_into_the_index(self, mock_index):
+        self.session.add_all([TRA_BuildingStatusOnDate(SERVICE_DATE, status=2),
+                              THSR_BuildingStatusOnDate(SERVICE_DATE, status=2)])
+        self.session.commit()
+        mock_index.get.return_value = None
+        ready, checks = check_readiness(Session, SERVICE_DATE)
+        self.assertFalse(ready)
+        self.assertEqual(checks["timetable"], {"TRA": True, "THSR": True})
+        self.assertEqual(mock_index.schedule_load.call_count, 2)
+        mock_index.get.return_value = MagicMock()
+        ready, checks = check_readiness(Session, SERVICE_DATE)
+        self.assertTrue(ready)
+        self.assertEqual(checks["index"], {"TRA": True, "THSR": True})
+
+    def test_endpoints(self):
+        client = app.test_client()
+        self.assertEqual(client.get("/healthz").status_code, 200)
+        with patch("views.check_readiness", return_value=(False, {"database": False})):
+            self.assertEqual(client.get("/readyz").status_code, 503)
+        with patch("views.check_readiness", return_value=(True, {"database": True})):
+            response = client.get("/readyz")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('"database": true', response.get_data(as_text=True))
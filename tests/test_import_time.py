@@ -0,0 +1,53 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+import threading
+import subprocess
+
+import utils
+from profile_imports import IMPORT_BUDGETS, ROOT, child_environment, profile_import, over_budget
+from app import create_app
+from . import create_test_app
+
+SIDE_EFFECTS = """
+import json, threading
+import app, handlers, utils
+print(json.dumps({"engine": handlers.engine is not None, "keys": utils._keys_candidates is not None,
+                  "threads": threading.active_count()}))
+"""
+
+
+class TestCase_for_imports(unittest.TestCase):
+    def test_imports_without_config_have_no_side_effects(self):
+        output = subprocess.check_output([sys.executable, "-c", SIDE_EFFECTS], cwd=ROOT, env=child_environment())
+        self.assertEqual(json.loads(output.decode("utf-8").strip().splitlines()[-1]),
+                         {"engine": False, "keys": False, "threads": 1})
+
+    def test_imports_are_within_budget(self):
+        for module in sorted(IMPORT_BUDGETS):
+            result = profile_import(module, runs=2)
+            self.assertFalse(over_budget(result), "import {0} took {1:.2f}s, budget {2}s".format(
+                module, result["seconds"], result["budget"]))
+
+    def test_create_app_needs_database_uri(self):
+        with self.assertRaises(RuntimeError):
+            create_app({"DATABASE_URI": ""})
+
+    def test_create_app_needs_line_credentials(self):
+        with self.assertRaises(RuntimeError):
+            create_test_app({"CHANNEL_SECRET": ""})
+        with self.assertRaises(RuntimeError):
+            create_test_app({"CHANNEL_ACCESS_TOKEN": None})
+
+    def test_create_app_starts_no_threads(self):
+        threads = threading.active_count()
+        create_test_app({"METRICS_DIR": tempfile.gettempdir()})
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_keys_are_read_in_pairs(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            f.write("id1\nkey1\n\nid2\nkey2\nid3\n")
+        self.addCleanup(os.remove, f.name)
+        self.assertEqual(utils.load_keys_candidates(f.name), [("id1", "key1"), ("id2", "key2")])
@@ -0,0 +1,94 @@
+import unittest
+from datetime import date
+
+from timetable_index import DayIndex
+from journey_planner import ConnectionDay
+
+SERVICE_DATE = date(2018, 6, 2)
+
+
+def make_day(train_type, timetables):
+    """
+    :param timetables: list of (train no, [(station, arrival, departure)]) with times as "HH:MM"
+    """
+    day = DayIndex(train_type, SERVICE_DATE)
+    for timetable_id, (train_no, stops) in enumerate(timetables):
+        day.add_timetable(timetable_id, train_no, None, [(s, minutes(a), minutes(d)) for s, a, d in stops])
+    day.freeze()
+    return day
+
+
+def minutes(hhmm):
+    h, m = hhmm.split(":")
+    return int(h) * 60 + int(m)
+
+
+def summarize(legs):
+    return [(leg.train_type, leg.timetable.train.train_no if leg.timetable else None,
+             leg.departure_station, leg.destination_station) for leg in legs]
+
+
+class TestCase_for_connection_scan(unittest.TestCase):
+    def setUp(self):
+        self.tra = make_day("TRA", [
+            ("101", [("花蓮", "06:00", "06:00"), ("宜蘭", "07:00", "07:02"), ("臺北", "08:00", "08:00")]),
+            # Leaves 臺北 only 3 minutes after 101 arrives
+            ("103", [("臺北", "08:03", "08:03"), ("桃園", "08:30", "08:30")]),
+            ("105", [("臺北", "08:10", "08:10"), ("桃園", "08:40", "08:40")]),
+            ("107", [("宜蘭", "05:00", "05:00"), ("臺北", "06:00", "06:00")]),
+            ("109", [("新左營", "10:30", "10:30"), ("高雄", "10:40", "10:40")]),
+        ])
+        self.thsr = make_day("THSR", [
+            ("0601", [("臺北", "08:05", "08:05"), ("左營", "09:40", "09:40")]),
+            ("0603", [("臺北", "08:12", "08:12"), ("左營", "09:50", "09:50")]),
+        ])
+        self.connections = ConnectionDay(SERVICE_DATE, [self.tra, self.thsr])
+
+    def test_direct_train(self):
+        legs = self.connections.plan("花蓮", "宜蘭", minutes("05:30"), "TRA")
+        self.assertEqual(summarize(legs), [("TRA", "101", "花蓮", "宜蘭")])
+        self.assertEqual(legs[-1].arrival, minutes("07:00"))
+
+    def test_minimum_transfer_time_within_operator(self):
+        legs = self.connections.plan("花蓮", "桃園", minutes("05:30"), "TRA")
+        self.assertEqual(summarize(legs), [("TRA", "101", "花蓮", "臺北"), ("TRA", "105", "臺北", "桃園")])
+
+    def test_transfer_between_operators(self):
+        legs = self.connections.plan("花蓮", "新左營", minutes("05:30"), "TRA")
+        self.assertEqual(summarize(legs), [("TRA", "101", "花蓮", "臺北"), (None, None, "臺北", "臺北"),
+                                           ("THSR", "0603", "臺北", "左營"), (None, None, "左營", "新左營")])
+        self.assertEqual(legs[-2].arrival, minutes("09:50"))
+        self.assertEqual(legs[-1].arrival, minutes("10:00"))
+
+    def test_departure_after_requested_time(self):
+        self.assertIsNone(self.connections.plan("花蓮", "新左營", minutes("06:00"), "TRA"))
+
+    def test_station_of_the_other_operator(self):
+        self.assertIsNone(self.connections.plan("花蓮", "左營", minutes("05:30"), "TRA"))
+
+    def test_unknown_station(self):
+        self.assertIsNone(self.connections.plan("花蓮", "屏東", minutes("05:30"), "TRA"))
+
+
+class TestCase_for_stations_of_the_same_name(unittest.TestCase):
+    def setUp(self):
+        # TRA 新竹 is far from THSR 新竹, which is reached from TRA 六家
+        tra = make_day("TRA", [
+            ("111", [("新竹", "07:00", "07:00"), ("六家", "07:20", "07:20")]),
+            ("113", [("新左營", "09:00", "09:00"), ("高雄", "09:10", "09:10")]),
+        ])
+        thsr = make_day("THSR", [
+            ("0611", [("新竹", "07:05", "07:05"), ("左營", "08:00", "08:00")]),
+            ("0613", [("新竹", "07:30", "07:30"), ("左營", "08:30", "08:30")]),
+        ])
+        self.connections = ConnectionDay(SERVICE_DATE, [tra, thsr])
+
+    def test_boards_the_other_operator_after_changing(self):
+        legs = self.connections.plan("新竹", "新左營", minutes("06:50"), "TRA")
+        self.assertEqual(summarize(legs), [("TRA", "111", "新竹", "六家"), (None, None, "六家", "新竹"),
+                                           ("THSR", "0613", "新竹", "左營"), (None, None, "左營", "新左營")])
+        self.assertEqual(legs[-1].arrival, minutes("08:40"))
+
+    def test_starts_at_the_station_of_the_train_type(self):
+        legs = self.connections.plan("新竹", "左營", minutes("06:50"), "THSR")
+        self.assertEqual(summarize(legs), [("THSR", "0611", "新竹", "左營")])
@@ -0,0 +1,110 @@
+import unittest
+import threading
+import time
+from unittest.mock import MagicMock, patch
+import requests
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage, Error
+
+from line_dispatcher import LineDispatcher, PooledHttpClient, PUSH_LATENCY, REPLY_LATENCY, LINE_API_TIMEOUT
+from . import create_test_app
+
+
+def line_error(status_code):
+    return LineBotApiError(status_code, Error(message="error"))
+
+
+class TestCase_for_LineDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.api = MagicMock()
+        self.dispatcher = LineDispatcher(self.api, backoff=0)
+        self.message = TextSendMessage(text="搜尋中...")
+
+    def test_push_async_retries_server_errors(self):
+        self.api.push_message.side_effect = [line_error(500), requests.ConnectionError(), None]
+        self.assertTrue(self.dispatcher.push_async("123", self.message))
+        self.dispatcher.join()
+        self.assertEqual(self.api.push_message.call_count, 3)
+
+    def test_client_error_is_not_retried(self):
+        self.api.push_message.side_effect = line_error(400)
+        with patch("sys.stdout"):
+            self.assertFalse(self.dispatcher.send_with_retries("123", self.message))
+        self.assertEqual(self.api.push_message.call_count, 1)
+
+    def test_gives_up_after_max_attempts(self):
+        self.api.push_message.side_effect = line_error(503)
+        with patch("sys.stdout"):
+            self.assertFalse(self.dispatcher.send_with_retries("123", self.message))
+        self.assertEqual(self.api.push_message.call_count, self.dispatcher.max_attempts)
+
+    def test_full_queue_refuses(self):
+        sending = threading.Event()
+        release = threading.Event()
+        self.api.push_message.side_effect = lambda *args: sending.set() or release.wait()
+        dispatcher = LineDispatcher(self.api, max_queued=1)
+        self.assertTrue(dispatcher.push_async("123", self.message))
+        sending.wait()
+        self.assertTrue(dispatcher.push_async("123", self.message))
+        self.assertFalse(dispatcher.push_async("123", self.message))
+        release.set()
+        dispatcher.join()
+
+    def test_queued_notice_is_dropped_after_its_reply(self):
+        sending = threading.Event()
+        release = threading.Event()
+        self.api.push_message.side_effect = lambda *args: sending.set() or release.wait()
+        self.assertTrue(self.dispatcher.push_async("456", self.message))
+        sending.wait()
+        self.assertTrue(self.dispatcher.push_async("123", self.message, "token"))
+        self.dispatcher.reply("token", TextSendMessage(text="result"))
+        release.set()
+        self.dispatcher.join()
+        self.assertEqual([c[0][0] for c in self.api.push_message.call_args_list], ["456"])
+
+    def test_reply_waits_for_its_notice_being_sent(self):
+        calls = list()
+        sending = threading.Event()
+        release = threading.Event()
+        self.api.push_message.side_effect = lambda *args: sending.set() or release.wait() and calls.append("push")
+        self.api.reply_message.side_effect = lambda *args: calls.append("reply")
+        self.assertTrue(self.dispatcher.push_async("123", self.message, "token"))
+        sending.wait()
+        reply = threading.Thread(target=self.dispatcher.reply, args=("token", TextSendMessage(text="result")))
+        reply.start()
+        reply.join(0.1)
+        self.assertEqual(calls, [])
+        release.set()
+        reply.join()
+        self.assertEqual(calls, ["push", "reply"])
+
+    def test_replies_are_sent_side_by_side(self):
+        self.api.reply_message.side_effect = lambda token, messages: time.sleep(0.2)
+        started = time.time()
+        self.assertEqual(self.dispatcher.reply_all([(str(i), self.message) for i in range(5)]), 5)
+        self.assertLess(time.time() - started, 0.2 * 3)
+
+    def test_failed_reply_does_not_stop_the_others(self):
+        self.api.reply_message.side_effect = [line_error(400), None]
+        with patch("sys.stdout"):
+            self.assertEqual(self.dispatcher.reply_all([("1", self.message), ("2", self.message)]), 1)
+
+    def test_latency_is_recorded(self):
+        replies, pushes = REPLY_LATENCY.snapshot()["count"], PUSH_LATENCY.snapshot()["count"]
+        self.dispatcher.reply("token", self.message)
+        self.dispatcher.push("123", self.message)
+        self.assertEqual(REPLY_LATENCY.snapshot()["count"], replies + 1)
+        self.assertEqual(PUSH_LATENCY.snapshot()["count"], pushes + 1)
+        self.api.reply_message.assert_called_once_with("token", self.message)
+
+
+class TestCase_for_PooledHttpClient(unittest.TestCase):
+    def test_posts_through_one_session(self):
+        client = create_test_app().linebot.http_client
+        self.assertIsInstance(client, PooledHttpClient)
+        self.assertEqual(client.timeout, LINE_API_TIMEOUT)
+        with patch.object(client.session, "post") as post:
+            post.return_value.status_code = 200
+            client.post("https://api.line.me/v2/bot/message/push", data="{}")
+            client.post("https://api.line.me/v2/bot/message/push", data="{}", timeout=1)
+        self.assertEqual([c[1]["timeout"] for c in post.call_args_list], [client.timeout, 1])
@@ -0,0 +1,48 @@
+import json
+import unittest
+from datetime import datetime
+import requests
+from linebot import WebhookParser
+from linebot.models import FollowEvent, MessageEvent, PostbackEvent
+
+from loadtest_webhook import LineApiStub, LoadTest, dialog_events, make_body, sign, is_error_reply
+
+
+class TestCase_for_loadtest_webhook(unittest.TestCase):
+    def test_signed_body_is_parsed(self):
+        events = [event for _, event in dialog_events("U123", "臺北", "臺中", datetime(2018, 6, 2, 7, 0))]
+        body = make_body(events)
+        parsed = WebhookParser("secret").parse(body, sign(body, "secret"))
+        self.assertEqual([type(e) for e in parsed], [FollowEvent] + [MessageEvent] * 4 + [PostbackEvent])
+        self.assertEqual(parsed[3].message.text, "臺北")
+        self.assertEqual(parsed[5].postback.params["datetime"], "2018-06-02T07:00")
+
+    def test_stub_records_replies_and_pushes(self):
+        stub = LineApiStub().start()
+        self.addCleanup(stub.stop)
+        requests.post(stub.url + "/v2/bot/message/reply",
+                      json={"replyToken": "abc", "messages": [{"type": "text", "text": "hi"}]})
+        requests.post(stub.url + "/v2/bot/message/push", json={"to": "U123", "messages": []})
+        reply = stub.wait_for_reply("abc", timeout=1)
+        self.assertEqual(reply[1], [{"type": "text", "text": "hi"}])
+        self.assertIsNone(stub.wait_for_reply("other", timeout=0.01))
+        self.assertEqual(stub.pushes, 1)
+
+    def test_report_counts_every_step(self):
+        stub = LineApiStub().start()
+        self.addCleanup(stub.stop)
+
+        def post(body, headers):
+            # Answer like the app would, but failing the searches
+            for event in json.loads(body)["events"]:
+                text = "系統發生錯誤" if event["type"] == "postback" else "ok"
+                stub.record("/v2/bot/message/reply", {"replyToken": event["replyToken"],
+                                                      "messages": [{"type": "text", "text": text}]})
+            return 200
+
+        result = LoadTest(post, stub, "secret", users=2, dialogs=2, reply_timeout=1).run()
+        self.assertEqual(result["requests"], 2 * (1 + 2 * 5))
+        self.assertEqual(result["steps"]["follow"]["requests"], 2)
+        self.assertEqual(result["steps"]["menu"]["error_rate"], 0)
+        self.assertEqual(result["steps"]["datetime"]["error_replies"], 4)
+        self.assertTrue(is_error_reply([{"type": "text", "text": "系統發生錯誤，請稍後再試"}]))
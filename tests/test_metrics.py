@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from metrics import counter, gauge, histogram, collect, collect_all, dump, merge, render, percentile
+from . import create_test_app
+
+app = create_test_app()
+
+
+def find_sample(samples, name, labels=None):
+    for sample in samples:
+        if sample["name"] == name and sample["labels"] == (labels or {}):
+            return sample
+    return None
+
+
+class TestCase_for_metrics(unittest.TestCase):
+    def test_labels_are_separate_metrics(self):
+        counter("test_events_total", "Events", labels={"event_type": "follow"}).inc()
+        counter("test_events_total", "Events", labels={"event_type": "message"}).inc(2)
+        counter("test_events_total", "Events", labels={"event_type": "message"}).inc()
+        samples = collect()
+        self.assertEqual(find_sample(samples, "test_events_total", {"event_type": "follow"})["value"], 1)
+        self.assertEqual(find_sample(samples, "test_events_total", {"event_type": "message"})["value"], 3)
+
+    def test_same_name_of_another_type(self):
+        counter("test_typed_total")
+        with self.assertRaises(ValueError):
+            gauge("test_typed_total")
+
+    def test_render_histogram(self):
+        h = histogram("test_render_seconds", "Render", buckets=(0.1, 1.0, float("inf")), labels={"train_type": "TRA"})
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(3)
+        text = render([s for s in collect() if s["name"] == "test_render_seconds"])
+        self.assertIn("# TYPE test_render_seconds histogram", text)
+        self.assertIn('test_render_seconds_bucket{train_type="TRA",le="0.1"} 1', text)
+        self.assertIn('test_render_seconds_bucket{train_type="TRA",le="1.0"} 2', text)
+        self.assertIn('test_render_seconds_bucket{train_type="TRA",le="+Inf"} 3', text)
+        self.assertIn('test_render_seconds_count{train_type="TRA"} 3', text)
+
+    def test_merge_processes(self):
+        def process(pid, value):
+            return {"pid": pid, "samples": [
+                {"name": "a_total", "type": "counter", "description": "", "labels": {}, "value": value},
+                {"name": "b", "type": "gauge", "description": "", "labels": {}, "value": value},
+                {"name": "c_seconds", "type": "histogram", "description": "", "labels": {}, "count": value,
+                 "sum": value, "buckets": [[1.0, value], [float("inf"), value]]},
+            ]}
+        with patch("metrics.is_running", side_effect=lambda pid: pid != 2):
+            samples = merge([process(1, 1), process(2, 2), process(3, 3)])
+        self.assertEqual(find_sample(samples, "a_total")["value"], 6)
+        # The gauge of a process which exited is left out
+        self.assertEqual(find_sample(samples, "b")["value"], 4)
+        self.assertEqual(find_sample(samples, "c_seconds")["count"], 6)
+        self.assertEqual(find_sample(samples, "c_seconds")["buckets"][1][1], 6)
+
+    def test_collect_all_reads_every_process(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        counter("test_workers_total").inc()
+        dump(directory, pid=os.getpid() + 100000)
+        with patch("metrics.is_running", return_value=True):
+            samples = collect_all(directory)
+        self.assertEqual(find_sample(samples, "test_workers_total")["value"], 2)
+
+    def test_metrics_endpoint(self):
+        counter("test_endpoint_total", "Endpoint").inc()
+        with patch.dict(app.config, {"METRICS_DIR": None}):
+            response = app.test_client().get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.get_data(as_text=True)
+        self.assertIn("test_endpoint_total 1", text)
+        self.assertIn("# TYPE search_cache_hits_total counter", text)
+
+    def test_metrics_endpoint_reads_metrics_dir_of_config(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        counter("test_config_dir_total").inc()
+        dump(directory, pid=os.getpid() + 100000)
+        with patch("metrics.is_running", return_value=True), patch.dict(app.config, {"METRICS_DIR": directory}):
+            text = app.test_client().get("/metrics").get_data(as_text=True)
+        self.assertIn("test_config_dir_total 2", text)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
@@ -0,0 +1,75 @@
+import unittest
+import json
+import logging
+from unittest.mock import patch
+from linebot.models import MessageEvent, SourceUser, TextMessage
+
+import request_log
+from request_log import redact, truncate, log_request, log_failed_event, pseudonym
+
+BODY = json.dumps({"events": [{
+    "type": "message", "replyToken": "secret-token", "timestamp": 1527868800000,
+    "source": {"type": "group", "userId": "U123", "groupId": "C456"},
+    "message": {"type": "text", "id": "1", "text": "查臺鐵"}
+}]})
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestCase_for_request_log(unittest.TestCase):
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger("test_request_log")
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        patcher = patch.object(request_log, "get_logger", return_value=self.logger)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ids_are_hashed_and_tokens_dropped(self):
+        source = redact(json.loads(BODY))["events"][0]
+        self.assertNotIn("replyToken", source)
+        self.assertEqual(source["source"]["userId"], pseudonym("U123"))
+        self.assertEqual(source["source"]["groupId"], pseudonym("C456"))
+        self.assertNotIn("123", source["source"]["userId"][1:])
+        self.assertEqual(source["message"]["text"], "查臺鐵")
+
+    def test_truncate(self):
+        self.assertEqual(truncate("abc", 5), "abc")
+        self.assertEqual(truncate("abcdefg", 5), "abcde...(2 more)")
+
+    def test_sampling(self):
+        self.assertFalse(log_request(BODY, sample_rate=0))
+        self.assertEqual(self.handler.records, [])
+        self.assertTrue(log_request(BODY, sample_rate=1))
+        record = json.loads(self.handler.records[0].getMessage())
+        self.assertEqual([record["events"], record["types"]], [1, ["message"]])
+        self.assertNotIn("U123", record["body"])
+        self.assertNotIn("secret-token", record["body"])
+
+    def test_failed_event_is_logged_whole(self):
+        event = MessageEvent(reply_token="secret-token", source=SourceUser(user_id="U123"),
+                             message=TextMessage(id="1", text="新竹" * 400))
+        log_failed_event(event)
+        record = self.handler.records[0]
+        self.assertEqual(record.levelno, logging.ERROR)
+        data = json.loads(record.getMessage())["failed_event"]
+        self.assertEqual(data["message"]["text"], "新竹" * 400)
+        self.assertEqual(data["source"]["userId"], pseudonym("U123"))
+
+
+class TestCase_for_queued_logger(unittest.TestCase):
+    def test_records_are_written_by_the_listener(self):
+        logger = request_log.get_logger()
+        handler = request_log._listener.handlers[0]
+        with patch.object(handler, "emit") as emit:
+            logger.info("queued")
+            request_log._listener.queue.join()
+        self.assertEqual(emit.call_args[0][0].getMessage(), "queued")
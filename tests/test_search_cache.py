@@ -0,0 +1,84 @@
+import unittest
+import os
+from datetime import date, datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .load_example import load_example_timetable_to_database, drop_all_table
+from models import Base, THSR_QuestionState
+from handlers import request_THSR_matching_train, find_matching_train
+from search_cache import SearchResultCache, CachedTrip, search_cache
+from timetable_index import timetable_index
+from . import create_test_app
+
+app = create_test_app()
+engine = create_engine(os.environ["TESTING_DATABASE_URI"])
+Session = sessionmaker(bind=engine)
+TEST_DATE = date(2018, 6, 5)
+
+
+class TestCase_for_SearchResultCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = SearchResultCache(max_size=2, bucket_minutes=10)
+        self.trips = [CachedTrip(1, "0803", None, 422, 520)]
+
+    def test_bucket(self):
+        self.assertEqual(self.cache.bucket_of(427), 420)
+        self.assertEqual(self.cache.bucket_of(420), 420)
+
+    def test_version_mismatch_is_a_miss(self):
+        key = ("THSR", "新竹", "左營", TEST_DATE, 420)
+        self.cache.put(key, (2, date(2018, 6, 1)), self.trips)
+        self.assertIs(self.cache.get(key, (2, date(2018, 6, 1))), self.trips)
+        self.assertIsNone(self.cache.get(key, (2, date(2018, 6, 2))))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        keys = [("THSR", "新竹", "左營", TEST_DATE, i * 10) for i in range(3)]
+        self.cache.put(keys[0], 1, self.trips)
+        self.cache.put(keys[1], 1, self.trips)
+        self.cache.get(keys[0], 1)
+        self.cache.put(keys[2], 1, self.trips)
+        self.assertIsNotNone(self.cache.get(keys[0], 1))
+        self.assertIsNone(self.cache.get(keys[1], 1))
+        self.assertEqual(self.cache.stats()["size"], 2)
+
+
+class TestCase_for_find_matching_train_with_cache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(engine)
+        session = Session()
+        load_example_timetable_to_database(session, TEST_DATE, "THSR")
+        session.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_all_table(engine)
+
+    def setUp(self):
+        self.app = app
+        self.app.session = Session()
+        search_cache.clear()
+        timetable_index.clear()
+
+    def tearDown(self):
+        search_cache.clear()
+        timetable_index.clear()
+        self.app.session.close()
+
+    def summarize(self, result):
+        return [[_l[0].train.train_no, _l[1].departure_time, _l[2].arrival_time] for _l in result]
+
+    def test_searches_in_same_bucket_share_an_entry(self):
+        with self.app.app_context():
+            for minute in (1, 7, 9):
+                qs = THSR_QuestionState(group=None, user='123', departure_station="新竹",
+                                        destination_station="左營",
+                                        departure_time=datetime(2018, 6, 5, 7, minute))
+                result = find_matching_train(qs, "THSR")
+                self.assertEqual(self.summarize(result), self.summarize(request_THSR_matching_train(qs)))
+        stats = search_cache.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 2)
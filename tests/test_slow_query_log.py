@@ -0,0 +1,76 @@
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from sqlalchemy import create_engine
+
+from slow_query_log import SlowQueryLog, enable_slow_query_log, process_log_path, read_records, summarize, main
+
+
+class TestCase_for_slow_query_log(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "slow_queries.log")
+        self.engine = create_engine(os.environ["TESTING_DATABASE_URI"])
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_slow_select_is_logged_with_plan(self):
+        SlowQueryLog(self.path, threshold_ms=0).attach(self.engine)
+        with self.engine.connect() as connection:
+            connection.execute("SELECT relname FROM pg_class WHERE relname = %(name)s", {"name": "U1234"})
+        records = list(read_records(self.path))
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record["shape"], "SELECT relname FROM pg_class WHERE relname = ?")
+        self.assertNotEqual(record["parameters"]["name"], "U1234")
+        self.assertTrue(record["plan"])
+
+    def test_every_process_writes_its_own_file(self):
+        SlowQueryLog(self.path, threshold_ms=0).attach(self.engine)
+        self.engine.execute("SELECT 1")
+        self.assertTrue(os.path.exists(process_log_path(self.path)))
+        self.assertFalse(os.path.exists(self.path))
+        other = process_log_path(self.path, pid=os.getpid() + 1)
+        with open(other, "w") as f:
+            f.write(json.dumps({"shape": "A", "seconds": 1.0}) + "\n")
+        with open(other + ".1", "w") as f:
+            f.write(json.dumps({"shape": "B", "seconds": 1.0}) + "\n")
+        self.assertEqual(sorted(r["shape"] for r in read_records(self.path)), ["A", "B", "SELECT ?"])
+
+    def test_fast_statement_is_not_logged(self):
+        SlowQueryLog(self.path, threshold_ms=10000).attach(self.engine)
+        self.engine.execute("SELECT 1")
+        self.assertEqual(list(read_records(self.path)), [])
+
+    def test_disabled_without_threshold(self):
+        self.assertIsNone(enable_slow_query_log(self.engine, self.path, threshold_ms=0))
+
+    def test_failed_explain_keeps_the_transaction(self):
+        log = SlowQueryLog(self.path, threshold_ms=0)
+        with self.engine.connect() as connection:
+            transaction = connection.begin()
+            connection.execute("SELECT 1")
+            self.assertIsNone(log.explain(connection, "SELECT no_such_column", {}))
+            self.assertEqual(connection.execute("SELECT 2").scalar(), 2)
+            transaction.rollback()
+
+    def test_summary_puts_the_largest_total_first(self):
+        with open(self.path, "w") as f:
+            for shape, seconds in [("A", 1.0), ("B", 0.8), ("B", 0.9), ("C", 0.1)]:
+                f.write(json.dumps({"shape": shape, "seconds": seconds, "plan": ["Seq Scan"]}) + "\n")
+            f.write("not json\n")
+        summary = summarize(read_records(self.path))
+        self.assertEqual([s["shape"] for s in summary], ["B", "A", "C"])
+        self.assertEqual(summary[0]["count"], 2)
+        self.assertEqual(summary[0]["max"], 0.9)
+        with patch("sys.argv", ["slow_query_log.py", "--file", self.path, "--top", "1"]), \
+                patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            main()
+        self.assertIn("1. 2 runs, total 1.70s", stdout.getvalue())
+        self.assertNotIn("\n   A", stdout.getvalue())
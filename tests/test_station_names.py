@@ -0,0 +1,53 @@
+import unittest
+
+from station_names import StationTrie, TRA_STATIONS, THSR_STATIONS
+
+
+class TestCase_for_station_trie(unittest.TestCase):
+    def test_longest_name_wins(self):
+        self.assertEqual(TRA_STATIONS.match("臺中港"), "臺中港")
+        self.assertEqual(TRA_STATIONS.match("臺中"), "臺中")
+        self.assertEqual(TRA_STATIONS.match("蘇澳新站"), "蘇澳新")
+        self.assertEqual(TRA_STATIONS.match("北新竹"), "北新竹")
+
+    def test_tai_is_folded(self):
+        self.assertEqual(TRA_STATIONS.match("台中港"), "臺中港")
+        self.assertEqual(THSR_STATIONS.match("台北"), "臺北")
+
+    def test_alias(self):
+        self.assertEqual(THSR_STATIONS.match("高雄"), "左營")
+        self.assertEqual(TRA_STATIONS.match("高雄"), "高雄")
+
+    def test_no_match(self):
+        self.assertIsNone(TRA_STATIONS.match("火車"))
+        self.assertIsNone(THSR_STATIONS.match(""))
+
+    def test_scan(self):
+        trie = StationTrie(["新竹", "北新竹", "竹北"])
+        self.assertEqual(trie.scan("從北新竹到竹北"), [(1, 4, "北新竹"), (5, 7, "竹北")])
+
+    def test_typo_is_resolved(self):
+        self.assertEqual(TRA_STATIONS.resolve("板僑"), ["板橋"])
+        self.assertEqual(THSR_STATIONS.resolve("左瑩"), ["左營"])
+
+    def test_station_words_are_ignored(self):
+        self.assertEqual(TRA_STATIONS.resolve("台北車站"), ["臺北"])
+        self.assertEqual(THSR_STATIONS.resolve("高鐵台中站"), ["臺中"])
+
+    def test_ambiguous_text_gives_candidates(self):
+        self.assertEqual(TRA_STATIONS.resolve("新行"), ["新營", "新竹", "新富"])
+        self.assertIsNone(TRA_STATIONS.match("新行"))
+        self.assertEqual(THSR_STATIONS.resolve("新行"), ["新竹"])
+
+    def test_names_in_a_sentence_only_anywhere(self):
+        self.assertEqual(TRA_STATIONS.resolve("明天去新竹玩"), ["新竹"])
+        self.assertEqual(TRA_STATIONS.resolve("明天去新竹玩", anywhere=False), [])
+        self.assertEqual(THSR_STATIONS.resolve("今天中壢好塞"), ["桃園"])
+        self.assertEqual(THSR_STATIONS.resolve("今天中壢好塞", anywhere=False), [])
+        self.assertEqual(THSR_STATIONS.resolve("中壢", anywhere=False), ["桃園"])
+        self.assertEqual(TRA_STATIONS.resolve("台北車站", anywhere=False), ["臺北"])
+        self.assertEqual(TRA_STATIONS.resolve("板僑", anywhere=False), ["板橋"])
+        self.assertIsNone(TRA_STATIONS.match("新竹北埔", anywhere=False))
+
+    def test_nothing_close_gives_no_candidate(self):
+        self.assertEqual(TRA_STATIONS.resolve("我想要回家吃飯了"), [])
@@ -0,0 +1,104 @@
+import unittest
+from unittest.mock import patch
+import os
+from datetime import date, datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .load_example import load_example_timetable_to_database, drop_all_table
+from models import Base, TRA_QuestionState, THSR_QuestionState
+from handlers import request_matching_train, find_matching_train
+from timetable_index import TimetableIndex, DayIndex, timetable_index
+from search_cache import search_cache
+from . import create_test_app
+
+app = create_test_app()
+engine = create_engine(os.environ["TESTING_DATABASE_URI"])
+Session = sessionmaker(bind=engine)
+TRA_DATE = date(2018, 6, 2)
+THSR_DATE = date(2018, 6, 5)
+
+TRA_CASES = [("新竹", "高雄", datetime(2018, 6, 2, 7, 0)),
+             ("鶯歌", "山佳", datetime(2018, 6, 2, 22, 0)),
+             ("基隆", "新營", datetime(2018, 6, 2, 6, 0)),
+             ("榮華", "內灣", datetime(2018, 6, 2, 6, 0)),
+             ("臺北", "花蓮", datetime(2018, 6, 2, 20, 30)),
+             ("臺北", "臺北", datetime(2018, 6, 2, 8, 0))]
+THSR_CASES = [("新竹", "左營", datetime(2018, 6, 5, 7, 0)),
+              ("左營", "臺北", datetime(2018, 6, 5, 21, 0)),
+              ("臺中", "南港", datetime(2018, 6, 5, 6, 0))]
+
+
+def summarize(result):
+    return [[_l[0].train.train_no, _l[1].departure_time, _l[2].arrival_time] for _l in result]
+
+
+class TestCase_for_timetable_index(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(engine)
+        session = Session()
+        load_example_timetable_to_database(session, TRA_DATE)
+        load_example_timetable_to_database(session, THSR_DATE, "THSR")
+        session.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        timetable_index.clear()
+        drop_all_table(engine)
+
+    def setUp(self):
+        self.app = app
+        self.app.session = Session()
+        self.index = TimetableIndex()
+        search_cache.clear()
+
+    def tearDown(self):
+        self.app.session.close()
+
+    def compare_with_sql(self, train_type, qs_class, cases, service_date):
+        day = self.index.load(self.app.session, train_type, service_date)
+        for departure_station, destination_station, departure_time in cases:
+            qs = qs_class(group=None, user='123',
+                          departure_station=departure_station,
+                          destination_station=destination_station,
+                          departure_time=departure_time)
+            with self.app.app_context():
+                expected = request_matching_train(qs, train_type)
+            start = (departure_time - datetime.combine(service_date, datetime.min.time())).seconds // 60
+            result = day.search(departure_station, destination_station, start, start + 5 * 60)
+            self.assertEqual(summarize(result), summarize(expected))
+
+    def test_TRA_search_is_same_as_sql(self):
+        self.compare_with_sql("TRA", TRA_QuestionState, TRA_CASES, TRA_DATE)
+
+    def test_THSR_search_is_same_as_sql(self):
+        self.compare_with_sql("THSR", THSR_QuestionState, THSR_CASES, THSR_DATE)
+
+    def test_result_keeps_train_type(self):
+        day = self.index.load(self.app.session, "TRA", TRA_DATE)
+        result = day.search("新竹", "高雄", 7 * 60, 12 * 60)
+        self.assertEqual([result[0][0].train.train_no, result[0][0].train.train_type], ['51', '莒光'])
+
+    def test_station_missing_in_data_gets_a_code(self):
+        day = DayIndex("THSR", THSR_DATE)
+        day.add_timetable(1, "0999", None, [("臺北", 600, 600), ("測試", 650, 651)])
+        day.freeze()
+        result = day.search("臺北", "測試", 500, 700)
+        self.assertEqual(summarize(result), [['0999', datetime(2018, 6, 5, 10, 0), datetime(2018, 6, 5, 10, 50)]])
+        self.assertEqual(result[0][2].station_name, "測試")
+
+    def test_empty_date_is_not_kept(self):
+        self.index.load(self.app.session, "TRA", date(2018, 1, 1))
+        self.assertIsNone(self.index.get("TRA", date(2018, 1, 1)))
+
+    @patch("handlers.request_matching_train")
+    def test_find_matching_train_uses_loaded_date(self, mock_request):
+        timetable_index.load(self.app.session, "THSR", THSR_DATE)
+        qs = THSR_QuestionState(group=None, user='123', departure_station="新竹",
+                                destination_station="左營",
+                                departure_time=datetime(2018, 6, 5, 7, 0))
+        with self.app.app_context():
+            result = find_matching_train(qs, "THSR")
+        mock_request.assert_not_called()
+        self.assertEqual(summarize(result)[0], ['0803', datetime(2018, 6, 5, 7, 2), datetime(2018, 6, 5, 8, 40)])
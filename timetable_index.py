@@ -0,0 +1,324 @@
+"""
+In-process timetable index.
+
+For every (train type, service date) that has been loaded, the departures of each station are kept
+sorted by time, so "trains from A after T reaching B" becomes a binary search followed by a stop
+order check instead of several SQL round trips.
+"""
+import sys
+import bisect
+import threading
+import traceback
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta, time
+
+from sqlalchemy.orm.exc import NoResultFound
+from models import (
+    TRA_Train, TRA_TrainTimeTable, TRA_TableEntry, TRA_BuildingStatusOnDate,
+    THSR_Train, THSR_TrainTimeTable, THSR_TableEntry, THSR_BuildingStatusOnDate
+)
+from data import TRA_STATION_CODE2NAME, THSR_STATION_CODE2NAME
+
+# Only keep the most recently used dates in memory, about two months of TRA and THSR
+MAX_LOADED_DAYS = 105
+
+
+class IndexedTrain(object):
+    __slots__ = ("train_no", "train_type")
+
+    def __init__(self, train_no, train_type=None):
+        self.train_no = train_no
+        self.train_type = train_type
+
+
+class IndexedTimetable(object):
+    """
+    Stands in for TRA_TrainTimeTable / THSR_TrainTimeTable in search results
+    """
+    __slots__ = ("id", "date", "train")
+
+    def __init__(self, timetable_id, service_date, train):
+        self.id = timetable_id
+        self.date = service_date
+        self.train = train
+
+
+class IndexedEntry(object):
+    """
+    Stands in for TRA_TableEntry / THSR_TableEntry in search results
+    """
+    __slots__ = ("station_name", "arrival_time", "departure_time")
+
+    def __init__(self, station_name, arrival_time, departure_time):
+        self.station_name = station_name
+        self.arrival_time = arrival_time
+        self.departure_time = departure_time
+
+
+def minutes_since(service_date, dt):
+    return int((dt - datetime.combine(service_date, time(0))).total_seconds() // 60)
+
+
+class StationCodes(object):
+    """
+    Small int codes of station names, shared by every DayIndex of a train type.
+    Codes follow the PTX station codes of data.py, names missing there get the next free code.
+    """
+    def __init__(self, code2name):
+        self.names = list()
+        self.codes = dict()
+        self._lock = threading.Lock()
+        for _, name in sorted(code2name.items()):
+            self.code(name)
+
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            with self._lock:
+                code = self.codes.get(name)
+                if code is None:
+                    code = self.codes[name] = len(self.names)
+                    self.names.append(name)
+        return code
+
+    def name(self, code):
+        return self.names[code]
+
+
+STATION_CODES = {
+    "TRA": StationCodes(TRA_STATION_CODE2NAME),
+    "THSR": StationCodes(THSR_STATION_CODE2NAME),
+}
+
+
+class DayIndex(object):
+    """
+    Timetables of one train type on one service date, kept in flat arrays.
+    Trips are numbered in the order they are added, the stops of trip i are the positions
+    trip_offsets[i] to trip_offsets[i + 1] of the stop arrays. Stations are stored as StationCodes and
+    times as minutes since the start of the service date, so stops after midnight are larger than 1440.
+    Result rows are only materialized as Indexed* views.
+    """
+    def __init__(self, train_type, service_date, version=None):
+        self.train_type = train_type
+        self.date = service_date
+        self.version = version
+        self.stations = STATION_CODES[train_type]
+        self.timetable_ids = array("I")
+        self.train_nos = list()
+        self.train_types = list()
+        self.trip_offsets = array("I", [0])
+        self.stop_stations = array("H")
+        self.stop_arrivals = array("h")
+        self.stop_departures = array("h")
+        # station code -> sorted departure minutes, used for bisect
+        self.departure_keys = dict()
+        # station code -> stop position and trip of every departure, in the order of departure_keys
+        self.departure_stops = dict()
+        self.departure_trips = dict()
+
+    def __len__(self):
+        return len(self.timetable_ids)
+
+    def add_timetable(self, timetable_id, train_no, train_type, stops):
+        """
+        :param stops: list of (station_name, arrival minute, departure minute) in stop order
+        """
+        self.timetable_ids.append(timetable_id)
+        # The same train numbers come back every date
+        self.train_nos.append(sys.intern(train_no))
+        self.train_types.append(sys.intern(train_type) if train_type else train_type)
+        for station_name, arrival, departure in stops:
+            self.stop_stations.append(self.stations.code(station_name))
+            self.stop_arrivals.append(arrival)
+            self.stop_departures.append(departure)
+        self.trip_offsets.append(len(self.stop_stations))
+
+    def freeze(self):
+        departures = dict()
+        for trip in range(len(self)):
+            for position in range(self.trip_offsets[trip], self.trip_offsets[trip + 1]):
+                departures.setdefault(self.stop_stations[position], []).append(
+                    (self.stop_departures[position], trip, position))
+        for code, station_departures in departures.items():
+            station_departures.sort()
+            self.departure_keys[code] = array("h", [d[0] for d in station_departures])
+            self.departure_trips[code] = array("I", [d[1] for d in station_departures])
+            self.departure_stops[code] = array("I", [d[2] for d in station_departures])
+
+    def timetable(self, trip):
+        return IndexedTimetable(self.timetable_ids[trip], self.date,
+                                IndexedTrain(self.train_nos[trip], self.train_types[trip]))
+
+    def make_entry(self, position):
+        start = datetime.combine(self.date, time(0))
+        return IndexedEntry(self.stations.name(self.stop_stations[position]),
+                            start + timedelta(minutes=self.stop_arrivals[position]),
+                            start + timedelta(minutes=self.stop_departures[position]))
+
+    def search(self, departure_station, destination_station, start, end):
+        """
+        Find trains leaving departure_station in (start, end) minutes and arriving at
+        destination_station afterwards.
+        :return: list of [timetable, dep_entry, dest_entry] sorted by departure time
+        """
+        departure_code = self.stations.codes.get(departure_station)
+        destination_code = self.stations.codes.get(destination_station)
+        keys = self.departure_keys.get(departure_code)
+        if not keys or destination_code not in self.departure_keys:
+            return []
+        trips = self.departure_trips[departure_code]
+        positions = self.departure_stops[departure_code]
+        stop_stations, stop_arrivals = self.stop_stations, self.stop_arrivals
+        seen = set()
+        suitable_trains = list()
+        for i in range(bisect.bisect_right(keys, start), len(keys)):
+            departure = keys[i]
+            if departure >= end:
+                break
+            trip = trips[i]
+            # A train passing the station twice only counts with its earliest departure
+            if trip in seen:
+                continue
+            seen.add(trip)
+            position = positions[i]
+            for dest_position in range(position + 1, self.trip_offsets[trip + 1]):
+                if stop_stations[dest_position] == destination_code and stop_arrivals[dest_position] > departure:
+                    suitable_trains.append([self.timetable(trip), self.make_entry(position),
+                                            self.make_entry(dest_position)])
+                    break
+        return suitable_trains
+
+
+def get_table_classes(train_type):
+    if train_type == "TRA":
+        return TRA_Train, TRA_TrainTimeTable, TRA_TableEntry
+    elif train_type == "THSR":
+        return THSR_Train, THSR_TrainTimeTable, THSR_TableEntry
+    raise ValueError("Unknown train type: {0}".format(train_type))
+
+
+def get_timetable_version(session, train_type, service_date):
+    """
+    The building status works as a version stamp of the timetable on a date. The status is 2 while a
+    rebuild of the date runs too, the number of finished builds tells the timetables apart.
+    :return: None if the date is not completely built, otherwise (status, build, trip_pairs)
+    """
+    status_class = TRA_BuildingStatusOnDate if train_type == "TRA" else THSR_BuildingStatusOnDate
+    try:
+        status, build, trip_pairs = session.query(
+            status_class.status, status_class.build, status_class.trip_pairs) \
+            .filter_by(assigned_date=service_date).one()
+    except NoResultFound:
+        return None
+    if status != 2:
+        return None
+    return status, build, bool(trip_pairs)
+
+
+def build_day_index_query(session, train_type, service_date):
+    train_class, timetable_class, table_entry_class = get_table_classes(train_type)
+    columns = [timetable_class.id, table_entry_class.station_name,
+               table_entry_class.arrival_minute, table_entry_class.departure_minute, train_class.train_no]
+    if train_type == "TRA":
+        columns.append(train_class.train_type)
+    return session.query(*columns) \
+        .join(timetable_class, table_entry_class.pattern_id == timetable_class.pattern_id) \
+        .join(train_class, timetable_class.train_id == train_class.id) \
+        .filter(timetable_class.date == service_date) \
+        .order_by(timetable_class.id, table_entry_class.arrival_minute, table_entry_class.id)
+
+
+def build_day_index(session, train_type, service_date):
+    """
+    Load every timetable entry of the date with a single query
+    """
+    q = build_day_index_query(session, train_type, service_date)
+    day = DayIndex(train_type, service_date, get_timetable_version(session, train_type, service_date))
+    current_id = None
+    current_train = None
+    stops = list()
+    for row in q:
+        if row[0] != current_id:
+            if current_id is not None:
+                day.add_timetable(current_id, current_train[0], current_train[1], stops)
+            current_id = row[0]
+            current_train = (row[4], row[5] if len(row) > 5 else None)
+            stops = list()
+        stops.append((row[1], row[2], row[3]))
+    if current_id is not None:
+        day.add_timetable(current_id, current_train[0], current_train[1], stops)
+    day.freeze()
+    return day
+
+
+class TimetableIndex(object):
+    """
+    Holds the DayIndex of recently searched dates.
+    Dates are loaded in background threads so that a search never waits for it.
+    """
+    def __init__(self, max_days=MAX_LOADED_DAYS):
+        self.max_days = max_days
+        self._days = OrderedDict()
+        self._loading = set()
+        self._lock = threading.Lock()
+
+    def get(self, train_type, service_date, version=None):
+        """
+        :param version: if given, a date loaded from another version of the timetable is ignored
+        """
+        key = (train_type, service_date)
+        with self._lock:
+            day = self._days.get(key)
+            if day is None or (version is not None and day.version != version):
+                return None
+            self._days.move_to_end(key)
+            return day
+
+    def put(self, day):
+        key = (day.train_type, day.date)
+        with self._lock:
+            self._days[key] = day
+            self._days.move_to_end(key)
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._days.clear()
+
+    def load(self, session, train_type, service_date):
+        day = build_day_index(session, train_type, service_date)
+        # An empty date has not been built yet, keep asking the database instead
+        if len(day) and day.version is not None:
+            self.put(day)
+        return day
+
+    def schedule_load(self, session_factory, train_type, service_date):
+        """
+        Load the date in a background thread unless it is already being loaded
+        """
+        key = (train_type, service_date)
+        with self._lock:
+            if key in self._loading:
+                return False
+            self._loading.add(key)
+
+        def run():
+            session = session_factory()
+            try:
+                self.load(session, train_type, service_date)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+            finally:
+                session.close()
+                with self._lock:
+                    self._loading.discard(key)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return True
+
+
+timetable_index = TimetableIndex()
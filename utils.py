@@ -10,17 +10,34 @@ import re
 import time
 
 
-keys_candidates = list()
-with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "ptx_keys.txt"), "r") as infile:
-    ID = KEY = ""
-    for line in infile:
-        line = line.rstrip('\n')
-        if line and not ID:
-            ID = line
-        elif line and not KEY:
-            KEY = line
-            keys_candidates.append((ID, KEY))
-            ID = KEY = ""
+PTX_KEYS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "ptx_keys.txt")
+# (app id, app key) of PTX, read from PTX_KEYS_PATH on the first request
+_keys_candidates = None
+
+
+def load_keys_candidates(path=PTX_KEYS_PATH):
+    """
+    The file holds an app id and its app key per two lines
+    """
+    keys_candidates = list()
+    with open(path, "r") as infile:
+        ID = KEY = ""
+        for line in infile:
+            line = line.rstrip('\n')
+            if line and not ID:
+                ID = line
+            elif line and not KEY:
+                KEY = line
+                keys_candidates.append((ID, KEY))
+                ID = KEY = ""
+    return keys_candidates
+
+
+def get_keys_candidates():
+    global _keys_candidates
+    if _keys_candidates is None:
+        _keys_candidates = load_keys_candidates()
+    return _keys_candidates
 
 
 def request_MOTC(url):
@@ -42,6 +59,7 @@ def request_MOTC(url):
         }
 
     url += "?$format=JSON"
+    keys_candidates = get_keys_candidates()
     r = None
     # In my experience, PTX platform is not stable, so try multiple times to work around
     # If message in response, then the problem is probably related to the key, so change the key
@@ -1,9 +1,13 @@
-from flask import request, abort
+from flask import request, abort, Response, jsonify
 from flask import current_app
 from flask.views import View
 from linebot.exceptions import InvalidSignatureError
 from datetime import datetime
-from handlers import handle_events
+from handlers import handle_events, session_factory, get_request_date
+from event_queue import EventQueue
+from request_log import log_request
+from metrics import collect_all, render
+from health import check_readiness
 
 
 def register_url(app):
@@ -12,6 +16,9 @@ def register_url(app):
     """
     app.add_url_rule('/', view_func=IndexView.as_view("index"))
     app.add_url_rule('/callback', view_func=LineRequestView.as_view('line'))
+    app.add_url_rule('/metrics', view_func=MetricsView.as_view('metrics'))
+    app.add_url_rule('/healthz', view_func=HealthView.as_view('healthz'))
+    app.add_url_rule('/readyz', view_func=ReadyView.as_view('readyz'))
 
 
 class IndexView(View):
@@ -19,6 +26,24 @@ class IndexView(View):
         return "Hello From Triple T at {0}.".format(datetime.now().strftime("%Y/%m/%d %H:%M"))
 
 
+class HealthView(View):
+    def dispatch_request(self):
+        return "OK"
+
+
+class ReadyView(View):
+    def dispatch_request(self):
+        ready, checks = check_readiness(session_factory, get_request_date(datetime.now()))
+        return jsonify(checks), 200 if ready else 503
+
+
+class MetricsView(View):
+    def dispatch_request(self):
+        # Metrics of every gunicorn worker when they are written to METRICS_DIR
+        samples = collect_all(current_app.config.get("METRICS_DIR"))
+        return Response(render(samples), mimetype="text/plain; version=0.0.4")
+
+
 class LineRequestView(View):
     methods = ["POST"]
 
@@ -28,12 +53,23 @@ class LineRequestView(View):
 
         # get request body as text
         body = request.get_data(as_text=True)
-        current_app.logger.info("Request body: " + body)
+        log_request(body)
         # handle webhook body
         try:
             events = current_app.parser.parse(body, signature)
         except InvalidSignatureError:
             current_app.logger.error("Invalid Signature.")
             abort(400)
-        handle_events(events)
+        # Events are handled and replied by the workers of the event queue
+        if not current_app.event_queue.submit(events):
+            current_app.logger.error("Event queue is full, {0} events are refused.".format(len(events)))
+            abort(503)
         return 'OK'
+
+
+def create_event_queue(app):
+    def handle(events):
+        with app.app_context():
+            handle_events(events)
+    return EventQueue(handle, workers=app.config["EVENT_QUEUE_WORKERS"],
+                      max_depth=app.config["EVENT_QUEUE_MAX_DEPTH"], logger=app.logger)
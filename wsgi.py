@@ -1 +1,3 @@
-from app import app as application  # noqa
\ No newline at end of file
+from app import create_app, start_app
+
+application = start_app(create_app())